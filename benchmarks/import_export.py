@@ -0,0 +1,146 @@
+"""Benchmark importing and exporting a large site.
+
+Writes a synthetic NDJSON export (by default 100k posts, most of them
+replies or likes citing a smaller pool of urls, with tags and
+mentions), imports it into a throwaway sqlite database, then exports
+it again. Prints records per second and the peak resident memory of
+each phase.
+
+    python benchmarks/import_export.py --posts 100000 --batch-size 500
+"""
+from redwind import create_app, exporter, importer
+from redwind.extensions import db
+from redwind.models import Context, Post
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+CONFIG = """\
+SECRET_KEY = 'benchmark'
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{db_path}'
+REDIS_URL = 'redis://localhost:911'
+"""
+
+SETTINGS = {
+    'posts_per_page': '15',
+    'author_domain': 'example.com',
+    'site_url': 'http://example.com',
+    'timezone': 'America/Los_Angeles',
+}
+
+
+def context(url):
+    return {
+        'url': url, 'permalink': url, 'author_name': 'Someone',
+        'author_url': 'http://someone.example.org/', 'author_image': None,
+        'content': 'Something worth replying to', 'content_plain': None,
+        'published': '2014-01-01T00:00:00', 'title': None,
+        'syndication': [],
+    }
+
+
+def mention(post_idx, idx):
+    url = 'http://example.org/reply/{}/{}'.format(post_idx, idx)
+    return {
+        'url': url, 'permalink': url, 'author_name': 'Person',
+        'author_url': 'http://person.example.org/', 'author_image': None,
+        'content': 'Nice!', 'content_plain': 'Nice!',
+        'published': '2014-01-01T00:00:00', 'title': None,
+        'syndication': [], 'reftype': 'reply',
+    }
+
+
+def write_export(f, num_posts, num_urls):
+    def write(rectype, data):
+        f.write(json.dumps({'type': rectype, 'data': data}) + '\n')
+
+    for key, value in SETTINGS.items():
+        write('setting', {'key': key, 'name': None, 'value': value})
+    start = datetime.datetime(2005, 1, 1)
+    for ii in range(num_posts):
+        published = start + datetime.timedelta(hours=ii)
+        url = 'http://example.org/cited/{}'.format(ii % num_urls)
+        post_type = ('note', 'reply', 'like')[ii % 3]
+        write('post', {
+            'path': '{}/{:02d}/post-{}'.format(
+                published.year, published.month, ii),
+            'historic_path': None, 'post_type': post_type,
+            'draft': False, 'deleted': False, 'hidden': False,
+            'redirect': None, 'friends_only': False,
+            'tags': ['tag-{}'.format(ii % 50)], 'people': [],
+            'in_reply_to': [url] if post_type == 'reply' else [],
+            'repost_of': [],
+            'like_of': [url] if post_type == 'like' else [],
+            'bookmark_of': [],
+            'reply_contexts': [context(url)] if post_type == 'reply' else [],
+            'like_contexts': [context(url)] if post_type == 'like' else [],
+            'repost_contexts': [], 'bookmark_contexts': [],
+            'title': None, 'published': published.isoformat(),
+            'updated': published.isoformat(), 'slug': 'post-{}'.format(ii),
+            'syndication': [], 'location': None, 'venue': None,
+            'attachments': [],
+            'mentions': [mention(ii, jj) for jj in range(ii % 3)],
+            'content': 'Post number {}'.format(ii),
+            'content_html': '<p>Post number {}</p>'.format(ii),
+        })
+
+
+def peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--urls', type=int, default=1000,
+                        help='distinct urls cited by replies and likes')
+    parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg_path = os.path.join(tmpdir, 'redwind.cfg')
+        with open(cfg_path, 'w') as f:
+            f.write(CONFIG.format(db_path=os.path.join(tmpdir, 'bench.db')))
+        export_path = os.path.join(tmpdir, 'export.ndjson')
+        with open(export_path, 'w') as f:
+            write_export(f, args.posts, args.urls)
+        print('export file: {:.1f}MB, peak rss {:.0f}MB'.format(
+            os.path.getsize(export_path) / 1e6, peak_rss_mb()))
+
+        app = create_app(cfg_path)
+        with app.app_context():
+            db.create_all()
+
+            start = time.perf_counter()
+            with open(export_path) as f:
+                stats = importer.import_file(f, batch_size=args.batch_size)
+            elapsed = time.perf_counter() - start
+            print('import: {} posts in {:.1f}s ({:.0f} posts/s), '
+                  'peak rss {:.0f}MB'.format(
+                      stats['post'], elapsed, stats['post'] / elapsed,
+                      peak_rss_mb()))
+            print('  {} contexts for {} distinct urls'.format(
+                Context.query.count(), args.urls))
+
+            start = time.perf_counter()
+            out_path = os.path.join(tmpdir, 'reexport.ndjson')
+            with open(out_path, 'w') as f:
+                exporter.export_to_file(f)
+            elapsed = time.perf_counter() - start
+            print('export: {} posts in {:.1f}s ({:.0f} posts/s), '
+                  'peak rss {:.0f}MB'.format(
+                      Post.query.count(), elapsed,
+                      args.posts / elapsed, peak_rss_mb()))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
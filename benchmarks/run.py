@@ -0,0 +1,209 @@
+"""End-to-end benchmarks for the main views, feeds and the save pipeline.
+
+Seeds a synthetic database (a throwaway sqlite file by default, or an
+empty database given by --database-uri, e.g. Postgres), then times
+requests against each scenario through the test client and reports
+requests per second and latency percentiles. Results can be written
+as JSON and compared with an earlier run, e.g. from another commit:
+
+    python benchmarks/run.py --posts 2000 --output before.json
+    python benchmarks/run.py --posts 2000 --compare before.json
+
+Jobs that saving a post would queue (webmentions, syndication, ...) are
+recorded but not run, so the write scenarios time only the request
+itself, and Redis is not needed.
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import create_bench_app, seed, access_token
+from redwind import tasks
+from redwind.extensions import db
+from redwind.models import Post, User, Tag
+import argparse
+import datetime
+import flask_login
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+class RecordingQueue:
+    """Stands in for the RQ queue; counts jobs instead of running them"""
+    def __init__(self):
+        self.jobs = 0
+
+    def enqueue(self, func, *args, **kwargs):
+        self.jobs += 1
+
+
+def bench_login():
+    flask_login.login_user(User.query.first(), remember=True)
+    return 'logged in'
+
+
+def scenarios(app):
+    """Each scenario is (name, expected status, function of (client, ii)
+    that makes the iith request)
+    """
+    with app.app_context():
+        paths = [path for path, in Post.query.with_entities(Post.path)
+                 .order_by(Post.published.desc()).limit(100)]
+        tag = Tag.query.first().name
+        token = access_token()
+
+    def new_post_form(ii):
+        return {'post_type': 'note', 'action': 'publish',
+                'content': 'Benchmarking #{} with @person1 #bench'
+                .format(ii)}
+
+    return [
+        ('index', 200, lambda c, ii: c.get('/')),
+        ('posts_by_tag', 200, lambda c, ii: c.get('/tags/{}/'.format(tag))),
+        ('post_by_path', 200,
+         lambda c, ii: c.get('/' + paths[ii % len(paths)])),
+        ('atom_index', 200, lambda c, ii: c.get('/?feed=atom')),
+        ('atom_everything', 200,
+         lambda c, ii: c.get('/everything/?feed=atom')),
+        ('atom_tag', 200,
+         lambda c, ii: c.get('/tags/{}/?feed=atom'.format(tag))),
+        ('tag_cloud', 200, lambda c, ii: c.get('/tags/')),
+        ('admin.save_post', 302,
+         lambda c, ii: c.post('/save_new', data=new_post_form(ii))),
+        ('micropub_create', 201,
+         lambda c, ii: c.post('/micropub', data={
+             'h': 'entry', 'content': 'Micropub #{}'.format(ii),
+             'category': 'bench'},
+             headers={'Authorization': 'Bearer ' + token})),
+    ]
+
+
+def percentile(sorted_times, pct):
+    idx = min(len(sorted_times) - 1,
+              int(round(pct / 100 * (len(sorted_times) - 1))))
+    return sorted_times[idx]
+
+
+def run_scenario(client, request, expected, num_requests, warmup):
+    for ii in range(warmup):
+        request(client, ii)
+
+    times = []
+    start = time.perf_counter()
+    for ii in range(num_requests):
+        before = time.perf_counter()
+        rv = request(client, warmup + ii)
+        times.append(time.perf_counter() - before)
+        assert rv.status_code == expected, (rv.status_code, rv.location)
+    elapsed = time.perf_counter() - start
+
+    times.sort()
+    return {
+        'requests': num_requests,
+        'requests_per_second': num_requests / elapsed,
+        'mean_ms': 1000 * elapsed / num_requests,
+        'p50_ms': 1000 * percentile(times, 50),
+        'p90_ms': 1000 * percentile(times, 90),
+        'p95_ms': 1000 * percentile(times, 95),
+        'p99_ms': 1000 * percentile(times, 99),
+        'max_ms': 1000 * times[-1],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print('{:<18} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'vs base' if baseline else ''))
+    for name, result in results.items():
+        change = ''
+        base = baseline and baseline.get(name)
+        if base:
+            change = '{:+.1f}%'.format(
+                100 * (result['requests_per_second']
+                       / base['requests_per_second'] - 1))
+        print('{:<18} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9}'.format(
+            name, result['requests_per_second'], result['p50_ms'],
+            result['p95_ms'], result['p99_ms'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-uri',
+                        help='an empty database to seed, instead of a '
+                        'temporary sqlite file')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--mentions', type=int, default=10,
+                        help='mentions per post')
+    parser.add_argument('--contexts', type=int, default=200,
+                        help='distinct urls that posts reply to')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--scenario', action='append',
+                        help='only run these scenarios')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare',
+                        help='a JSON file from an earlier run to compare to')
+    args = parser.parse_args()
+
+    queue = tasks._queue = RecordingQueue()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        app = create_bench_app(tmpdir, args.database_uri)
+        app.add_url_rule('/bench_login', 'bench_login', bench_login)
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            seed(args.posts, args.mentions, args.tags, args.contexts)
+            print('seeded {} posts in {:.1f}s'.format(
+                args.posts, time.perf_counter() - start))
+            dialect = db.engine.dialect.name
+
+        client = app.test_client()
+        client.get('/bench_login')
+        results = {}
+        for name, expected, request in scenarios(app):
+            if args.scenario and name not in args.scenario:
+                continue
+            results[name] = run_scenario(
+                client, request, expected, args.requests, args.warmup)
+        print('{} jobs queued'.format(queue.jobs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'timestamp': datetime.datetime.utcnow().isoformat(),
+                'database': dialect,
+                'params': {
+                    'posts': args.posts, 'tags': args.tags,
+                    'mentions': args.mentions, 'contexts': args.contexts,
+                    'requests': args.requests, 'warmup': args.warmup,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Build a throwaway app and fill its database with synthetic posts, for
+the benchmarks in this directory.
+"""
+from redwind import create_app, util
+from redwind.extensions import db
+from redwind.models import Post, Mention, Setting, Tag, Context
+from redwind.models import Contact, Nick, User, Credential
+import datetime
+import logging
+import os
+import random
+
+CONFIG = """\
+SECRET_KEY = 'benchmark'
+SQLALCHEMY_DATABASE_URI = '{database_uri}'
+REDIS_URL = 'redis://localhost:911'
+PILBOX_URL = '/imageproxy'
+PILBOX_KEY = 'benchmark'
+UPLOAD_PATH = '{tmpdir}/uploads'
+IMAGEPROXY_PATH = '{tmpdir}/imageproxy'
+FILE_DELIVERY = 'direct'
+"""
+
+SETTINGS = {
+    'posts_per_page': '15',
+    'author_domain': 'example.com',
+    'author_name': 'Benchmark',
+    'site_url': 'http://example.com',
+    'timezone': 'America/Los_Angeles',
+}
+
+ME = 'http://example.com/'
+
+
+def create_bench_app(tmpdir, database_uri=None):
+    """Write a config file under tmpdir and create an app from it.
+    Defaults to a sqlite database in tmpdir.
+    """
+    cfg_path = os.path.join(tmpdir, 'redwind.cfg')
+    with open(cfg_path, 'w') as f:
+        f.write(CONFIG.format(
+            database_uri=database_uri or 'sqlite:///{}'.format(
+                os.path.join(tmpdir, 'bench.db')),
+            tmpdir=tmpdir))
+    app = create_app(cfg_path)
+    # debug logging to stderr would dominate the timings
+    app.logger.setLevel(logging.WARNING)
+    return app
+
+
+def seed(num_posts, mentions_per_post=10, num_tags=50, num_contexts=200,
+         num_contacts=20):
+    """Create settings, an admin user, contacts and num_posts posts.
+    Every third post is a reply to one of num_contexts urls, every post
+    has up to three tags, and about a third have an inline image.
+    Call inside an app context, with empty tables.
+    """
+    rand = random.Random(1234)
+    for key, value in SETTINGS.items():
+        s = Setting()
+        s.key = key
+        s.value = value
+        db.session.add(s)
+
+    user = User()
+    user.name = 'example.com'
+    user.admin = True
+    cred = Credential()
+    cred.type = 'indieauth'
+    cred.value = ME
+    cred.user = user
+    db.session.add_all([user, cred])
+
+    for ii in range(num_contacts):
+        contact = Contact(name='Person {}'.format(ii),
+                          url='http://person{}.example.org/'.format(ii),
+                          image='http://person{}.example.org/me.jpg'
+                          .format(ii))
+        contact.nicks = [Nick('person{}'.format(ii))]
+        db.session.add(contact)
+
+    tags = [Tag('tag{}'.format(ii)) for ii in range(num_tags)]
+    contexts = []
+    for ii in range(num_contexts):
+        context = Context()
+        context.url = context.permalink = \
+            'http://example.org/cited/{}'.format(ii)
+        context.author_name = 'Someone {}'.format(ii % 10)
+        context.author_url = 'http://someone{}.example.org/'.format(ii % 10)
+        context.content = 'Something worth replying to'
+        context.update_display_html()
+        contexts.append(context)
+
+    now = datetime.datetime.utcnow()
+    for ii in range(num_posts):
+        post = Post('reply' if ii % 3 == 1 else 'note')
+        post.published = post.updated = now - datetime.timedelta(hours=ii)
+        post.path = '{}/{:02d}/bench-{}'.format(
+            post.published.year, post.published.month, ii)
+        post.slug = 'bench-{}'.format(ii)
+        post.short_path = 'n/bench{}'.format(ii)
+        post.friends_only = False
+        post.tags = rand.sample(tags, min(3, len(tags)))
+        if post.post_type == 'reply' and contexts:
+            context = contexts[ii % len(contexts)]
+            post.in_reply_to = [context.url]
+            post.reply_contexts = [context]
+        if ii % 3:
+            post.content = 'A plain note, hi @person{} #{}'.format(
+                ii % num_contacts if num_contacts else 0, ii)
+            post.content_html = '<p>{}</p>'.format(post.content)
+        else:
+            post.content = 'A note with a picture #{}'.format(ii)
+            post.content_html = (
+                '<p>{}</p><img src="http://images.example.org/{}.jpg">'
+                .format(post.content, ii))
+        post.update_display_html()
+
+        for jj in range(mentions_per_post):
+            mention = Mention()
+            mention.url = 'http://example.org/reply/{}/{}'.format(ii, jj)
+            mention.permalink = mention.url
+            mention.reftype = 'reply' if jj % 2 else 'like'
+            mention.author_name = 'Person {}'.format(jj)
+            mention.author_url = 'http://person{}.example.org/'.format(jj)
+            # the same few people show up everywhere
+            mention.author_image = 'http://person{}.example.org/me.jpg'\
+                .format(jj % 10)
+            mention.content = 'Nice!'
+            mention.published = post.published
+            mention.update_display_html()
+            post.mentions.append(mention)
+        db.session.add(post)
+        if ii % 500 == 499:
+            db.session.commit()
+    db.session.commit()
+
+
+def access_token():
+    """A micropub access token for the seeded user"""
+    token = util.jwt_encode({'me': ME, 'client_id': 'benchmark',
+                             'scope': 'post'})
+    return token.decode() if isinstance(token, bytes) else token
@@ -0,0 +1,182 @@
+"""Benchmark app startup: the time to import redwind and call create_app,
+as paid by every uWSGI worker and every queued job.
+
+Runs a fresh interpreter a few times, with -X importtime where the
+interpreter has it (3.7+) and a timing import hook otherwise, keeps the
+fastest run, and prints the total along with the modules that took
+longest to import, including everything they imported, and the
+packages with the most import time of their own.
+
+    python benchmarks/startup.py --top 15
+    python benchmarks/startup.py --plugins wm_receiver,wm_sender
+"""
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+CONFIG = """\
+SECRET_KEY = 'benchmark'
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmpdir}/bench.db'
+REDIS_URL = 'redis://localhost:911'
+"""
+
+# -X importtime does not see importlib.import_module, which loads the
+# plugins, so time those calls here
+STARTUP = """\
+import importlib, json, sys, time
+plugins = {}
+import_module = importlib.import_module
+def timed_import(name, *args):
+    before = time.perf_counter()
+    try:
+        return import_module(name, *args)
+    finally:
+        plugins[name] = 1e6 * (time.perf_counter() - before)
+importlib.import_module = timed_import
+start = time.perf_counter()
+from redwind import create_app
+create_app(sys.argv[1], is_queue='--queue' in sys.argv)
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'plugins': plugins}))
+"""
+
+# Before 3.7 there is no -X importtime, so time each module's execution
+# from a meta path finder and write it to stderr in the same format
+IMPORT_TIMER = """\
+import sys, time
+class TimedLoader:
+    def __init__(self, loader, stack):
+        self.loader = loader
+        self.stack = stack
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+    def exec_module(self, module):
+        module.__loader__ = module.__spec__.loader = self.loader
+        self.stack.append(0)
+        before = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            cumulative = int(1e6 * (time.perf_counter() - before))
+            self_us = cumulative - self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            sys.stderr.write('import time: {:>9} | {:>10} | {}{}\\n'.format(
+                self_us, cumulative, '  ' * len(self.stack), module.__name__))
+class ImportTimer:
+    stack = []
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self:
+                continue
+            if not hasattr(finder, 'find_spec'):
+                return None
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self.stack)
+                return spec
+        return None
+sys.meta_path.insert(0, ImportTimer())
+"""
+
+
+def measure(cfg_path, queue):
+    """Start the app once and return (seconds, [(module, self_us,
+    cumulative_us, depth)], {plugin module: cumulative_us})
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [env.get('PYTHONPATH'), root]))
+    if sys.version_info >= (3, 7):
+        cmd = [sys.executable, '-X', 'importtime', '-c', STARTUP]
+    else:
+        cmd = [sys.executable, '-c', IMPORT_TIMER + STARTUP]
+    cmd += [cfg_path] + (['--queue'] if queue else [])
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env,
+                            universal_newlines=True)
+    stdout, stderr = proc.communicate()
+    if proc.returncode:
+        sys.stderr.write(stderr)
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us),
+                        depth))
+    result = json.loads(stdout.splitlines()[-1])
+    return result['seconds'], imports, result['plugins']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--plugins',
+                        help='comma-separated PLUGINS to enable, instead '
+                        'of the default set')
+    parser.add_argument('--queue', action='store_true',
+                        help='start the app as a queued job does')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cfg_path = os.path.join(tmpdir, 'redwind.cfg')
+        with open(cfg_path, 'w') as f:
+            f.write(CONFIG.format(tmpdir=tmpdir))
+            if args.plugins is not None:
+                f.write('PLUGINS = {!r}\n'.format(
+                    [p for p in args.plugins.split(',') if p]))
+        seconds, imports, plugins = min(
+            (measure(cfg_path, args.queue) for _ in range(args.repeat)),
+            key=lambda run: run[0])
+    finally:
+        shutil.rmtree(tmpdir)
+
+    redwind_imports = [imp for imp in imports
+                       if imp[0].split('.')[0] == 'redwind']
+    # the import hook also sees the plugins, -X importtime does not
+    seen = {imp[0] for imp in redwind_imports}
+    redwind_imports += [(name, None, cumulative, None)
+                        for name, cumulative in plugins.items()
+                        if name not in seen]
+    print('startup: {:.0f}ms, {} modules imported'.format(
+        1000 * seconds, len(imports)))
+
+    print('\nslowest redwind modules, including their imports (ms):')
+    for name, _, cumulative, _ in sorted(
+            redwind_imports, key=lambda imp: -imp[2])[:args.top]:
+        print('{:>9.1f}  {}'.format(cumulative / 1000, name))
+
+    packages = collections.Counter()
+    for name, self_us, _, _ in imports:
+        packages[name.split('.')[0]] += self_us
+    print('\npackages by their own import time (ms):')
+    for name, self_us in packages.most_common(args.top):
+        print('{:>9.1f}  {}'.format(self_us / 1000, name))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'seconds': seconds,
+                'modules': {name: {'self_us': self_us,
+                                   'cumulative_us': cumulative}
+                            for name, self_us, cumulative, _ in imports},
+                'plugins': plugins,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
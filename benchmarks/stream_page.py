@@ -0,0 +1,55 @@
+"""Benchmark rendering of the home stream page.
+
+Seeds a throwaway sqlite database (see seed.py) with notes that carry
+mentions, avatars and inline images, then times repeated requests for
+/. Prints the mean time per request and hit rate of the memoized
+imageproxy signing layer. run.py covers the other views.
+
+    python benchmarks/stream_page.py --posts 50 --requests 200
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed import create_bench_app, seed
+from redwind import imageproxy
+from redwind.extensions import db
+import argparse
+import shutil
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--mentions', type=int, default=10,
+                        help='mentions per post')
+    parser.add_argument('--requests', type=int, default=100)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        app = create_bench_app(tmpdir)
+        with app.app_context():
+            db.create_all()
+            seed(args.posts, args.mentions)
+
+        client = app.test_client()
+        # warm up templates and caches
+        client.get('/')
+
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            rv = client.get('/')
+            assert rv.status_code == 200, rv.status_code
+        elapsed = time.perf_counter() - start
+
+        print('{} requests in {:.2f}s: {:.2f}ms/request'.format(
+            args.requests, elapsed, 1000 * elapsed / args.requests))
+        print('imageproxy url cache:', imageproxy._construct_url.cache_info())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
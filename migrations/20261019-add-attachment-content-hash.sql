@@ -0,0 +1 @@
+alter table attachment add column content_hash varchar(64);
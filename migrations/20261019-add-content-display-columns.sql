@@ -0,0 +1,3 @@
+alter table post add column content_display text;
+alter table context add column content_display text;
+alter table mention add column content_display text;
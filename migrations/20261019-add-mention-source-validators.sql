@@ -0,0 +1,3 @@
+alter table mention add column source_etag varchar(512);
+alter table mention add column source_last_modified varchar(64);
+alter table mention add column source_hash varchar(64);
@@ -0,0 +1 @@
+alter table post add column publish_status text;
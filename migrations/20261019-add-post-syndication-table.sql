@@ -0,0 +1,7 @@
+create table post_syndication (
+    id serial primary key,
+    post_id integer references post(id),
+    url varchar(512)
+);
+create index ix_post_syndication_post_id on post_syndication (post_id);
+create index ix_post_syndication_url on post_syndication (url);
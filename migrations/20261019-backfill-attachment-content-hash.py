@@ -0,0 +1,14 @@
+from redwind import create_app
+from redwind import util
+from redwind.models import Attachment
+from redwind.extensions import db
+import os
+
+app = create_app()
+with app.app_context():
+    for attachment in Attachment.query.filter(
+            Attachment.content_hash == None):  # noqa
+        if os.path.exists(attachment.disk_path):
+            attachment.content_hash = util.hash_file(attachment.disk_path)
+            print(attachment.storage_path, attachment.content_hash)
+    db.session.commit()
@@ -0,0 +1,11 @@
+from redwind import create_app
+from redwind.models import Post
+from redwind.extensions import db
+
+app = create_app()
+with app.app_context():
+    for post in Post.query:
+        # reassigning syndication fills in post.syndications
+        post.syndication = list(post.syndication or [])
+        print(post.path, post.syndications)
+    db.session.commit()
@@ -0,0 +1,46 @@
+"""Move every attachment under UPLOAD_PATH into content-addressed
+storage, keeping a single copy of files that were stored more than
+once. Run after 20261019-content-addressed-attachments.sql.
+"""
+from redwind import create_app
+from redwind import storage
+from redwind import util
+from redwind.models import Attachment
+from redwind.extensions import db
+from flask import current_app
+import os
+
+app = create_app()
+with app.app_context():
+    root = current_app.config['UPLOAD_PATH']
+    moved = duplicates = missing = 0
+    for attachment in Attachment.query.order_by(Attachment.id):
+        if not attachment.storage_path:
+            continue
+        if storage.is_blob_path(attachment.storage_path):
+            continue
+        old_path = attachment.disk_path
+        if not os.path.exists(old_path):
+            print('missing', old_path)
+            missing += 1
+            continue
+
+        content_hash = util.hash_file(old_path)
+        if os.path.exists(os.path.join(root, storage.blob_path(content_hash))):
+            duplicates += 1
+        else:
+            moved += 1
+        attachment.storage_path, attachment.content_hash = \
+            storage.move_into_place(old_path, content_hash)
+        print(old_path, '->', attachment.storage_path)
+        # commit as we go so a crash never leaves rows pointing at
+        # files that have already been moved
+        db.session.commit()
+
+    # clean up the empty YYYY/MM/DD directories left behind
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        if dirpath != root and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+    print('moved {}, removed {} duplicates, {} missing'.format(
+        moved, duplicates, missing))
@@ -0,0 +1 @@
+create index ix_attachment_storage_path on attachment (storage_path);
@@ -0,0 +1 @@
+create index ix_context_url on context (url);
@@ -0,0 +1,3 @@
+create index ix_post_path on post (path);
+create index ix_post_historic_path on post (historic_path);
+create index ix_post_short_path on post (short_path);
@@ -16,16 +16,36 @@ Message:
 %(message)s
 '''
 
+DEFAULT_PLUGINS = [
+    'facebook',
+    'instagram',
+    'locations',
+    'push',
+    'twitter',
+    'wm_receiver',
+    'wm_sender',
+    'wordpress',
+    'posse',
+    'static_site',
+]
+
 
 def create_app(config_file='../redwind.cfg', is_queue=False):
     from redwind import extensions
+    from redwind import metrics
+    from redwind import pipeline
+    from redwind import profiler
+    from redwind import sqlstats
     from redwind.views import views
     from redwind.admin import admin
     from redwind.services import services
     from redwind.micropub import micropub
+    from redwind.ingest import ingest
     from redwind.imageproxy import imageproxy
+    from redwind.storage import UploadRequest
 
     app = Flask(__name__)
+    app.request_class = UploadRequest
     app.config.from_pyfile(config_file)
     app.config['CONFIG_FILE'] = config_file
 
@@ -36,6 +56,10 @@ def create_app(config_file='../redwind.cfg', is_queue=False):
     app.jinja_env.add_extension('jinja2.ext.i18n')
 
     extensions.init_app(app)
+    sqlstats.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    pipeline.init_app(app)
 
     if app.config.get('PROFILE'):
         from werkzeug.contrib.profiler import ProfilerMiddleware
@@ -69,19 +93,13 @@ def create_app(config_file='../redwind.cfg', is_queue=False):
     app.register_blueprint(admin)
     app.register_blueprint(services)
     app.register_blueprint(micropub)
+    app.register_blueprint(ingest)
     app.register_blueprint(imageproxy)
 
-    for plugin in [
-            'facebook',
-            'instagram',
-            'locations',
-            'push',
-            'twitter',
-            'wm_receiver',
-            'wm_sender',
-            'wordpress',
-            'posse',
-    ]:
+    # only enabled plugins are imported, so leaving out e.g. twitter
+    # and facebook saves every worker and queued job loading them
+    app.config.setdefault('PLUGINS', DEFAULT_PLUGINS)
+    for plugin in app.config['PLUGINS']:
         # app.logger.info('loading plugin module %s', plugin)
         module = importlib.import_module('redwind.plugins.' + plugin)
         try:
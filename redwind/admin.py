@@ -1,34 +1,24 @@
 from flask import Blueprint, render_template, request, current_app, abort
 from flask import flash, redirect, url_for, session, make_response
-from redwind import contexts
+from flask import Response, stream_with_context
+from redwind import exporter
 from redwind import hooks
 from redwind import maps
+from redwind import posts
 from redwind import util
 from redwind.extensions import db
-from redwind.models import Post, Attachment, Tag, Contact, Mention, Nick
+from redwind.models import Post, Tag, Contact, Mention, Nick
 from redwind.models import Venue, Setting, User, Credential, get_settings
-from requests_oauthlib import OAuth1Session
-from werkzeug import secure_filename
-import bs4
+from sqlalchemy.orm import subqueryload
 import collections
 import datetime
 import flask.ext.login as flask_login
-import hashlib
-import itertools
 import json
-import mf2py
 import mf2util
-import mimetypes
 import operator
-import os
-import os.path
-import random
 import requests
-import shutil
-import string
 import urllib
 import urllib.parse
-import urllib.request
 
 admin = Blueprint('admin', __name__)
 
@@ -46,7 +36,7 @@ def get_tags():
 
 def get_contact_nicks():
     return [n.name
-            for c in Contact.query.all()
+            for c in Contact.query.options(subqueryload(Contact.nicks))
             for n in c.nicks]
 
 
@@ -136,7 +126,10 @@ def edit_by_id():
     id = request.args.get('id')
     if not id:
         abort(404)
-    post = Post.load_by_id(id)
+    # the form lists each tagged person's nick
+    post = Post.query.options(
+        subqueryload(Post.people).subqueryload(Contact.nicks)
+    ).filter_by(id=id).first()
     if not post:
         abort(404)
     type = 'post'
@@ -193,243 +186,13 @@ def save_new():
 
 
 def save_post(post):
-    was_draft = post.draft
-    pub_str = request.form.get('published')
-    if pub_str:
-        post.published = mf2util.parse_dt(pub_str)
-        if post.published.tzinfo:
-            post.published = post.published.astimezone(datetime.timezone.utc)\
-                                           .replace(tzinfo=None)
-
-    if 'post_type' in request.form:
-        post.post_type = request.form.get('post_type')
-
-    start_str = request.form.get('start')
-    if start_str:
-        start = mf2util.parse_dt(start_str)
-        if start:
-            post.start = start
-            post.start_utcoffset = start.utcoffset()
-
-    end_str = request.form.get('end')
-    if end_str:
-        end = mf2util.parse_dt(end_str)
-        if end:
-            post.end = end
-            post.end_utcoffset = end.utcoffset()
-
-    now = datetime.datetime.utcnow()
-    if not post.published or was_draft:
-        post.published = now
-    post.updated = now
-
-    # populate the Post object and save it to the database,
-    # redirect to the view
-    post.title = request.form.get('title', '')
-    post.content = request.form.get('content')
-    post.draft = request.form.get('action') == 'save_draft'
-    post.hidden = request.form.get('hidden', 'false') == 'true'
-    post.friends_only = request.form.get('friends_only', 'false') == 'true'
-
-    venue_name = request.form.get('new_venue_name')
-    venue_lat = request.form.get('new_venue_latitude')
-    venue_lng = request.form.get('new_venue_longitude')
-    if venue_name and venue_lat and venue_lng:
-        venue = Venue()
-        venue.name = venue_name
-        venue.location = {
-            'latitude': float(venue_lat),
-            'longitude': float(venue_lng),
-        }
-        venue.update_slug('{}-{}'.format(venue_lat, venue_lng))
-        db.session.add(venue)
-        db.session.commit()
-        hooks.fire('venue-saved', venue, request.form)
-        post.venue = venue
-
-    else:
-        venue_id = request.form.get('venue')
-        if venue_id:
-            post.venue = Venue.query.get(venue_id)
-
-    lat = request.form.get('latitude')
-    lon = request.form.get('longitude')
-    if lat and lon:
-        if post.location is None:
-            post.location = {}
-
-        post.location['latitude'] = float(lat)
-        post.location['longitude'] = float(lon)
-        loc_name = request.form.get('location_name')
-        if loc_name is not None:
-            post.location['name'] = loc_name
-    else:
-        post.location = None
-
-    for url_attr, context_attr in (('in_reply_to', 'reply_contexts'),
-                                   ('repost_of', 'repost_contexts'),
-                                   ('like_of', 'like_contexts'),
-                                   ('bookmark_of', 'bookmark_contexts')):
-        url_str = request.form.get(url_attr)
-        if url_str is not None:
-            urls = util.multiline_string_to_list(url_str)
-            setattr(post, url_attr, urls)
-
-    # fetch contexts before generating a slug
-    contexts.fetch_contexts(post)
-
-    if 'item-name' in request.form:
-        post.item = util.trim_nulls({
-            'name': request.form.get('item-name'),
-            'author': request.form.get('item-author'),
-            'photo': request.form.get('item-photo'),
-        })
-    if 'rating' in request.form:
-        rating = request.form.get('rating')
-        post.rating = int(rating) if rating else None
-
-    syndication = request.form.get('syndication')
-    if syndication is not None:
-        post.syndication = util.multiline_string_to_list(syndication)
-
-    audience = request.form.get('audience')
-    if audience is not None:
-        post.audience = util.multiline_string_to_list(audience)
-
-    tags = request.form.getlist('tags')
-    if post.post_type != 'article' and post.content:
-        # parse out hashtags as tag links from note-like posts
-        tags += util.find_hashtags(post.content)
-    tags = list(filter(None, map(util.normalize_tag, tags)))
-    post.tags = [Tag.query.filter_by(name=tag).first() or Tag(tag)
-                 for tag in tags]
-
-    post.people = []
-    people = request.form.getlist('people')
-    for person in people:
-        nick = Nick.query.filter_by(name=person).first()
-        if nick:
-            post.people.append(nick.contact)
-
-    slug = request.form.get('slug')
-    if slug:
-        post.slug = util.slugify(slug)
-    elif not post.slug or was_draft:
-        post.slug = post.generate_slug()
-
-    # events should use their start date for permalinks
-    path_date = post.start or post.published
-
-    if post.draft:
-        m = hashlib.md5()
-        m.update(bytes(path_date.isoformat() + '|' + post.slug,
-                       'utf-8'))
-        post.path = 'drafts/{}'.format(m.hexdigest())
-
-    elif not post.path or was_draft:
-        base_path = '{}/{:02d}/{}'.format(
-            path_date.year, path_date.month, post.slug)
-        # generate a unique path
-        unique_path = base_path
-        idx = 1
-        while Post.load_by_path(unique_path):
-            unique_path = '{}-{}'.format(base_path, idx)
-            idx += 1
-        post.path = unique_path
-
-    # generate short path
-    if not post.short_path:
-        short_base = '{}/{}'.format(
-            util.tag_for_post_type(post.post_type),
-            util.base60_encode(util.date_to_ordinal(path_date)))
-        short_paths = set(
-            row[0] for row in db.session.query(Post.short_path).filter(
-                Post.short_path.startswith(short_base)).all())
-        for idx in itertools.count(1):
-            post.short_path = short_base + util.base60_encode(idx)
-            if post.short_path not in short_paths:
-                break
-
-    infiles = request.files.getlist('files') + request.files.getlist('photo')
-    current_app.logger.debug('infiles: %s', infiles)
-    for infile in infiles:
-        if infile and infile.filename:
-            current_app.logger.debug('receiving uploaded file %s', infile)
-            attachment = create_attachment_from_file(post, infile)
-            os.makedirs(os.path.dirname(attachment.disk_path), exist_ok=True)
-            infile.save(attachment.disk_path)
-            post.attachments.append(attachment)
-
-    photo_url = request.form.get('photo')
-    if photo_url:
-        current_app.logger.debug('downloading photo from url %s', photo_url)
-        temp_filename, headers = urllib.request.urlretrieve(photo_url)
-        content_type = headers.get('content-type', '')
-        mimetype = content_type and content_type.split(';')[0].strip()
-        filename = os.path.basename(urllib.parse.urlparse(photo_url).path)
-        attachment = create_attachment(post, filename, mimetype)
-        os.makedirs(os.path.dirname(attachment.disk_path), exist_ok=True)
-        shutil.copyfile(temp_filename, attachment.disk_path)
-        urllib.request.urlcleanup()
-        post.attachments.append(attachment)
-
-    # pre-render the post html
-    html = util.markdown_filter(post.content, img_path=post.get_image_path())
-    html = util.autolink(html)
-    if post.post_type == 'article':
-        html = util.process_people_to_microcards(html)
-    else:
-        html = util.process_people_to_at_names(html)
-    post.content_html = html
-
-    if not post.id:
-        db.session.add(post)
-    db.session.commit()
-
-    current_app.logger.debug('saved post %d %s', post.id, post.permalink)
-    redirect_url = post.permalink
-
-    hooks.fire('post-saved', post, request.form)
-    return redirect(redirect_url)
-
-
-def create_attachment_from_file(post, f, default_ext=None):
-    return create_attachment(post, f.filename, f.mimetype, default_ext)
-
-
-def create_attachment(post, filename, mimetype=None, default_ext=None):
-    filename = secure_filename(filename)
-    basename, ext = os.path.splitext(filename)
-    if not mimetype:
-        mimetype, _ = mimetypes.guess_type(filename)
-
-    # special handling for ugly filenames from OwnYourGram
-    if basename.startswith('tmp_') and ext.lower() in ('.png', '.jpg'):
-        basename = 'photo'
-
-    unique_filename = ''.join(
-        random.choice(string.ascii_letters + string.digits)
-        for _ in range(8)) + '-' + filename
-    now = datetime.datetime.now()
-    storage_path = '{}/{:02d}/{:02d}/{}'.format(
-        now.year, now.month, now.day, unique_filename)
-
-    idx = 0
-    while True:
-        if idx == 0:
-            filename = '{}{}'.format(basename, ext)
-        else:
-            filename = '{}-{}{}'.format(basename, idx, ext)
-        if filename not in [a.filename for a in post.attachments]:
-            break
-        idx += 1
-
-    return Attachment(filename=filename,
-                      mimetype=mimetype,
-                      storage_path=storage_path)
+    data = posts.PostInput.from_form(request.form, request.files)
+    post = posts.save_post(post, data)
+    return redirect(post.permalink)
 
 
 def discover_endpoints(me):
+    import bs4
     me_response = requests.get(me)
     if me_response.status_code != 200:
         return make_response(
@@ -446,6 +209,7 @@ def discover_endpoints(me):
 
 @admin.route('/login_twitter')
 def login_twitter():
+    from requests_oauthlib import OAuth1Session
     callback_url = url_for('.login_twitter', _external=True)
     try:
         oauth_session = OAuth1Session(
@@ -560,6 +324,7 @@ def login():
 
 @admin.route('/login_callback')
 def login_callback():
+    import mf2py
     current_app.logger.debug('callback fields: %s', request.args)
 
     state = request.args.get('state')
@@ -750,6 +515,34 @@ def edit_settings():
     return redirect(url_for('.edit_settings'))
 
 
+@admin.route('/export')
+@flask_login.login_required
+def export():
+    """Download a backup of the site. format is ndjson (the default) or
+    json; since (an ISO 8601 datetime) limits it to posts updated since.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'json'):
+        abort(400)
+    since = request.args.get('since')
+    if since:
+        since = posts.parse_utc(since)
+        if not since:
+            abort(400)
+
+    if fmt == 'json':
+        chunks = exporter.iter_json(since)
+        mimetype = 'application/json'
+    else:
+        chunks = exporter.iter_ndjson(since)
+        mimetype = 'application/x-ndjson'
+    filename = 'redwind-{}.{}'.format(
+        datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'), fmt)
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=' + filename,
+    })
+
+
 @admin.route('/delete')
 @flask_login.login_required
 def delete_by_id():
@@ -2,9 +2,9 @@ from . import hooks
 from . import util
 from .extensions import db
 from .models import Context
+from .models import posts_to_reply_contexts, posts_to_repost_contexts
+from .models import posts_to_like_contexts, posts_to_bookmark_contexts
 
-import bs4
-import mf2py
 import mf2util
 
 from flask import current_app
@@ -23,20 +23,37 @@ def do_fetch_context(post, context_attr, urls):
     new_contexts = [create_context(url) for url in urls]
 
     for old in old_contexts:
-        if old not in new_contexts:
+        if old not in new_contexts and not in_use(old, post):
             db.session.delete(old)
 
     for new_context in new_contexts:
+        new_context.update_display_html()
         db.session.add(new_context)
 
     setattr(post, context_attr, new_contexts)
     db.session.commit()
 
 
+def in_use(context, post):
+    """Check whether posts other than post refer to context; contexts
+    are shared between posts that cite the same url.
+    """
+    if not context.id:
+        return False
+    for table in (posts_to_reply_contexts, posts_to_repost_contexts,
+                  posts_to_like_contexts, posts_to_bookmark_contexts):
+        if db.session.query(table).filter(
+                table.c.context_id == context.id,
+                table.c.post_id != post.id).first():
+            return True
+    return False
+
+
 def extract_ogp_context(context, doc, url):
     """ Gets Open Graph Protocol data from the given document
         See http://indiewebcamp.com/The-Open-Graph-protocol
     """
+    import bs4
     soup = bs4.BeautifulSoup(doc)
 
     # extract ogp data
@@ -72,6 +89,7 @@ def extract_ogp_context(context, doc, url):
 def extract_mf2_context(context, doc, url):
     """ Gets Microformats2 data from the given document
     """
+    import mf2py
     cached_mf2 = {}
 
     # used by authorship algorithm
@@ -123,6 +141,7 @@ def extract_mf2_context(context, doc, url):
 def extract_default_context(context, response, url):
     """ Gets default information if not all info is retrieved
     """
+    import bs4
     context = Context() if not context else context
 
     if not context.url or not context.permalink:
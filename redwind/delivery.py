@@ -0,0 +1,128 @@
+"""Serve files stored on disk (attachments, proxied images).
+
+The backend is chosen by the FILE_DELIVERY config value:
+
+ - 'x-accel-redirect': hand the file off to nginx via an internal
+   location (the default outside of debug mode)
+ - 'x-sendfile': hand the file off to Apache/lighttpd/uWSGI via the
+   X-Sendfile header
+ - 'direct': stream the file from Python, using the server's
+   wsgi.file_wrapper when it has one, with support for single byte
+   ranges (the default in debug mode)
+"""
+from flask import current_app, request
+from werkzeug.http import is_resource_modified, quote_etag
+from werkzeug.wsgi import wrap_file
+import datetime
+import os
+
+BACKENDS = ('x-accel-redirect', 'x-sendfile', 'direct')
+DEFAULT_MAX_AGE = 365 * 24 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+
+
+def get_backend():
+    backend = current_app.config.get('FILE_DELIVERY')
+    if not backend:
+        backend = 'direct' if current_app.debug else 'x-accel-redirect'
+    if backend not in BACKENDS:
+        raise ValueError('unknown FILE_DELIVERY backend: ' + backend)
+    return backend
+
+
+def send_file(path, mimetype, internal_url=None, etag=None, max_age=None,
+              private=False):
+    """Build a response for the file at path.
+
+    :param internal_url: the nginx internal location for this file,
+      required by the x-accel-redirect backend
+    :param etag: a strong validator for the file contents, e.g. a
+      hash; defaults to one derived from the file's size and mtime
+    :param max_age: seconds clients may cache the file for
+    :param private: true if shared caches must not store the file
+    """
+    stat = os.stat(path)
+    mtime = datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+    if not etag:
+        etag = '{}-{}'.format(int(stat.st_mtime), stat.st_size)
+    if max_age is None:
+        max_age = current_app.config.get('FILE_MAX_AGE', DEFAULT_MAX_AGE)
+
+    resp = current_app.response_class(mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.last_modified = mtime
+    resp.cache_control.max_age = max_age
+    if private:
+        resp.cache_control.private = True
+    else:
+        resp.cache_control.public = True
+    resp.expires = (datetime.datetime.utcnow()
+                    + datetime.timedelta(seconds=max_age))
+
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=mtime):
+        resp.status_code = 304
+        return resp
+
+    backend = get_backend()
+    if backend == 'x-accel-redirect':
+        resp.headers['X-Accel-Redirect'] = internal_url
+        del resp.headers['Content-Length']
+    elif backend == 'x-sendfile':
+        resp.headers['X-Sendfile'] = os.path.abspath(path)
+        del resp.headers['Content-Length']
+    else:
+        send_direct(resp, path, stat.st_size, etag)
+    return resp
+
+
+def send_direct(resp, path, size, etag):
+    resp.headers['Accept-Ranges'] = 'bytes'
+    byte_range = requested_range(size, etag)
+    if byte_range == 'unsatisfiable':
+        resp.status_code = 416
+        resp.headers['Content-Range'] = 'bytes */{}'.format(size)
+        return
+
+    f = open(path, 'rb')
+    if byte_range:
+        start, stop = byte_range
+        f.seek(start)
+        resp.response = iter_file_range(f, stop - start)
+        resp.status_code = 206
+        resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, stop - 1, size)
+        resp.content_length = stop - start
+    else:
+        resp.response = wrap_file(request.environ, f, CHUNK_SIZE)
+        resp.content_length = size
+    resp.direct_passthrough = True
+
+
+def requested_range(size, etag):
+    """Return the (start, stop) byte range requested by the client,
+    None to send the whole file, or 'unsatisfiable'.
+    """
+    byte_range = request.range
+    if not byte_range or byte_range.units != 'bytes':
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != quote_etag(etag):
+        # the client's copy is out of date, send the whole thing
+        return None
+    if len(byte_range.ranges) != 1:
+        # multipart/byteranges isn't worth supporting for media
+        return None
+    return byte_range.range_for_length(size) or 'unsatisfiable'
+
+
+def iter_file_range(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
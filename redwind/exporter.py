@@ -1,14 +1,108 @@
+"""Export the whole site as JSON.
+
+export_all builds the entire export in memory; iter_json and
+iter_ndjson produce the same records a chunk at a time, loading posts
+in id-ordered batches with their relationships, so memory use does not
+grow with the size of the archive.
+
+NDJSON exports have one record per line, e.g.
+{"type": "post", "data": {...}}, with settings, venues and contacts
+first. The JSON export is the object export_all returns.
+"""
+from .extensions import db
 from .models import Setting, Post, Contact, Venue
 import datetime
+import json
+import sqlalchemy
+
+BATCH_SIZE = 200
 
 
 def export_all():
-    return {
-        'settings': [export_setting(s) for s in Setting.query.all()],
-        'venues': [export_venue(v) for v in Venue.query.all()],
-        'contacts': [export_contact(c) for c in Contact.query.all()],
-        'posts': [export_post(p) for p in Post.query.all()],
-        }
+    return {key: list(records) for key, _, records in iter_sections()}
+
+
+def iter_posts(since=None, batch_size=BATCH_SIZE):
+    """Yield posts in id order, batch_size at a time, with everything
+    export_post needs loaded up front.
+
+    :param since: only posts updated at or after this datetime. Note
+      that receiving a mention does not change a post's updated time.
+    """
+    query = Post.query.options(
+        sqlalchemy.orm.joinedload(Post.venue),
+        sqlalchemy.orm.subqueryload(Post.tags),
+        sqlalchemy.orm.subqueryload(Post.people),
+        sqlalchemy.orm.subqueryload(Post.mentions),
+        sqlalchemy.orm.subqueryload(Post.attachments),
+        sqlalchemy.orm.subqueryload(Post.reply_contexts),
+        sqlalchemy.orm.subqueryload(Post.repost_contexts),
+        sqlalchemy.orm.subqueryload(Post.like_contexts),
+        sqlalchemy.orm.subqueryload(Post.bookmark_contexts))
+    if since:
+        query = query.filter(Post.updated >= since)
+
+    last_id = 0
+    while True:
+        batch = query.filter(Post.id > last_id)\
+                     .order_by(Post.id)\
+                     .limit(batch_size).all()
+        if not batch:
+            break
+        yield from batch
+        last_id = batch[-1].id
+        # let the batch (and what it loaded) be garbage collected
+        for post in batch:
+            db.session.expunge(post)
+
+
+def iter_sections(since=None):
+    """The (export key, record type, records) for each kind of object.
+    Settings, venues and contacts are always exported in full.
+    """
+    contacts = Contact.query.options(
+        sqlalchemy.orm.subqueryload(Contact.nicks)).order_by(Contact.id)
+    return [
+        ('settings', 'setting',
+         (export_setting(s) for s in Setting.query.order_by(Setting.key))),
+        ('venues', 'venue',
+         (export_venue(v) for v in Venue.query.order_by(Venue.id))),
+        ('contacts', 'contact', (export_contact(c) for c in contacts)),
+        ('posts', 'post', (export_post(p) for p in iter_posts(since))),
+    ]
+
+
+def iter_records(since=None):
+    """Yield a (record type, record) pair for everything in the export"""
+    for _, rectype, records in iter_sections(since):
+        for record in records:
+            yield rectype, record
+
+
+def iter_ndjson(since=None):
+    for rectype, record in iter_records(since):
+        yield json.dumps({'type': rectype, 'data': record}) + '\n'
+
+
+def iter_json(since=None):
+    """Stream the object export_all returns, a record at a time"""
+    yield '{'
+    for ii, (key, _, records) in enumerate(iter_sections(since)):
+        yield '{}{}: ['.format(',\n' if ii else '', json.dumps(key))
+        sep = '\n'
+        for record in records:
+            yield sep + json.dumps(record)
+            sep = ',\n'
+        yield ']'
+    yield '}\n'
+
+
+def export_to_file(f, fmt='ndjson', since=None):
+    """Write an export to the text file f. fmt is 'ndjson' or 'json'"""
+    chunks = iter_ndjson(since) if fmt == 'ndjson' else iter_json(since)
+    for chunk in chunks:
+        f.write(chunk)
+
 
 def export_datetime(dt):
     if dt:
@@ -17,6 +111,12 @@ def export_datetime(dt):
             dt = dt.replace(tzinfo=None)
         return dt.strftime('%Y-%m-%dT%H:%M:%S')
 
+
+def export_timedelta(td):
+    if td is not None:
+        return td.total_seconds()
+
+
 def export_setting(s):
     return { 
         'key': s.key,
@@ -53,7 +153,8 @@ def export_post(p):
         'hidden': p.hidden, 
         'redirect': p.redirect, 
         'tags': [t.name for t in p.tags], 
-        'audience': p.audience, 
+        'people': [c.name for c in p.people],
+        'friends_only': p.friends_only,
         'in_reply_to': p.in_reply_to, 
         'repost_of': p.repost_of, 
         'like_of': p.like_of, 
@@ -64,10 +165,18 @@ def export_post(p):
         'bookmark_contexts': [export_context(c) for c in p.bookmark_contexts], 
         'title': p.title, 
         'published': export_datetime(p.published), 
+        'updated': export_datetime(p.updated),
+        'start_utc': export_datetime(p.start_utc),
+        'start_utcoffset': export_timedelta(p.start_utcoffset),
+        'end_utc': export_datetime(p.end_utc),
+        'end_utcoffset': export_timedelta(p.end_utcoffset),
+        'short_path': p.short_path,
         'slug': p.slug, 
         'syndication': p.syndication, 
         'location': p.location, 
-        'photos': p.photos, 
+        'attachments': [export_attachment(a) for a in p.attachments],
+        'item': p.item,
+        'rating': p.rating,
         'venue': p.venue.slug if p.venue else None, 
         'mentions': [export_mention(m) for m in p.mentions], 
         'content': p.content, 
@@ -75,6 +184,15 @@ def export_post(p):
         }
 
 
+def export_attachment(a):
+    return {
+        'filename': a.filename,
+        'mimetype': a.mimetype,
+        'storage_path': a.storage_path,
+        'content_hash': a.content_hash,
+        }
+
+
 def export_context(c):
     return {
         'url': c.url, 
@@ -1,14 +1,152 @@
+"""Plugins register actions for named hooks, which the rest of redwind
+fires at points like saving a post or receiving a mention.
 
+Each action runs on its own: an exception is logged and the remaining
+actions still run, and an action with a timeout (or HOOK_TIMEOUT from
+the config) is interrupted once it has run that many seconds. Actions
+registered with background=True do not run in the request at all; all
+of a hook's background actions are queued together as one job, so a
+slow plugin cannot hold up publishing. Their arguments are pickled for
+the queue, with database objects passed by id and loaded again in the
+job.
+"""
+from flask import current_app
+from redwind import metrics
+from redwind.tasks import get_queue, async_app_context
+import collections
+import contextlib
+import signal
+import threading
+import time
+
+Action = collections.namedtuple('Action', ['func', 'background', 'timeout'])
+ModelRef = collections.namedtuple('ModelRef', ['model', 'id'])
 
 actions = {}
 
 
-def register(hook, action):
-    #app.logger.debug('registering hook %s -> %s', hook, action)
-    actions.setdefault(hook, []).append(action)
+class HookTimeout(Exception):
+    pass
+
+
+def register(hook, action, background=False, timeout=None):
+    """Call action whenever hook is fired. Registering the same action
+    again (e.g. when another app is created) replaces the earlier
+    registration.
+    """
+    registered = actions.setdefault(hook, [])
+    registered[:] = [a for a in registered if a.func != action]
+    registered.append(Action(action, background, timeout))
 
 
 def fire(hook, *args, **kwargs):
-    #app.logger.debug('firing hook %s', hook)
-    return [action(*args, **kwargs)
-            for action in actions.get(hook, [])]
+    """Run the hook's actions, and return the results of those run
+    here, in the order they were registered (None for an action that
+    failed). Background actions are queued as a single job.
+    """
+    results = []
+    background = []
+    for action in actions.get(hook, []):
+        if action.background:
+            background.append(action_name(action.func))
+        else:
+            results.append(run(hook, action, args, kwargs))
+    if background:
+        enqueue(hook, background, args, kwargs)
+    return results
+
+
+def run(hook, action, args, kwargs):
+    name = action_name(action.func)
+    timeout = action.timeout or current_app.config.get('HOOK_TIMEOUT')
+    try:
+        with metrics.timer('redwind_hook_seconds', hook=hook, action=name), \
+                time_limit(timeout):
+            return action.func(*args, **kwargs)
+    except Exception:
+        current_app.logger.exception('hook %s: action %s failed', hook, name)
+
+
+def enqueue(hook, names, args, kwargs):
+    try:
+        get_queue().enqueue(
+            do_fire, hook, names, [to_ref(arg) for arg in args],
+            {k: to_ref(v) for k, v in kwargs.items()},
+            current_app.config['CONFIG_FILE'])
+    except Exception:
+        current_app.logger.exception(
+            'hook %s: could not queue background actions %s', hook, names)
+
+
+@metrics.timed_job
+def do_fire(hook, names, args, kwargs, app_config):
+    from redwind.models import get_settings
+    with async_app_context(app_config):
+        # actions build absolute urls, so they need a request context
+        with current_app.test_request_context(
+                base_url=get_settings().site_url):
+            args = [from_ref(arg) for arg in args]
+            kwargs = {k: from_ref(v) for k, v in kwargs.items()}
+            registered = {action_name(action.func): action
+                          for action in actions.get(hook, [])}
+            for name in names:
+                action = registered.get(name)
+                if action:
+                    run(hook, action, args, kwargs)
+                else:
+                    current_app.logger.warn(
+                        'hook %s: action %s is no longer registered',
+                        hook, name)
+
+
+def to_ref(value):
+    from redwind.extensions import db
+    if isinstance(value, db.Model):
+        return ModelRef(type(value).__name__, value.id)
+    return value
+
+
+def from_ref(value):
+    from redwind import models
+    if isinstance(value, ModelRef):
+        return getattr(models, value.model).query.get(value.id)
+    return value
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """Raise HookTimeout if the with block runs longer than seconds.
+    This relies on SIGALRM, so it only limits the main thread on Unix
+    and does nothing elsewhere. An alarm that was already set, like
+    RQ's job timeout, is put back afterwards; if it is due first, it
+    is left to fire instead.
+    """
+    if not seconds or not hasattr(signal, 'setitimer') \
+       or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    outer_delay, _ = signal.getitimer(signal.ITIMER_REAL)
+    if outer_delay and outer_delay <= seconds:
+        yield
+        return
+
+    def interrupt(signum, frame):
+        raise HookTimeout('took longer than {}s'.format(seconds))
+
+    start = time.monotonic()
+    outer_handler = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, outer_handler)
+        if outer_delay:
+            signal.setitimer(signal.ITIMER_REAL, max(
+                outer_delay - (time.monotonic() - start), 0.001))
+
+
+def action_name(action):
+    return '{}.{}'.format(getattr(action, '__module__', None),
+                          getattr(action, '__name__', repr(action)))
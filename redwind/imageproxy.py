@@ -1,37 +1,76 @@
+from redwind import delivery
+from redwind import metrics
+from redwind import pipeline
 from redwind import util
 from flask import request, abort, send_file, url_for, make_response, \
     Blueprint, escape, current_app
 from requests.exceptions import HTTPError
 import datetime
+import functools
 import hashlib
 import hmac
 import json
+import mimetypes
 import os
+import re
 import shutil
 import sys
 import urllib.parse
 
 imageproxy = Blueprint('imageproxy', __name__)
 
+# sizes requested by the templates for post photos; these are
+# generated in the background whenever a post is saved
+DEFAULT_PREGENERATE_SIZES = (600,)
+DEFAULT_MAX_SIZE = 2048
+URL_CACHE_SIZE = 4096
+CACHED_FILE_MAX_AGE = 24 * 60 * 60
 
-def construct_url(url, size=None, external=False):
+
+@imageproxy.record_once
+def register(state):
+    pipeline.register(plan_derivatives)
+
+
+def config_key():
+    """The parts of the configuration that affect a proxied URL. Used
+    to key memoized URLs so they are invalidated when any of these
+    change.
+    """
     from redwind.models import get_settings
+    return (get_settings().site_url,
+            current_app.config.get('PILBOX_URL'),
+            current_app.config.get('PILBOX_KEY'))
+
+
+def construct_url(url, size=None, external=False):
     if not url or 'PILBOX_URL' not in current_app.config:
         return url
-    url = urllib.parse.urljoin(get_settings().site_url, url)
+    return _construct_url(url, size and str(size), external, config_key())
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+@metrics.timed('redwind_imageproxy_sign_seconds')
+def _construct_url(url, size, external, config_key):
+    """Build and sign the proxied URL. Listing pages ask for the same
+    avatars over and over, so results are memoized; config_key is part
+    of the key so that changing the site url or Pilbox settings does
+    not return stale URLs.
+    """
+    site_url, pilbox_url, pilbox_key = config_key
+    url = urllib.parse.urljoin(site_url, url)
     query = [('url', url)]
     if size:
         query += [('w', size), ('h', size), ('mode', 'clip')]
     else:
         query += [('op', 'noop')]
     querystring = urllib.parse.urlencode(query)
-    if 'PILBOX_KEY' in current_app.config:
-        h = hmac.new(current_app.config['PILBOX_KEY'].encode(),
-                     querystring.encode(), hashlib.sha1)
+    if pilbox_key:
+        h = hmac.new(pilbox_key.encode(), querystring.encode(), hashlib.sha1)
         querystring += '&sig=' + h.hexdigest()
-    proxy_url = current_app.config['PILBOX_URL'] + '?' + querystring
+    proxy_url = pilbox_url + '?' + querystring
     if external:
-        proxy_url = urllib.parse.urljoin(get_settings().site_url, proxy_url)
+        proxy_url = urllib.parse.urljoin(site_url, proxy_url)
     return proxy_url
 
 
@@ -39,3 +78,239 @@ def construct_url(url, size=None, external=False):
 def imageproxy_filter(src, side=None, external=False):
     return escape(
         construct_url(src, side and str(side), external))
+
+
+@imageproxy.route('/imageproxy')
+def image_proxy():
+    """Built-in replacement for an external Pilbox server. Accepts the
+    same query parameters that construct_url generates, resizes the
+    image to fit within w x h and caches the result on disk.
+    """
+    url = request.args.get('url')
+    if not url or not check_signature(request.query_string.decode(), url):
+        abort(400)
+
+    if request.args.get('op') == 'noop':
+        width = height = None
+    else:
+        try:
+            width = int(request.args.get('w'))
+            height = int(request.args.get('h') or width)
+        except (TypeError, ValueError):
+            abort(400)
+        max_size = current_app.config.get('IMAGEPROXY_MAX_SIZE',
+                                          DEFAULT_MAX_SIZE)
+        if not 0 < width <= max_size or not 0 < height <= max_size:
+            abort(400)
+
+    try:
+        path, mimetype = get_derivative(url, width, height)
+    except HTTPError as e:
+        current_app.logger.warn('could not fetch image %s: %s', url, e)
+        abort(404)
+
+    if not path:
+        abort(404)
+    return send_cached_file(path, mimetype)
+
+
+def check_signature(querystring, url):
+    key = current_app.config.get('PILBOX_KEY')
+    if not key:
+        # unsigned, we would be an open proxy for any image on the
+        # web, so only serve the site's own attachments
+        return find_local_source(url) is not None
+    unsigned, sep, sig = querystring.rpartition('&sig=')
+    if not sep:
+        return False
+    expected = hmac.new(key.encode(), unsigned.encode(), hashlib.sha1)
+    return hmac.compare_digest(expected.hexdigest(), sig)
+
+
+def source_key(url):
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def find_local_source(url):
+    """If url refers to an attachment on this site, return the
+    Attachment so we can read it from disk instead of fetching it
+    over HTTP.
+    """
+    from redwind.models import Post, get_settings
+    from werkzeug.exceptions import HTTPException
+
+    site_url = get_settings().site_url
+    if not site_url or not url.startswith(site_url):
+        return None
+
+    path = urllib.parse.urlparse(url).path
+    site_prefix = urllib.parse.urlparse(site_url).path.rstrip('/')
+    try:
+        endpoint, args = current_app.url_map.bind(site_url).match(
+            path[len(site_prefix):])
+    except HTTPException:
+        return None
+
+    if endpoint == 'views.post_attachment':
+        post = Post.load_by_path('{}/{:02d}/{}'.format(
+            args['year'], args['month'], args['slug']))
+    elif endpoint == 'views.draft_attachment':
+        post = Post.load_by_path('drafts/{}'.format(args['hash']))
+    else:
+        return None
+
+    if post and not post.deleted and not post.friends_only:
+        return next((a for a in post.attachments
+                     if a.filename == args['filename']), None)
+
+
+def get_derivative(url, width=None, height=None):
+    """Find or create a copy of the image at url resized to fit
+    within width x height. Derivatives are stored under
+    IMAGEPROXY_PATH keyed by a hash of the source URL and the size.
+
+    :return: a tuple of (path relative to IMAGEPROXY_PATH, mimetype)
+    """
+    root = current_app.config['IMAGEPROXY_PATH']
+    key = source_key(url)
+    ext = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+
+    attachment = find_local_source(url)
+    if attachment:
+        source_path = attachment.disk_path
+        if not os.path.exists(source_path):
+            return None, None
+        mimetype = attachment.mimetype
+    else:
+        source_path = os.path.join(root, 'sources', key[:2], key + ext)
+        if not os.path.exists(source_path):
+            util.download_resource(url, source_path)
+        mimetype = guess_mimetype(source_path)
+
+    if not width or not height:
+        if attachment:
+            # no need to keep a second copy of our own files
+            width = height = current_app.config.get(
+                'IMAGEPROXY_MAX_SIZE', DEFAULT_MAX_SIZE)
+        else:
+            return os.path.relpath(source_path, root), mimetype
+
+    return write_derivative(url, source_path, width, height), mimetype
+
+
+def guess_mimetype(path):
+    """Guess from the extension, or failing that, ask Pillow what the
+    file is; remote images do not always have an extension.
+    """
+    mimetype, _ = mimetypes.guess_type(path)
+    if mimetype:
+        return mimetype
+    try:
+        from PIL import Image
+        mimetype = Image.MIME.get(Image.open(path).format)
+    except (ImportError, IOError, OSError):
+        pass
+    return mimetype or 'application/octet-stream'
+
+
+def write_derivative(url, source_path, width, height):
+    """Resize source_path, a copy of the image at url, unless the
+    derivative is already up to date.
+
+    :return: the derivative's path relative to IMAGEPROXY_PATH
+    """
+    root = current_app.config['IMAGEPROXY_PATH']
+    key = source_key(url)
+    ext = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+    relpath = os.path.join(
+        key[:2], '{}-{}x{}{}'.format(key, width, height, ext))
+    resized_path = os.path.join(root, relpath)
+    if not util.is_cached_current(source_path, resized_path):
+        os.makedirs(os.path.dirname(resized_path), exist_ok=True)
+        if not resize_image(source_path, resized_path, width, height):
+            shutil.copyfile(source_path, resized_path)
+    return relpath
+
+
+def resize_image(source_path, dest_path, width, height):
+    """Resize an image to fit within width x height, preserving its
+    aspect ratio and never scaling up. Requires Pillow; returns False
+    if the image could not be resized, in which case the caller should
+    fall back to the original.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        current_app.logger.warn('Pillow is not installed; cannot resize')
+        return False
+
+    try:
+        im = Image.open(source_path)
+        if im.format == 'GIF' and im.info.get('duration'):
+            # resizing would drop every frame but the first
+            return False
+        if im.size[0] <= width and im.size[1] <= height:
+            return False
+        fmt = im.format
+        im.thumbnail((width, height), Image.LANCZOS)
+        temp_path = dest_path + '.part'
+        im.save(temp_path, fmt, quality=90)
+        os.replace(temp_path, dest_path)
+        return True
+    except (IOError, OSError):
+        current_app.logger.exception('could not resize %s', source_path)
+        return False
+
+
+def uses_builtin_proxy():
+    pilbox_url = current_app.config.get('PILBOX_URL')
+    return (pilbox_url and 'IMAGEPROXY_PATH' in current_app.config
+            and urllib.parse.urlparse(pilbox_url).path
+            == url_for('imageproxy.image_proxy'))
+
+
+def plan_derivatives(post, args):
+    if not uses_builtin_proxy():
+        return []
+    images = [(a.url, a.disk_path) for a in post.attachments
+              if (a.mimetype or '').startswith('image/')]
+    if images:
+        return [pipeline.Stage(
+            'image derivatives',
+            functools.partial(pregenerate_derivatives, images), None)]
+
+
+def pregenerate_derivatives(images):
+    """Write the sizes the templates ask for of each (url, disk path)"""
+    sizes = current_app.config.get('IMAGEPROXY_PREGENERATE_SIZES',
+                                   DEFAULT_PREGENERATE_SIZES)
+    for url, disk_path in images:
+        if not os.path.exists(disk_path):
+            continue
+        for size in sizes:
+            current_app.logger.debug('generating %s derivative of %s',
+                                     size, url)
+            write_derivative(url, disk_path, size, size)
+    return '{} images in {} sizes'.format(len(images), len(sizes))
+
+
+@imageproxy.route('/imageproxy/maps/<key>.png')
+def map_image(key):
+    if not re.match('^[0-9a-f]+$', key):
+        abort(404)
+    path = os.path.join('maps', key + '.png')
+    return send_cached_file(path, 'image/png')
+
+
+def send_cached_file(path, mimetype):
+    """Serve a file stored under IMAGEPROXY_PATH, letting nginx handle
+    it via the configured delivery backend.
+    """
+    root = current_app.config.get('IMAGEPROXY_PATH')
+    if not root or not os.path.exists(os.path.join(root, path)):
+        abort(404)
+
+    return delivery.send_file(
+        os.path.join(root, path), mimetype,
+        internal_url=os.path.join('/internal_imageproxy', path),
+        max_age=CACHED_FILE_MAX_AGE)
@@ -1,26 +1,308 @@
+"""Import a site export (see exporter.py).
+
+Records are read one at a time, from NDJSON or from a JSON export
+(streamed with ijson when it is installed), and written batch_size at
+a time. Each batch of posts is flushed through the ORM, then its tag,
+people, context and mention links are written with one executemany
+insert per association table. Contexts are shared between posts by
+url, including contexts already in the database.
+
+After every commit the number of records read so far is written to
+the checkpoint file, if there is one, so an interrupted import can be
+run again and pick up where it stopped. Posts whose path already
+exists are skipped either way.
+"""
+from flask import current_app, g
 from .extensions import db
 from .models import Setting, Post, Contact, Venue, Tag, Nick, Mention, Context
+from .models import Attachment, posts_to_tags, posts_to_people
+from .models import posts_to_mentions, posts_to_reply_contexts
+from .models import posts_to_repost_contexts, posts_to_like_contexts
+from .models import posts_to_bookmark_contexts
+import collections
 import datetime
+import json
+import os
+
+BATCH_SIZE = 500
+# keep IN (...) queries under sqlite's limit on bound parameters
+QUERY_CHUNK_SIZE = 500
+SECTIONS = (
+    ('settings', 'setting'),
+    ('venues', 'venue'),
+    ('contacts', 'contact'),
+    ('posts', 'post'),
+)
+CONTEXT_TABLES = (
+    ('reply_contexts', posts_to_reply_contexts),
+    ('repost_contexts', posts_to_repost_contexts),
+    ('like_contexts', posts_to_like_contexts),
+    ('bookmark_contexts', posts_to_bookmark_contexts),
+)
 
 
 def truncate(string, length):
     if string:
         return string[:length]
 
+
 def import_all(blob):
-    tags = {}
-    venues = {}
-    db.session.add_all([import_setting(s) for s in blob['settings']])
-    db.session.add_all([import_venue(v, venues) for v in blob['venues']])
-    db.session.add_all([import_contact(c) for c in blob['contacts']])
-    db.session.add_all([import_post(p, tags, venues) for p in blob['posts']])
-    db.session.commit()
+    """Import an export that has already been loaded into memory"""
+    return Importer().run(
+        (rectype, record) for key, rectype in SECTIONS
+        for record in blob.get(key, []))
+
+
+def import_file(f, fmt='ndjson', batch_size=BATCH_SIZE, checkpoint=None):
+    """Import an export from the file f, which is read incrementally.
+
+    :param fmt: 'ndjson' or 'json'
+    :param checkpoint: path of a file to record progress in
+    :return: a Counter of records imported and skipped, by type
+    """
+    records = (iter_ndjson_records(f) if fmt == 'ndjson'
+               else iter_json_records(f))
+    return Importer(batch_size, checkpoint).run(records)
+
+
+def iter_ndjson_records(f):
+    for line in f:
+        if line.strip():
+            record = json.loads(line)
+            yield record['type'], record['data']
+
+
+def iter_json_records(f):
+    """Yield (type, record) pairs from a JSON export. Without ijson the
+    whole file has to be parsed at once.
+    """
+    try:
+        import ijson
+    except ImportError:
+        current_app.logger.warn(
+            'ijson is not installed; reading the whole export into memory')
+        blob = json.load(f)
+        for key, rectype in SECTIONS:
+            for record in blob.get(key, []):
+                yield rectype, record
+        return
+
+    prefixes = {key + '.item': rectype for key, rectype in SECTIONS}
+    builder = item_prefix = None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if builder:
+            builder.event(event, value)
+            if prefix == item_prefix and event == 'end_map':
+                yield prefixes[item_prefix], builder.value
+                builder = None
+        elif prefix in prefixes and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            item_prefix = prefix
+
+
+class Importer:
+    def __init__(self, batch_size=BATCH_SIZE, checkpoint=None):
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.stats = collections.Counter()
+        self.posts = []
+        self.new_venues = []
+        self.new_contacts = []
+        self.pending = 0
+
+    def run(self, records):
+        done = self.read_checkpoint()
+        # names and slugs are cheap to keep for the whole import
+        self.tags = dict(db.session.query(Tag.name, Tag.id))
+        self.venues = dict(db.session.query(Venue.slug, Venue.id))
+        self.contacts = dict(db.session.query(Contact.name, Contact.id))
+        self.nicks = set(n for n, in db.session.query(Nick.name))
+
+        position = 0
+        for position, (rectype, record) in enumerate(records, 1):
+            if position <= done:
+                continue
+            if rectype == 'post':
+                self.posts.append(record)
+            elif rectype == 'setting':
+                self.import_setting(record)
+            elif rectype == 'venue':
+                self.import_venue(record)
+            elif rectype == 'contact':
+                self.import_contact(record)
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.commit(position)
+        self.commit(position)
+        return self.stats
+
+    def commit(self, position):
+        if not self.pending:
+            return
+        db.session.flush()
+        self.venues.update((v.slug, v.id) for v in self.new_venues)
+        self.contacts.update((c.name, c.id) for c in self.new_contacts)
+        if self.posts:
+            self.import_posts(self.posts)
+        db.session.commit()
+        db.session.expunge_all()
+        self.write_checkpoint(position)
+        current_app.logger.info('imported %d records: %s', position,
+                                dict(self.stats))
+        self.posts = []
+        self.new_venues = []
+        self.new_contacts = []
+        self.pending = 0
+
+    def read_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                return json.load(f)['position']
+        return 0
+
+    def write_checkpoint(self, position):
+        if self.checkpoint:
+            temp = self.checkpoint + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump({'position': position}, f)
+            os.replace(temp, self.checkpoint)
+
+    def import_setting(self, blob):
+        setting = Setting.query.get(blob['key']) or import_setting(blob)
+        setting.name = blob['name']
+        setting.value = blob['value']
+        db.session.add(setting)
+        # get_settings() caches them for the app context
+        g.rw_settings = None
+        self.stats['setting'] += 1
+
+    def import_venue(self, blob):
+        if blob['slug'] in self.venues:
+            self.stats['venue skipped'] += 1
+            return
+        venue = import_venue(blob)
+        # remember it now, so a duplicate later in this batch is skipped
+        self.venues[venue.slug] = None
+        self.new_venues.append(venue)
+        db.session.add(venue)
+        self.stats['venue'] += 1
+
+    def import_contact(self, blob):
+        if any(nick in self.nicks for nick in blob['nicks']):
+            self.stats['contact skipped'] += 1
+            return
+        contact = import_contact(blob)
+        self.nicks.update(blob['nicks'])
+        self.new_contacts.append(contact)
+        db.session.add(contact)
+        self.stats['contact'] += 1
+
+    def import_posts(self, blobs):
+        existing = set(path for path, in query_in(
+            Post.path, Post.path, [b['path'] for b in blobs]))
+        # the first of several posts with the same path wins, as it
+        # would have if they were in different batches
+        new_blobs = []
+        for blob in blobs:
+            if blob['path'] not in existing:
+                existing.add(blob['path'])
+                new_blobs.append(blob)
+        self.stats['post skipped'] += len(blobs) - len(new_blobs)
+        blobs = new_blobs
+        if not blobs:
+            return
+
+        contexts = self.resolve_contexts(blobs)
+        new_tags = {}
+        for blob in blobs:
+            for name in blob['tags']:
+                if name not in self.tags and name not in new_tags:
+                    new_tags[name] = Tag(name)
+
+        posts = [import_post(blob) for blob in blobs]
+        for post, blob in zip(posts, blobs):
+            post.venue_id = self.venues.get(blob['venue'])
+        mentions = [[import_mention(m) for m in blob['mentions']]
+                    for blob in blobs]
+        db.session.add_all(posts)
+        db.session.add_all(new_tags.values())
+        db.session.add_all(m for ms in mentions for m in ms)
+        db.session.flush()
+        self.tags.update((t.name, t.id) for t in new_tags.values())
+
+        rows = collections.defaultdict(list)
+        for post, blob, post_mentions in zip(posts, blobs, mentions):
+            for name in unique(blob['tags']):
+                rows[posts_to_tags].append(
+                    {'post_id': post.id, 'tag_id': self.tags[name]})
+            for name in unique(blob.get('people', [])):
+                if name in self.contacts:
+                    rows[posts_to_people].append(
+                        {'post_id': post.id,
+                         'contact_id': self.contacts[name]})
+            for mention in post_mentions:
+                rows[posts_to_mentions].append(
+                    {'post_id': post.id, 'mention_id': mention.id})
+            for attr, table in CONTEXT_TABLES:
+                for context_blob in blob[attr]:
+                    context = contexts[context_key(context_blob)]
+                    rows[table].append(
+                        {'post_id': post.id, 'context_id': context.id})
+
+        for table, table_rows in rows.items():
+            db.session.execute(table.insert(), table_rows)
+        self.stats['post'] += len(posts)
+
+    def resolve_contexts(self, blobs):
+        """Find or create a Context for every context in blobs.
+
+        :return: a dict from context_key to Context
+        """
+        blobs_by_key = collections.OrderedDict(
+            (context_key(c), c) for blob in blobs
+            for attr, _ in CONTEXT_TABLES for c in blob[attr])
+        urls = [key for key in blobs_by_key if isinstance(key, str)]
+        contexts = {}
+        for context in query_in(Context, Context.url, urls):
+            contexts.setdefault(context.url, context)
+        for key, context_blob in blobs_by_key.items():
+            if key not in contexts:
+                contexts[key] = import_context(context_blob)
+                db.session.add(contexts[key])
+                self.stats['context'] += 1
+        db.session.flush()
+        return contexts
+
+
+def unique(names):
+    return collections.OrderedDict.fromkeys(names).keys()
+
+
+def context_key(blob):
+    """Contexts are deduplicated by url; ones without a url by identity"""
+    return blob['url'] or id(blob)
+
+
+def query_in(entity, column, values):
+    """Run query(entity).filter(column.in_(values)) in chunks"""
+    values = list(values)
+    for ii in range(0, len(values), QUERY_CHUNK_SIZE):
+        chunk = values[ii:ii + QUERY_CHUNK_SIZE]
+        for row in db.session.query(entity).filter(column.in_(chunk)):
+            yield row
 
 
 def import_datetime(dt):
     if dt:
         return datetime.datetime.strptime(dt, '%Y-%m-%dT%H:%M:%S')
 
+
+def import_timedelta(seconds):
+    if seconds is not None:
+        return datetime.timedelta(seconds=seconds)
+
+
 def import_setting(blob):
     s = Setting()
     s.key = blob['key']
@@ -39,27 +321,18 @@ def import_contact(blob):
     return c
 
 
-def import_venue(blob, venues):
+def import_venue(blob):
     v = Venue()
     v.name = blob['name']
     v.location = blob['location']
     v.slug = blob['slug']
-    venues[v.slug] = v
     return v
 
 
-def import_post(blob, tags, venues):
-    def import_tag(tag_name):
-        tag = tags.get(tag_name)
-        if not tag:
-            tag = Tag(tag_name)
-            tags[tag_name] = tag
-        return tag
-
-    def lookup_venue(slug):
-        if slug:
-            return venues.get(slug)
-
+def import_post(blob):
+    """Build a Post from blob. Tags, people, contexts and mentions are
+    linked by the Importer.
+    """
     p = Post(blob['post_type'])
     p.path = blob['path']
     p.historic_path = blob['historic_path']
@@ -67,29 +340,41 @@ def import_post(blob, tags, venues):
     p.deleted = blob['deleted']
     p.hidden = blob['hidden']
     p.redirect = blob['redirect']
-    p.tags = [import_tag(t) for t in blob['tags']]
-    p.audience = blob['audience']
+    p.friends_only = blob.get('friends_only')
     p.in_reply_to = blob['in_reply_to']
     p.repost_of = blob['repost_of']
     p.like_of = blob['like_of']
     p.bookmark_of = blob['bookmark_of']
-    p.reply_contexts = [import_context(c) for c in blob['reply_contexts']]
-    p.like_contexts = [import_context(c) for c in blob['like_contexts']]
-    p.repost_contexts = [import_context(c) for c in blob['repost_contexts']]
-    p.bookmark_contexts = [import_context(c) for c in blob['bookmark_contexts']]
     p.title = blob['title']
     p.published = import_datetime(blob['published'])
+    p.updated = import_datetime(blob.get('updated'))
+    p.start_utc = import_datetime(blob.get('start_utc'))
+    p.start_utcoffset = import_timedelta(blob.get('start_utcoffset'))
+    p.end_utc = import_datetime(blob.get('end_utc'))
+    p.end_utcoffset = import_timedelta(blob.get('end_utcoffset'))
+    p.short_path = blob.get('short_path')
     p.slug = blob['slug']
     p.syndication = blob['syndication']
     p.location = blob['location']
-    p.photos = blob['photos']
-    p.venue = lookup_venue(blob['venue'])
-    p.mentions = [import_mention(m) for m in blob['mentions']]
+    p.item = blob.get('item')
+    p.rating = blob.get('rating')
+    p.attachments = [import_attachment(a)
+                     for a in blob.get('attachments', [])]
     p.content = blob['content']
     p.content_html = blob['content_html']
+    p.update_display_html()
     return p
 
 
+def import_attachment(blob):
+    a = Attachment()
+    a.filename = blob['filename']
+    a.mimetype = blob['mimetype']
+    a.storage_path = blob['storage_path']
+    a.content_hash = blob['content_hash']
+    return a
+
+
 def import_context(blob):
     c = Context()
     c.url = blob['url']
@@ -102,6 +387,7 @@ def import_context(blob):
     c.published = import_datetime(blob['published'])
     c.title = truncate(blob['title'], 512)
     c.syndication = blob['syndication']
+    c.update_display_html()
     return c
 
 
@@ -118,4 +404,5 @@ def import_mention(blob):
     m.title = truncate(blob['title'], 512)
     m.syndication = blob['syndication']
     m.reftype = blob['reftype']
+    m.update_display_html()
     return m
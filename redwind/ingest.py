@@ -0,0 +1,171 @@
+"""Bulk ingestion of micropub JSON entries, one per line (NDJSON), for
+importing years of silo archives at once.
+
+Entries are translated just like single micropub JSON requests, but
+are inserted in batches that share one tag/venue/contact Resolver, and
+without fetching photos or reply contexts or rendering html. Each
+committed batch is handed to a background job that does all three
+and, if asked, fires the post-saved hooks (which would otherwise
+syndicate and send webmentions for every archived post).
+
+Available at /micropub/bulk (streaming a JSON progress line back after
+every batch) and as scripts/bulk_ingest.py.
+"""
+from redwind import contexts
+from redwind import hooks
+from redwind import micropub
+from redwind import posts
+from redwind.extensions import db
+from redwind.models import Post, get_settings
+from redwind.tasks import get_queue, async_app_context
+from flask import Blueprint, Response, current_app, request, abort
+from flask import stream_with_context
+from werkzeug.datastructures import MultiDict
+import json
+
+DEFAULT_BATCH_SIZE = 100
+
+ingest = Blueprint('ingest', __name__)
+
+
+@ingest.route('/micropub/bulk', methods=['POST'])
+def bulk_endpoint():
+    """Accepts an NDJSON body of micropub JSON entries. Query args:
+    batch_size, and hooks=true to run post-saved hooks for the new posts.
+    """
+    token = micropub.get_access_token()
+    if not token or not micropub.verify_token(token):
+        abort(401)
+
+    batch_size = request.args.get('batch_size', DEFAULT_BATCH_SIZE, type=int)
+    fire_hooks = request.args.get('hooks') == 'true'
+    lines = iter(request.stream.readline, b'')
+
+    def generate():
+        for progress in ingest_lines(lines, batch_size, fire_hooks):
+            yield json.dumps(progress) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def ingest_lines(lines, batch_size=DEFAULT_BATCH_SIZE, fire_hooks=False):
+    """Create a post for each JSON entry in lines. Blank lines are
+    ignored; entries that fail to parse, or whose syndication urls we
+    already have, are skipped.
+
+    :param lines: an iterable of str or bytes, one entry per line
+    :param batch_size: the number of posts to insert per commit
+    :param fire_hooks: run post-saved hooks once the posts are rendered
+    :return: a generator that yields a progress dict after each batch,
+      with running totals and the errors from that batch
+    """
+    resolver = posts.Resolver()
+    progress = {'lines': 0, 'created': 0, 'skipped': 0, 'errors': []}
+    batch = []
+
+    def flush():
+        db.session.commit()
+        if batch:
+            get_queue().enqueue(
+                do_process_batch, [(post.id, args, photo_url)
+                                   for post, args, photo_url in batch],
+                fire_hooks, current_app.config['CONFIG_FILE'])
+        progress['created'] += len(batch)
+        current_app.logger.info(
+            'bulk ingest: %(lines)d lines, %(created)d created, '
+            '%(skipped)d skipped', progress)
+        report = dict(progress, errors=list(progress['errors']))
+        del batch[:]
+        del progress['errors'][:]
+        return report
+
+    for lineno, line in enumerate(lines, 1):
+        progress['lines'] = lineno
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            result = create_post(json.loads(line), resolver)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            current_app.logger.warn('bulk ingest: bad entry on line %d: %s',
+                                    lineno, e)
+            progress['errors'].append({'line': lineno, 'error': str(e)})
+            progress['skipped'] += 1
+            continue
+
+        if result:
+            batch.append(result)
+        else:
+            progress['skipped'] += 1
+
+        if len(batch) >= batch_size:
+            yield flush()
+
+    yield flush()
+
+
+def create_post(entry, resolver):
+    """Add a post for one entry to the session without committing.
+
+    :return: a tuple of (post, hook args, photo url), or None if we
+      already have a post with one of the entry's syndication urls
+    """
+    data = micropub.json_to_post_input(entry, resolver)
+    for url in data.syndication or []:
+        if Post.load_by_syndication_url(url):
+            return None
+
+    post = Post(data.post_type)
+    try:
+        # nothing is flushed until the post is complete
+        with db.session.no_autoflush:
+            posts.apply_input(post, data, resolver)
+        posts.update_paths(post, data, was_draft=False)
+    except Exception:
+        # detach it from the tags, venue and contacts it was given, or
+        # they would cascade it back into the session
+        post.tags = []
+        post.people = []
+        post.venue = None
+        if post in db.session:
+            db.session.expunge(post)
+        raise
+    db.session.add(post)
+    return post, data.hook_args().to_dict(flat=False), data.photo_url
+
+
+def do_process_batch(post_hook_args, fire_hooks, app_config):
+    """Fetch photos and contexts and render html for newly ingested
+    posts.
+
+    :param post_hook_args: a list of (post id, hook args, photo url)
+      tuples
+    """
+    with async_app_context(app_config):
+        saved = []
+        for post_id, args, photo_url in post_hook_args:
+            post = Post.load_by_id(post_id)
+            if not post:
+                continue
+            try:
+                if photo_url:
+                    posts.fetch_photo(post, photo_url)
+                if (post.in_reply_to or post.repost_of or post.like_of
+                        or post.bookmark_of):
+                    contexts.fetch_contexts(post)
+                posts.render_html(post)
+                db.session.commit()
+                saved.append((post, args))
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception(
+                    'bulk ingest: could not process post %s', post_id)
+
+        if fire_hooks:
+            # hooks build absolute urls, so they need a request context
+            with current_app.test_request_context(
+                    base_url=get_settings().site_url):
+                for post, args in saved:
+                    hooks.fire('post-saved', post, MultiDict(args))
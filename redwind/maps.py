@@ -2,11 +2,30 @@
 Generate static map images
 """
 from redwind import imageproxy
+from flask import current_app, url_for
+import collections
+import functools
+import hashlib
+import os
+import requests
 import urllib.parse
 
 # get_map_image(600, 400, 33, -88, 13, [])
 # get_map_image(600, 400, 33, -88, 13, [Marker(33, -88)])
 
+STATIC_MAPS_URL = 'http://static-maps.kylewm.com/img.php'
+MAP_URL_CACHE_SIZE = 512
+FETCHED_MAPS_SIZE = 1024
+
+# a fetch in progress is marked in Redis, so that every process sees it
+# and a fetch that died without clearing the marker is retried later
+PENDING_KEY = 'redwind:maps:pending:{}'
+PENDING_TTL = 10 * 60
+
+# keys of map images this process has found on disk, most recently
+# used last, so we don't stat the disk on every render
+_fetched_maps = collections.OrderedDict()
+
 
 class Marker:
     def __init__(self, lat, lng, icon='dot-small-blue'):
@@ -14,9 +33,25 @@ class Marker:
         self.lng = lng
         self.icon = icon
 
+    def _key(self):
+        return (self.lat, self.lng, self.icon)
 
-def get_map_image(width, height, maxzoom, markers):
-    # create the URL
+    def __eq__(self, other):
+        return isinstance(other, Marker) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return 'Marker(lat={}, lng={}, icon={})'.format(
+            self.lat, self.lng, self.icon)
+
+
+@functools.lru_cache(maxsize=MAP_URL_CACHE_SIZE)
+def build_map_url(width, height, maxzoom, markers):
+    """Build the URL of the remote static map image. Markers must be
+    passed as a tuple so the result can be memoized.
+    """
     args = [
         ('width', width),
         ('height', height),
@@ -26,7 +61,84 @@ def get_map_image(width, height, maxzoom, markers):
         ('marker[]', 'lat:{};lng:{};icon:{}'.format(m.lat, m.lng, m.icon))
         for m in markers
     ]
+    return STATIC_MAPS_URL + '?' + urllib.parse.urlencode(args)
+
+
+def get_map_image(width, height, maxzoom, markers):
+    markers = tuple(markers)
+
+    if current_app.config.get('MAP_IMAGE_CACHE'):
+        local_url = get_cached_map_image(
+            build_map_url(width, height, maxzoom, markers))
+        if local_url:
+            return local_url
 
+    # construct_url memoizes the signed url
     return imageproxy.construct_url(
-        'http://static-maps.kylewm.com/img.php?'
-        + urllib.parse.urlencode(args))
+        build_map_url(width, height, maxzoom, markers))
+
+
+def map_image_key(map_url):
+    return hashlib.sha1(map_url.encode()).hexdigest()
+
+
+def map_image_path(key):
+    return os.path.join(
+        current_app.config['IMAGEPROXY_PATH'], 'maps', key + '.png')
+
+
+def get_cached_map_image(map_url):
+    """Return the URL of the locally stored copy of this map image. If
+    we do not have a local copy yet, enqueue a job to fetch one and
+    return None so the caller can fall back to the remote image.
+    """
+    if 'IMAGEPROXY_PATH' not in current_app.config:
+        return None
+
+    key = map_image_key(map_url)
+    if key in _fetched_maps or os.path.exists(map_image_path(key)):
+        remember_fetched_map(key)
+        return url_for('imageproxy.map_image', key=key)
+
+    from redwind.tasks import get_queue
+    try:
+        queue = get_queue()
+        # only the first render to see this map queues the fetch
+        if queue.connection.set(PENDING_KEY.format(key), 1,
+                                nx=True, ex=PENDING_TTL):
+            queue.enqueue(fetch_map_image, map_url, map_image_path(key),
+                          current_app.config['CONFIG_FILE'])
+    except Exception:
+        current_app.logger.exception(
+            'could not enqueue map image fetch for %s', map_url)
+
+
+def remember_fetched_map(key):
+    _fetched_maps[key] = True
+    _fetched_maps.move_to_end(key)
+    if len(_fetched_maps) > FETCHED_MAPS_SIZE:
+        _fetched_maps.popitem(last=False)
+
+
+def fetch_map_image(map_url, path, app_config):
+    """Download a rendered map image and store it under
+    IMAGEPROXY_PATH. Writes to a temporary file first so a partial
+    download is never served. The pending marker is cleared either
+    way, so a failed fetch is tried again on a later render.
+    """
+    from redwind.tasks import get_queue, async_app_context
+    with async_app_context(app_config):
+        try:
+            current_app.logger.debug('fetching map image %s', map_url)
+            response = requests.get(map_url, stream=True, timeout=30)
+            response.raise_for_status()
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + '.part'
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(4096):
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        finally:
+            key = os.path.splitext(os.path.basename(path))[0]
+            get_queue().connection.delete(PENDING_KEY.format(key))
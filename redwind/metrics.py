@@ -0,0 +1,240 @@
+"""Timing histograms for request phases, hooks and background jobs,
+served in the Prometheus text format at /metrics (admin login
+required). Turned on by METRICS = True in the config.
+
+Request, database, template, ETag, image proxy signing and hook timings
+are kept in memory, so each web worker process reports its own. RQ
+runs every job in a fresh fork, so job timings are added up in Redis
+instead and included by whichever worker answers the scrape.
+"""
+from flask import Blueprint, Response, current_app, g, request
+from flask import has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import bisect
+import contextlib
+import flask.ext.login as flask_login
+import functools
+import jinja2
+import threading
+import time
+
+metrics = Blueprint('metrics', __name__)
+
+# in seconds, the Prometheus client defaults
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+JOBS_KEY = 'redwind:metrics:jobs'
+
+HELP = {
+    'redwind_request_seconds': 'Time to handle a request',
+    'redwind_request_db_seconds': 'Time spent in SQL queries per request',
+    'redwind_template_render_seconds': 'Time to render a template',
+    'redwind_etag_seconds': 'Time to compute ETags and check conditions',
+    'redwind_imageproxy_sign_seconds':
+    'Time to build and sign an uncached image proxy url',
+    'redwind_hook_seconds': 'Time taken by each hook action',
+    'redwind_job_seconds': 'Time taken by each background job',
+}
+
+# set by init_app; nothing is recorded until an app turns metrics on
+enabled = False
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(BUCKETS, value)
+        if idx < len(BUCKETS):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        with timer('redwind_template_render_seconds',
+                   template=self.name or 'string'):
+            return super().render(*args, **kwargs)
+
+
+def init_app(app):
+    global enabled
+    if not app.config.get('METRICS'):
+        return
+    enabled = True
+    app.register_blueprint(metrics)
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if not event.contains(Engine, 'before_cursor_execute', before_execute):
+        event.listen(Engine, 'before_cursor_execute', before_execute)
+        event.listen(Engine, 'after_cursor_execute', after_execute)
+
+
+def observe(name, seconds, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        hist = _histograms.get(key)
+        if not hist:
+            hist = _histograms[key] = Histogram()
+        hist.observe(seconds)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator that times each call of the function"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_job(f):
+    """Decorator for RQ job functions; records each run in Redis,
+    labelled with the function's name
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            # the job creates its app, so enabled is known by now
+            if enabled:
+                record_job(f.__name__, time.perf_counter() - start)
+    return wrapper
+
+
+def record_job(job, seconds):
+    from redwind.tasks import get_queue
+    from redis.exceptions import RedisError
+    idx = bisect.bisect_left(BUCKETS, seconds)
+    pipe = get_queue().connection.pipeline()
+    if idx < len(BUCKETS):
+        pipe.hincrby(JOBS_KEY, '{}|{}'.format(job, idx), 1)
+    pipe.hincrbyfloat(JOBS_KEY, '{}|sum'.format(job), seconds)
+    pipe.hincrby(JOBS_KEY, '{}|count'.format(job), 1)
+    try:
+        pipe.execute()
+    except RedisError:
+        pass
+
+
+def load_job_histograms():
+    """Rebuild the job histograms recorded by record_job"""
+    from redwind.tasks import get_queue
+    from redis.exceptions import RedisError
+    try:
+        fields = get_queue().connection.hgetall(JOBS_KEY)
+    except RedisError as e:
+        current_app.logger.warn('could not load job metrics: %s', e)
+        return {}
+
+    histograms = {}
+    for field, value in fields.items():
+        job, _, part = field.decode().rpartition('|')
+        hist = histograms.setdefault(
+            ('redwind_job_seconds', (('job', job),)), Histogram())
+        if part == 'sum':
+            hist.sum = float(value)
+        elif part == 'count':
+            hist.count = int(value)
+        else:
+            hist.counts[int(part)] = int(value)
+    return histograms
+
+
+def before_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def after_execute(conn, cursor, statement, parameters, context,
+                  executemany):
+    started = conn.info.get('metrics_started')
+    if started and has_app_context() \
+       and getattr(g, 'metrics_db_time', None) is not None:
+        g.metrics_db_time += time.perf_counter() - started.pop()
+    elif started:
+        started.pop()
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_db_time = 0.0
+
+
+def finish_request(response):
+    started = getattr(g, 'metrics_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'none'
+        observe('redwind_request_seconds', time.perf_counter() - started,
+                endpoint=endpoint)
+        observe('redwind_request_db_seconds', g.metrics_db_time,
+                endpoint=endpoint)
+        g.metrics_started = g.metrics_db_time = None
+    return response
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in labels) + '}'
+
+
+def render(histograms):
+    """Format histograms, a dict of (name, labels) -> Histogram, in the
+    Prometheus text exposition format
+    """
+    lines = []
+    last_name = None
+    for (name, labels), hist in sorted(histograms.items()):
+        if name != last_name:
+            lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+            lines.append('# TYPE {} histogram'.format(name))
+            last_name = name
+        cumulative = 0
+        for le, count in zip(BUCKETS, hist.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, format_labels(labels, le=str(le)), cumulative))
+        lines.append('{}_bucket{} {}'.format(
+            name, format_labels(labels, le='+Inf'), hist.count))
+        lines.append('{}_sum{} {}'.format(
+            name, format_labels(labels), repr(hist.sum)))
+        lines.append('{}_count{} {}'.format(
+            name, format_labels(labels), hist.count))
+    return '\n'.join(lines) + '\n'
+
+
+@metrics.route('/metrics')
+@flask_login.login_required
+def metrics_endpoint():
+    histograms = load_job_histograms()
+    with _lock:
+        histograms.update(_histograms)
+        text = render(histograms)
+    return Response(text, mimetype='text/plain; version=0.0.4')
@@ -1,16 +1,20 @@
+import collections
 import datetime
+import hashlib
+import time
 import urllib
 
 from redwind import auth
+from redwind import posts
 from redwind import util
-from redwind.models import get_settings, Post, Venue, Credential, PosseTarget
 from redwind.extensions import db
+from redwind.models import get_settings, Post, Venue, Credential, PosseTarget
+from redwind.models import User
 
 import jwt
 import requests
 from flask import request, abort, make_response, url_for, jsonify, Blueprint
 from flask import current_app, redirect
-from flask.ext.login import login_user
 
 
 micropub = Blueprint('micropub', __name__)
@@ -85,30 +89,13 @@ def micropub_endpoint():
         "received micropub request %s, args=%s, form=%s, headers=%s",
         request, request.args, request.form, request.headers)
 
-    bearer_prefix = 'Bearer '
-    header_token = request.headers.get('authorization')
-    if header_token and header_token.startswith(bearer_prefix):
-        token = header_token[len(bearer_prefix):]
-    else:
-        token = request.form.get('access_token')
-
+    token = get_access_token()
     if not token:
         current_app.logger.warn('hit micropub endpoint with no access token')
         abort(401)
 
-    try:
-        decoded = util.jwt_decode(token)
-    except jwt.DecodeError as e:
-        current_app.logger.warn('could not decode access token: %s', e)
-        abort(401)
-
-    me = decoded.get('me')
-    client_id = decoded.get('client_id')
-    cred = Credential.query.filter_by(type='indieauth', value=me).first()
-    user = cred and cred.user
-    if not user or not user.is_authenticated():
-        current_app.logger.warn(
-            'received valid access token for invalid user: %s', me)
+    verified = verify_token(token)
+    if not verified:
         abort(401)
 
     if request.method == 'GET':
@@ -118,42 +105,20 @@ def micropub_endpoint():
         q = request.args.get('q')
         if q == 'syndicate-to':
             current_app.logger.debug('returning syndication targets')
+            targets = get_syndicate_to(verified.user_id)
 
             if 'application/json' in accept_header:
-                return jsonify({
-                    'syndicate-to': util.trim_nulls([{
-                        'uid': t.uid,
-                        'name': t.name,
-                        'user': {
-                            'name': t.user_name,
-                            'url': t.user_url,
-                            'photo': t.user_photo,
-                        },
-                        'service': {
-                            'name': t.service_name,
-                            'url': t.service_url,
-                            'photo': t.service_photo,
-                        },
-                    } for t in user.posse_targets])
-                })
+                return jsonify({'syndicate-to': targets})
 
             else:
                 response = make_response(urllib.parse.urlencode([
-                    ('syndicate-to[]', t.uid) for t in user.posse_targets]))
+                    ('syndicate-to[]', t['uid']) for t in targets]))
                 response.headers['Content-Type'] = 'application/x-www-form-urlencoded'
                 return response
 
         elif q in ('actions', 'json_actions'):
             current_app.logger.debug('returning action handlers')
-            reply_url = url_for('admin.new_post', type='reply', _external=True)
-            repost_url = url_for('admin.new_post', type='share', _external=True)
-            like_url = url_for('admin.new_post', type='like', _external=True)
-            payload = {
-                'reply': reply_url + '?url={url}',
-                'repost': repost_url + '?url={url}',
-                'favorite': like_url + '?url={url}',
-                'like': like_url + '?url={url}',
-            }
+            payload = get_actions()
             if q == 'json_actions' or 'application/json' in accept_header:
                 return jsonify(payload)
             else:
@@ -164,102 +129,303 @@ def micropub_endpoint():
         else:
             abort(404)
 
-    h = request.form.get('h')
-    in_reply_to = request.form.get('in-reply-to')
-    like_of = request.form.get('like-of')
-    photo_url = request.form.get('photo')
-    photo_file = request.files.get('photo')
-    bookmark = request.form.get('bookmark') or request.form.get('bookmark-of')
-    repost_of = request.form.get('repost-of')
-
-    post_type = ('event' if h == 'event'
-                 else 'article' if 'name' in request.form
-                 else 'photo' if photo_file or photo_url
-                 else 'reply' if in_reply_to
-                 else 'like' if like_of
-                 else 'bookmark' if bookmark
-                 else 'share' if repost_of
-                 else 'note')
-
-    latitude = None
-    longitude = None
-    location_name = None
-    venue_id = None
-
-    loc_str = request.form.get('location')
-    geo_prefix = 'geo:'
-    if loc_str:
-        if loc_str.startswith(geo_prefix):
-            loc_str = loc_str[len(geo_prefix):]
-            loc_params = loc_str.split(';')
-            if loc_params:
-                latitude, longitude = loc_params[0].split(',', 1)
-                location_name = request.form.get('place_name')
-        else:
-            venue_prefix = urllib.parse.urljoin(get_settings().site_url, 'venues/')
-            if loc_str.startswith(venue_prefix):
-                slug = loc_str[len(venue_prefix):]
-                venue = Venue.query.filter_by(slug=slug).first()
-                if venue:
-                    venue_id = venue.id
-
-    # url of the venue, e.g. https://kylewm.com/venues/cafe-trieste-berkeley-california
-    venue = request.form.get('venue')
-
-    syndicate_to = request.form.getlist('syndicate-to[]')
-
-    syndication = request.form.getlist('syndication[]')
-    if syndication:
-        syndication = '\n'.join(syndication)
+    if request.mimetype == 'application/json':
+        data = json_to_post_input(request.get_json())
     else:
-        syndication = request.form.get('syndication')
+        data = form_to_post_input(request.form, request.files)
 
     # TODO check client_id
-    if syndication:
+    if data.syndication:
+        current_app.logger.debug(
+            'checking for existing post with syndication %s',
+            data.syndication)
+        for url in data.syndication:
+            existing = Post.load_by_syndication_url(url)
+            if existing:
+                current_app.logger.debug(
+                    'found post for %s: %s', url, existing)
+                return redirect(existing.permalink)
         current_app.logger.debug(
-            'checking for existing post with syndication %s', syndication)
-        existing = Post.query.filter(
-            Post.syndication.like(db.literal('%"' + syndication + '"%')),
-            ~Post.deleted
-        ).first()
-        if existing:
-            current_app.logger.debug(
-                'found post for %s: %s', syndication, existing)
-            return redirect(existing.permalink)
+            'no post found with syndication %s', data.syndication)
+
+    post = posts.save_post(Post(data.post_type), data)
+    return make_response('Created', 201, {'Location': post.permalink})
+
+
+def get_access_token():
+    """The token from the Authorization header or access_token form field"""
+    bearer_prefix = 'Bearer '
+    header_token = request.headers.get('authorization')
+    if header_token and header_token.startswith(bearer_prefix):
+        return header_token[len(bearer_prefix):]
+    return request.form.get('access_token')
+
+
+VerifiedToken = collections.namedtuple(
+    'VerifiedToken', ['user_id', 'me', 'client_id', 'scope', 'expires'])
+
+# Clients like Quill poll the endpoint, so we remember tokens we have
+# already verified, and the payloads we hand back, for a few minutes.
+# Entries are dropped immediately when this process changes a
+# credential, user or posse target; other processes see the change
+# once their entries expire.
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_SIZE = 256
+_token_cache = collections.OrderedDict()
+_syndicate_to_cache = {}
+_actions_cache = {}
+
+
+def verify_token(token):
+    """Decode an access token and check that it belongs to an admin
+    user.
+
+    :return: a VerifiedToken or None
+    """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    now = time.time()
+    verified = _token_cache.get(key)
+    if verified and verified.expires > now:
+        _token_cache.move_to_end(key)
+        return verified
+
+    try:
+        decoded = util.jwt_decode(token)
+    except jwt.DecodeError as e:
+        current_app.logger.warn('could not decode access token: %s', e)
+        return None
+
+    me = decoded.get('me')
+    cred = Credential.query.filter_by(type='indieauth', value=me).first()
+    user = cred and cred.user
+    if not user or not user.is_authenticated():
+        current_app.logger.warn(
+            'received valid access token for invalid user: %s', me)
+        return None
+
+    verified = VerifiedToken(
+        user.id, me, decoded.get('client_id'), decoded.get('scope'),
+        now + current_app.config.get('MICROPUB_TOKEN_CACHE_TTL',
+                                     TOKEN_CACHE_TTL))
+    _token_cache[key] = verified
+    while len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return verified
+
+
+def revoke_tokens():
+    _token_cache.clear()
+
+
+def get_syndicate_to(user_id):
+    cached = _syndicate_to_cache.get(user_id)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    targets = util.trim_nulls([{
+        'uid': t.uid,
+        'name': t.name,
+        'user': {
+            'name': t.user_name,
+            'url': t.user_url,
+            'photo': t.user_photo,
+        },
+        'service': {
+            'name': t.service_name,
+            'url': t.service_url,
+            'photo': t.service_photo,
+        },
+    } for t in PosseTarget.query.filter_by(user_id=user_id)
+                                .order_by(PosseTarget.id)])
+    _syndicate_to_cache[user_id] = (
+        time.time() + current_app.config.get('MICROPUB_TOKEN_CACHE_TTL',
+                                             TOKEN_CACHE_TTL),
+        targets)
+    return targets
+
+
+def invalidate_syndicate_to():
+    _syndicate_to_cache.clear()
+
+
+def get_actions():
+    # the urls only depend on which host we are being served from
+    payload = _actions_cache.get(request.url_root)
+    if not payload:
+        reply_url = url_for('admin.new_post', type='reply', _external=True)
+        repost_url = url_for('admin.new_post', type='share', _external=True)
+        like_url = url_for('admin.new_post', type='like', _external=True)
+        payload = _actions_cache[request.url_root] = {
+            'reply': reply_url + '?url={url}',
+            'repost': repost_url + '?url={url}',
+            'favorite': like_url + '?url={url}',
+            'like': like_url + '?url={url}',
+        }
+    return payload
+
+
+@db.event.listens_for(Credential, 'after_insert')
+@db.event.listens_for(Credential, 'after_update')
+@db.event.listens_for(Credential, 'after_delete')
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def _credentials_changed(mapper, connection, target):
+    revoke_tokens()
+    invalidate_syndicate_to()
+
+
+def guess_post_type(h, name, photo, in_reply_to, like_of, bookmark,
+                    repost_of):
+    return ('event' if h == 'event'
+            else 'article' if name
+            else 'photo' if photo
+            else 'reply' if in_reply_to
+            else 'like' if like_of
+            else 'bookmark' if bookmark
+            else 'share' if repost_of
+            else 'note')
+
+
+def parse_location(loc_str, resolver=None):
+    """Parse a micropub location, either a geo: URI or the url of one of
+    our venues.
+
+    :param resolver: a posts.Resolver to look venues up with
+    :return: a tuple of (latitude, longitude, venue_id)
+    """
+    geo_prefix = 'geo:'
+    if loc_str.startswith(geo_prefix):
+        loc_str = loc_str[len(geo_prefix):]
+        loc_params = loc_str.split(';')
+        if loc_params:
+            latitude, longitude = loc_params[0].split(',', 1)
+            return latitude, longitude, None
+    else:
+        # url of the venue, e.g.
+        # https://kylewm.com/venues/cafe-trieste-berkeley-california
+        venue_prefix = urllib.parse.urljoin(
+            get_settings().site_url, 'venues/')
+        if loc_str.startswith(venue_prefix):
+            slug = loc_str[len(venue_prefix):]
+            venue = (resolver.venue_by_slug(slug) if resolver
+                     else Venue.query.filter_by(slug=slug).first())
+            if venue:
+                return None, None, venue.id
+    return None, None, None
+
+
+def form_to_post_input(form, files):
+    """Translate a form-encoded micropub request"""
+    in_reply_to = form.get('in-reply-to')
+    like_of = form.get('like-of')
+    photo_url = form.get('photo')
+    photo_file = files.get('photo')
+    bookmark = form.get('bookmark') or form.get('bookmark-of')
+    repost_of = form.get('repost-of')
+
+    latitude = longitude = location_name = venue_id = None
+    loc_str = form.get('location')
+    if loc_str:
+        latitude, longitude, venue_id = parse_location(loc_str)
+        if latitude:
+            location_name = form.get('place_name')
+
+    syndication = (form.getlist('syndication[]')
+                   or util.multiline_string_to_list(
+                       form.get('syndication', '')))
+
+    return posts.PostInput(
+        post_type=guess_post_type(
+            form.get('h'), 'name' in form, photo_file or photo_url,
+            in_reply_to, like_of, bookmark, repost_of),
+        published=form.get('published'),
+        start=form.get('start'),
+        end=form.get('end'),
+        title=form.get('name', ''),
+        content=form.get('content[html]') or form.get('content'),
+        venue_id=venue_id,
+        latitude=latitude,
+        longitude=longitude,
+        location_name=location_name,
+        syndication=syndication or None,
+        in_reply_to=in_reply_to and [in_reply_to],
+        like_of=like_of and [like_of],
+        repost_of=repost_of and [repost_of],
+        bookmark_of=bookmark and [bookmark],
+        files=[photo_file] if photo_file else [],
+        photo_url=None if photo_file else photo_url,
+        syndicate_to=form.getlist('syndicate-to[]'),
+        hidden=bool(like_of or bookmark))
+
+
+def json_to_post_input(body, resolver=None):
+    """Translate a JSON micropub request, e.g.
+    {"type": ["h-entry"], "properties": {"content": ["hello"]}}
+
+    :param resolver: a posts.Resolver to look venues up with
+    """
+    h = (body.get('type') or ['h-entry'])[0]
+    if h.startswith('h-'):
+        h = h[2:]
+    props = body.get('properties', {})
+
+    def first(key):
+        values = props.get(key)
+        if values:
+            value = values[0]
+            if isinstance(value, dict):
+                # embedded objects, e.g. {"value": url, "alt": "..."}
+                return value.get('value') or value.get('url')
+            return value
+
+    content = (props.get('content') or [None])[0]
+    if isinstance(content, dict):
+        content = content.get('html') or content.get('value')
+
+    in_reply_to = props.get('in-reply-to')
+    like_of = props.get('like-of')
+    repost_of = props.get('repost-of')
+    bookmark = props.get('bookmark-of')
+    photo_url = first('photo')
+
+    latitude = longitude = venue_id = None
+    location = first('location')
+    if location:
+        latitude, longitude, venue_id = parse_location(location, resolver)
+
+    # plain categories are tags, embedded h-cards are people
+    tags = []
+    people = []
+    for category in props.get('category', []):
+        if isinstance(category, dict):
+            card = category.get('properties', {})
+            nick = (card.get('nickname') or card.get('name') or [None])[0]
+            if nick:
+                people.append(nick)
         else:
-            current_app.logger.debug(
-                'no post found with syndication %s', syndication)
-
-    # translate from micropub's verbage.TODO unify
-    translated = util.trim_nulls({
-        'post_type': post_type,
-        'published': request.form.get('published'),
-        'start': request.form.get('start'),
-        'end': request.form.get('end'),
-        'title': request.form.get('name'),
-        'content': request.form.get('content[html]') or request.form.get('content'),
-        'venue': venue_id,
-        'latitude': latitude,
-        'longitude': longitude,
-        'location_name': location_name,
-        'syndication': syndication,
-        'in_reply_to': in_reply_to,
-        'like_of': like_of,
-        'repost_of': repost_of,
-        'bookmark_of': bookmark,
-        'photo': photo_file or photo_url,
-        'syndicate-to': syndicate_to,
-        'hidden': 'true' if like_of or bookmark else 'false',
-    })
-    with current_app.test_request_context(
-            base_url=get_settings().site_url, path='/save_new',
-            method='POST', data=translated
-    ):
-        current_app.logger.debug('received fake request %s: %s',
-                                 request, request.args)
-        login_user(user)
-        current_app.logger.debug('successfully authenticated as user %s => %s',
-                                 me, user)
-        from . import admin
-        resp = admin.save_new()
-        return make_response('Created', 201, {'Location': resp.location})
+            tags.append(category)
+
+    return posts.PostInput(
+        post_type=guess_post_type(
+            h, 'name' in props, photo_url, in_reply_to, like_of, bookmark,
+            repost_of),
+        published=first('published'),
+        start=first('start'),
+        end=first('end'),
+        title=first('name') or '',
+        content=content,
+        slug=first('mp-slug'),
+        venue_id=venue_id,
+        latitude=latitude,
+        longitude=longitude,
+        syndication=props.get('syndication'),
+        in_reply_to=in_reply_to,
+        like_of=like_of,
+        repost_of=repost_of,
+        bookmark_of=bookmark,
+        photo_url=photo_url,
+        tags=tags,
+        people=people,
+        syndicate_to=props.get('mp-syndicate-to')
+        or body.get('mp-syndicate-to'),
+        hidden=bool(like_of or bookmark))
@@ -4,6 +4,7 @@ from redwind.extensions import db
 
 from flask import g, session, current_app
 
+import collections
 import json
 import urllib
 import datetime
@@ -154,6 +155,29 @@ class PosseTarget(db.Model):
     service_name = db.Column(db.String(256))
 
 
+class DisplayHtmlMixin:
+    """Stored display html (proxied images, media previews) for a
+    model with a content_display column, rendered from the column
+    named by display_source
+    """
+    display_source = 'content'
+    display_preview = False
+
+    def render_display_html(self):
+        return util.render_display_html(
+            getattr(self, self.display_source), preview=self.display_preview)
+
+    def update_display_html(self):
+        self.content_display = self.render_display_html()
+
+    @property
+    def display_html(self):
+        if self.content_display is None:
+            # saved before display html was stored
+            return self.render_display_html()
+        return self.content_display
+
+
 class Venue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(256))
@@ -179,11 +203,11 @@ class Venue(db.Model):
                                   [maps.Marker(lat, lng, 'dot-small-pink')])
 
 
-class Post(db.Model):
+class Post(DisplayHtmlMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    path = db.Column(db.String(256))
-    historic_path = db.Column(db.String(256))
-    short_path = db.Column(db.String(16))
+    path = db.Column(db.String(256), index=True)
+    historic_path = db.Column(db.String(256), index=True)
+    short_path = db.Column(db.String(16), index=True)
     post_type = db.Column(db.String(64))
     draft = db.Column(db.Boolean)
     deleted = db.Column(db.Boolean)
@@ -217,7 +241,12 @@ class Post(db.Model):
     slug = db.Column(db.String(256))
 
     syndication = db.Column(JsonType)
+    # indexed copy of syndication, kept in sync by _sync_syndications
+    syndications = db.relationship('PostSyndication', backref='post',
+                                   cascade='all, delete-orphan')
     sent_webmentions = db.Column(JsonType)
+    # how each stage of the last publish job went, see redwind.pipeline
+    publish_status = db.Column(JsonType)
 
     location = db.Column(JsonType)
     venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'))
@@ -228,6 +257,8 @@ class Post(db.Model):
 
     content = db.Column(db.Text)
     content_html = db.Column(db.Text)
+    # content_html with image urls proxied and previews added
+    content_display = db.Column(db.Text)
     attachments = db.relationship('Attachment', backref='post')
 
     # reviews
@@ -250,6 +281,12 @@ class Post(db.Model):
     def load_by_historic_path(cls, path):
         return cls.query.filter_by(historic_path=path).first()
 
+    @classmethod
+    def load_by_syndication_url(cls, url):
+        return cls.query.join(PostSyndication)\
+                        .filter(PostSyndication.url == url)\
+                        .filter(~cls.deleted).first()
+
     def __init__(self, post_type):
         self.post_type = post_type
         self.draft = False
@@ -273,9 +310,16 @@ class Post(db.Model):
         self.mention_urls = []
         self.content = None
         self.content_html = None
+        self.content_display = None
         self.rating = None
         self.item = None
 
+    display_source = 'content_html'
+
+    @property
+    def display_preview(self):
+        return self.post_type in util.PREVIEW_POST_TYPES
+
     def get_image_path(self):
         site_url = get_settings().site_url or 'http://localhost'
         return '/'.join((site_url, self.path, 'files'))
@@ -500,6 +544,14 @@ class Post(db.Model):
             if ctxs:
                 return util.slugify(prefix + ctxs[0].get_slugify_target(), 48)
 
+        # contexts are fetched later for bulk-imported posts
+        for urls, prefix in ((self.bookmark_of, 'bookmark-of-'),
+                             (self.like_of, 'like-of-'),
+                             (self.repost_of, 'repost-of-'),
+                             (self.in_reply_to, 'reply-to-')):
+            if urls:
+                return util.slugify(prefix + util.prettify_url(urls[0]), 48)
+
         return 'untitled'
 
     def add_syndication_url(self, url):
@@ -520,11 +572,36 @@ class Post(db.Model):
             return 'post:{}'.format(self.path)
 
 
+class PostSyndication(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), index=True)
+    url = db.Column(db.String(512), index=True)
+
+    def __init__(self, url):
+        self.url = url
+
+    def __repr__(self):
+        return 'syndication:{}'.format(self.url)
+
+
+@db.event.listens_for(Post.syndication, 'set')
+def _sync_syndications(post, value, oldvalue, initiator):
+    """Mirror every assignment to Post.syndication (the form field,
+    add_syndication_url, imports) into the post_syndication table.
+    """
+    existing = {s.url: s for s in post.syndications}
+    post.syndications = [existing.get(url) or PostSyndication(url)
+                         for url in collections.OrderedDict.fromkeys(
+                             value or [])]
+
+
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(256))
     mimetype = db.Column(db.String(256))
-    storage_path = db.Column(db.String(256))
+    storage_path = db.Column(db.String(256), index=True)
+    # sha256 of the file contents, used as its ETag
+    content_hash = db.Column(db.String(64))
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
 
     @property
@@ -537,14 +614,15 @@ class Attachment(db.Model):
             current_app.config['UPLOAD_PATH'], self.storage_path)
 
 
-class Context(db.Model):
+class Context(DisplayHtmlMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    url = db.Column(db.String(512))
+    url = db.Column(db.String(512), index=True)
     permalink = db.Column(db.String(512))
     author_name = db.Column(db.String(128))
     author_url = db.Column(db.String(512))
     author_image = db.Column(db.String(512))
     content = db.Column(db.Text)
+    content_display = db.Column(db.Text)
     content_plain = db.Column(db.Text)
     published = db.Column(db.DateTime)
     title = db.Column(db.String(512))
@@ -558,6 +636,7 @@ class Context(db.Model):
         self.author_image = kwargs.get('author_image')
         self.content = kwargs.get('content')
         self.content_plain = kwargs.get('content_plain')
+        self.content_display = None
         self.published = kwargs.get('published')
         self.title = kwargs.get('title')
         self.syndication = kwargs.get('syndication', [])
@@ -581,7 +660,7 @@ class Context(db.Model):
         return ' '.join(components)
 
 
-class Mention(db.Model):
+class Mention(DisplayHtmlMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(512))
     permalink = db.Column(db.String(512))
@@ -589,6 +668,7 @@ class Mention(db.Model):
     author_url = db.Column(db.String(512))
     author_image = db.Column(db.String(512))
     content = db.Column(db.Text)
+    content_display = db.Column(db.Text)
     content_plain = db.Column(db.Text)
     published = db.Column(db.DateTime)
     title = db.Column(db.String(512))
@@ -596,6 +676,11 @@ class Mention(db.Model):
     reftype = db.Column(db.String(32))
     rsvp = db.Column(db.String(32))
     person_mention = db.Column(db.Boolean)
+    # validators from the last fetch of the source, to skip re-parsing
+    # it when a webmention is sent again for an unchanged page
+    source_etag = db.Column(db.String(512))
+    source_last_modified = db.Column(db.String(64))
+    source_hash = db.Column(db.String(64))
     posts = db.relationship('Post', secondary=posts_to_mentions)
 
     def __init__(self):
@@ -607,6 +692,7 @@ class Mention(db.Model):
         self.author_image = None
         self.content = None
         self.content_plain = None
+        self.content_display = None
         self.published = None
         self.title = None
         self.reftype = None
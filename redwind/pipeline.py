@@ -0,0 +1,166 @@
+"""The publish pipeline: the work that follows saving a post, like
+reverse geocoding, sending webmentions and PuSH notifications and
+syndicating, runs as one queued job per save.
+
+Plugins register planners. In the job the post is loaded once, with
+its relationships, and each planner returns the Stages it wants to run
+for this post and these hook arguments (e.g. none for a draft). Each
+stage's run() does the slow part, usually network requests, in a
+thread pool alongside the other stages. It may read the post but must
+not change it or use the database, because the session belongs to the
+job's own thread; planners look up anything else it needs. Back in
+that thread, save(post, result), if given, applies the result to the
+post and returns a short message; otherwise the result is the message.
+
+Stages created with serial=True are not run in the pool. They run one
+at a time in the job's own thread once the pool is done, so they may
+use the database and change the post themselves, e.g. plugins whose
+senders commit a syndication url as soon as they have it.
+
+How each stage went is kept in Post.publish_status and shown on the
+post's edit page. Once it is committed the job fires the
+post-published hook, for anything that shows the post as the stages
+left it, like the static snapshot.
+"""
+from flask import current_app, g, request
+from redwind import hooks
+from redwind import metrics
+from redwind.extensions import db
+from redwind.tasks import get_queue, async_app_context
+from sqlalchemy.orm import joinedload, subqueryload
+from werkzeug.datastructures import MultiDict
+import collections
+import concurrent.futures
+import datetime
+import time
+
+Stage = collections.namedtuple('Stage', ['name', 'run', 'save', 'serial'])
+Stage.__new__.__defaults__ = (False,)
+
+DEFAULT_WORKERS = 4
+
+planners = []
+
+
+def init_app(app):
+    hooks.register('post-saved', queue_publish)
+
+
+def register(planner):
+    """planner(post, args) returns a list of Stages for the post"""
+    if planner not in planners:
+        planners.append(planner)
+
+
+def queue_publish(post, args):
+    get_queue().enqueue(do_publish, post.id, MultiDict(args),
+                        current_app.config['CONFIG_FILE'])
+
+
+@metrics.timed_job
+def do_publish(post_id, args, app_config):
+    from redwind.models import get_settings
+    with async_app_context(app_config):
+        # stages build absolute urls, so they need a request context
+        with current_app.test_request_context(
+                base_url=get_settings().site_url):
+            post = load_post(post_id)
+            if post:
+                publish(post, args)
+                hooks.fire('post-published', post, args)
+
+
+def load_post(post_id):
+    """Load the post with everything the stages read, so that nothing
+    is lazy loaded from the worker threads
+    """
+    from redwind.models import Post
+    return Post.query.options(
+        subqueryload(Post.tags),
+        subqueryload(Post.people),
+        subqueryload(Post.attachments),
+        subqueryload(Post.syndications),
+        joinedload(Post.venue),
+    ).get(post_id)
+
+
+def publish(post, args):
+    """Plan and run the stages for post, save their results and record
+    their status
+    """
+    stages = []
+    for planner in planners:
+        try:
+            stages += planner(post, args) or []
+        except Exception:
+            current_app.logger.exception(
+                'publish %s: %s failed', post.id, hooks.action_name(planner))
+    if not stages:
+        return
+
+    pooled = [stage for stage in stages if not stage.serial]
+    outcomes = {}
+    if pooled:
+        workers = current_app.config.get('PUBLISH_WORKERS', DEFAULT_WORKERS)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as pool:
+            outcomes = dict(zip(map(id, pooled),
+                                pool.map(run_stage(post), pooled)))
+
+    status = []
+    for stage in stages:
+        if stage.serial:
+            result, error, seconds = call_stage(post, stage)
+        else:
+            result, error, seconds = outcomes[id(stage)]
+        message = result
+        if not error and stage.save:
+            try:
+                message = stage.save(post, result)
+            except Exception as e:
+                current_app.logger.exception(
+                    'publish %s: saving %s failed', post.id, stage.name)
+                error = e
+        status.append({
+            'name': stage.name,
+            'status': 'failed' if error else 'ok',
+            'message': str(error if error else message or ''),
+            'seconds': round(seconds, 3),
+        })
+
+    post.publish_status = {
+        'finished': datetime.datetime.utcnow().isoformat(),
+        'stages': status,
+    }
+    db.session.commit()
+
+
+def run_stage(post):
+    """Make the function that runs a stage in a worker thread, with an
+    app and request context like the job's own
+    """
+    from redwind.models import get_settings
+    app = current_app._get_current_object()
+    base_url = request.url_root
+    settings = get_settings()
+
+    def run(stage):
+        with app.test_request_context(base_url=base_url):
+            # share the job's settings rather than query them again
+            g.rw_settings = settings
+            return call_stage(post, stage)
+    return run
+
+
+def call_stage(post, stage):
+    """Run stage.run()
+
+    :return: a tuple of (result, exception or None, seconds taken)
+    """
+    start = time.perf_counter()
+    try:
+        return stage.run(), None, time.perf_counter() - start
+    except Exception as e:
+        current_app.logger.exception(
+            'publish %s: %s failed', post.id, stage.name)
+        return None, e, time.perf_counter() - start
@@ -1,4 +1,5 @@
 import datetime
+import functools
 import json
 import re
 import urllib
@@ -6,15 +7,13 @@ from urllib.parse import urlencode, urljoin, parse_qs
 from urllib.request import urlopen
 
 from redwind.extensions import db
-from redwind import util, hooks
-from redwind.tasks import get_queue, async_app_context
+from redwind import pipeline, util
 from redwind.models import Post, Setting, get_settings
 
 from flask.ext.login import login_required
 from flask import request, redirect, url_for, render_template, flash
 from flask import has_request_context, Blueprint, current_app, jsonify
 import requests
-from bs4 import BeautifulSoup
 
 
 facebook = Blueprint('facebook', __name__)
@@ -22,7 +21,7 @@ facebook = Blueprint('facebook', __name__)
 
 def register(app):
     app.register_blueprint(facebook)
-    hooks.register('post-saved', send_to_facebook)
+    pipeline.register(plan_facebook)
 
 
 @facebook.context_processor
@@ -60,37 +59,25 @@ def authorize_facebook():
                         + urlencode(params))
 
 
-def send_to_facebook(post, args):
+def plan_facebook(post, args):
     if 'facebook' in args.getlist('syndicate-to'):
-        if not is_facebook_authorized():
-            return False, 'Current user is not authorized to post to Facebook'
+        return [pipeline.Stage(
+            'facebook', functools.partial(send_to_facebook, post), None,
+            serial=True)]
 
-        try:
-            current_app.logger.debug('auto-posting to Facebook %s', post.id)
-            get_queue().enqueue(
-                do_send_to_facebook, post.id, current_app.config['CONFIG_FILE'])
-            return True, 'Success'
 
-        except Exception as e:
-            current_app.logger.exception('auto-posting to facebook')
-            return False, 'Exception while auto-posting to FB: {}'.format(e)
+def send_to_facebook(post):
+    if not is_facebook_authorized():
+        raise RuntimeError(
+            'Current user is not authorized to post to Facebook')
 
-
-def do_send_to_facebook(post_id, app_config):
-    with async_app_context(app_config):
-        current_app.logger.debug('auto-posting to facebook for %s', post_id)
-        post = Post.load_by_id(post_id)
-
-        message, link, name, picture = guess_content(post)
-        facebook_url = handle_new_or_edit(post, message, link, name, picture,
-                                          post.post_type == 'photo',
-                                          album_id=None)
-        db.session.commit()
-        if has_request_context():
-            flash('Shared on Facebook: <a href="{}">Original</a>, '
-                  '<a href="{}">On Facebook</a><br/>'
-                  .format(post.permalink, facebook_url))
-            return redirect(post.permalink)
+    current_app.logger.debug('auto-posting to facebook for %s', post.id)
+    message, link, name, picture = guess_content(post)
+    facebook_url = handle_new_or_edit(post, message, link, name, picture,
+                                      post.post_type == 'photo',
+                                      album_id=None)
+    db.session.commit()
+    return facebook_url
 
 
 @facebook.route('/share_on_facebook', methods=['GET', 'POST'])
@@ -256,6 +243,7 @@ def handle_new_or_edit(post, message, link, name, picture,
 
 
 def guess_content(post):
+    from bs4 import BeautifulSoup
     name = None
     picture = None
     link = None
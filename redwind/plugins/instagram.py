@@ -1,14 +1,15 @@
 from .. import hooks
+from .. import pipeline
 from .. import util
 from ..extensions import db
-from ..models import Post, Setting, get_settings, Context
-from ..tasks import get_queue, async_app_context
+from ..models import Setting, get_settings, Context
 
 from flask.ext.login import login_required
 from flask import (
     request, redirect, url_for, Blueprint, current_app,
 )
 
+import functools
 import requests
 import urllib
 import datetime
@@ -22,7 +23,7 @@ instagram = Blueprint('instagram', __name__)
 def register(app):
     app.register_blueprint(instagram)
     hooks.register('create-context', create_context)
-    hooks.register('post-saved', send_to_instagram)
+    pipeline.register(plan_instagram)
 
 
 @instagram.route('/authorize_instagram')
@@ -109,69 +110,64 @@ def create_context(url):
     return context
 
 
-def send_to_instagram(post, args):
-    """Share a like or comment to Instagram without user-input.
-    """
+def plan_instagram(post, args):
     if 'instagram' in args.getlist('syndicate-to'):
-        if not is_instagram_authorized():
-            return False, 'Current user is not authorized for instagram'
-
-        current_app.logger.debug(
-            "queueing post to instagram {}".format(post.id))
-        get_queue().enqueue(do_send_to_instagram, post.id, current_app.config['CONFIG_FILE'])
-        return True, 'Success'
-
-
-def do_send_to_instagram(post_id, app_config):
-    with async_app_context(app_config):
-        current_app.logger.debug('posting to instagram %d', post_id)
-        post = Post.load_by_id(post_id)
-
-        in_reply_to, repost_of, like_of \
-            = util.posse_post_discovery(post, PERMALINK_RE)
-
-        # likes are the only thing we can POSSE to instagram unfortunately
-        if like_of:
-            m = PERMALINK_RE.match(like_of)
-            shortcode = m.group(1)
-
-            r = ig_get('https://api.instagram.com/v1/media/shortcode/'
-                       + m.group(1))
+        return [pipeline.Stage(
+            'instagram', functools.partial(send_to_instagram, post), None,
+            serial=True)]
 
-            if r.status_code // 2 != 100:
-                current_app.logger.warn(
-                    "failed to fetch instagram media %s %s", r, r.content)
-                return None
 
-            media_id = r.json().get('data', {}).get('id')
-            if not media_id:
-                current_app.logger.warn(
-                    'could not find media id for shortcode %s', shortcode)
-                return None
-
-            r = ig_get('https://api.instagram.com/v1/users/self')
-            my_username = r.json().get('data', {}).get('username')
-
-            r = ig_post('https://api.instagram.com/v1/media/'
-                        + media_id + '/likes')
-
-            if r.status_code // 2 != 100:
-                current_app.logger.warn(
-                    "failed to POST like for instagram id %s", media_id)
-                return None
-
-            like_url = like_of + '#liked-by-' + my_username
-            post.add_syndication_url(like_url)
+def send_to_instagram(post):
+    """Share a like or comment to Instagram without user-input.
+    """
+    if not is_instagram_authorized():
+        raise RuntimeError('Current user is not authorized for instagram')
+
+    current_app.logger.debug('posting to instagram %d', post.id)
+    in_reply_to, repost_of, like_of \
+        = util.posse_post_discovery(post, PERMALINK_RE)
+
+    # likes are the only thing we can POSSE to instagram unfortunately
+    if like_of:
+        m = PERMALINK_RE.match(like_of)
+        shortcode = m.group(1)
+
+        r = ig_get('https://api.instagram.com/v1/media/shortcode/'
+                   + m.group(1))
+
+        if r.status_code // 2 != 100:
+            raise RuntimeError('failed to fetch instagram media {} {}'.format(
+                r, r.content))
+
+        media_id = r.json().get('data', {}).get('id')
+        if not media_id:
+            raise RuntimeError(
+                'could not find media id for shortcode {}'.format(shortcode))
+
+        r = ig_get('https://api.instagram.com/v1/users/self')
+        my_username = r.json().get('data', {}).get('username')
+
+        r = ig_post('https://api.instagram.com/v1/media/'
+                    + media_id + '/likes')
+
+        if r.status_code // 2 != 100:
+            raise RuntimeError(
+                'failed to POST like for instagram id {}'.format(media_id))
+
+        like_url = like_of + '#liked-by-' + my_username
+        post.add_syndication_url(like_url)
+        db.session.commit()
+        return like_url
+
+    if in_reply_to:
+        comment_text = format_markdown_for_instagram(post.content)
+        comment_url = post_comment(in_reply_to, comment_text)
+        if comment_url:
+            post.add_syndication_url(comment_url)
             db.session.commit()
-            return like_url
-
-        if in_reply_to:
-            comment_text = format_markdown_for_instagram(post.content)
-            comment_url = post_comment(in_reply_to, comment_text)
-            if comment_url:
-                post.add_syndication_url(comment_url)
-                db.session.commit()
-                return comment_url
+            return comment_url
+
+    return 'nothing to share'
 
 
 def format_markdown_for_instagram(data):
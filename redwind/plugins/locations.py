@@ -1,9 +1,9 @@
 from flask import request, jsonify, Blueprint, current_app
 from redwind import hooks
+from redwind import pipeline
 from redwind import views
 from redwind.extensions import db
-from redwind.models import Post, Venue
-from redwind.tasks import get_queue, async_app_context
+import functools
 import json
 import requests
 
@@ -13,47 +13,39 @@ locations = Blueprint('locations', __name__)
 
 def register(app):
     app.register_blueprint(locations)
-    hooks.register('post-saved', reverse_geocode)
-    hooks.register('venue-saved', reverse_geocode_venue)
+    pipeline.register(plan_reverse_geocode)
+    hooks.register('venue-saved', reverse_geocode_venue, background=True)
 
 
-def reverse_geocode(post, args):
-    get_queue().enqueue(do_reverse_geocode_post, post.id, current_app.config['CONFIG_FILE'])
+def plan_reverse_geocode(post, args):
+    location = post.location
+    if location and 'latitude' in location and 'longitude' in location:
+        return [pipeline.Stage(
+            'reverse geocode', functools.partial(
+                do_reverse_geocode, location['latitude'],
+                location['longitude']),
+            save_address)]
+
+
+def save_address(post, adr):
+    # copy the dict so that the ORM recognizes
+    # that it changed
+    post.location = dict(post.location)
+    post.location.update(adr)
+    return views.geo_name(post.location, as_html=False)
 
 
 def reverse_geocode_venue(venue, args):
-    get_queue().enqueue(do_reverse_geocode_venue, venue.id, current_app.config['CONFIG_FILE'])
-
-
-def do_reverse_geocode_post(postid, app_config):
-    with async_app_context(app_config):
-        post = Post.load_by_id(postid)
-        if not post:
-            return
-        if post.location and 'latitude' in post.location \
-           and 'longitude' in post.location:
-            adr = do_reverse_geocode(post.location['latitude'],
-                                     post.location['longitude'])
-            # copy the dict so that the ORM recognizes
-            # that it changed
-            post.location = dict(post.location)
-            post.location.update(adr)
-            db.session.commit()
-
-
-def do_reverse_geocode_venue(venueid, app_config):
-    with async_app_context(app_config):
-        venue = Venue.query.get(venueid)
-        if venue.location and 'latitude' in venue.location \
-           and 'longitude' in venue.location:
-            adr = do_reverse_geocode(venue.location['latitude'],
-                                     venue.location['longitude'])
-            # copy the dict so the ORM actually recognizes
-            # that it changed
-            venue.location = dict(venue.location)
-            venue.location.update(adr)
-            venue.update_slug(views.geo_name(venue.location, as_html=False))
-            db.session.commit()
+    if venue and venue.location and 'latitude' in venue.location \
+       and 'longitude' in venue.location:
+        adr = do_reverse_geocode(venue.location['latitude'],
+                                 venue.location['longitude'])
+        # copy the dict so the ORM actually recognizes
+        # that it changed
+        venue.location = dict(venue.location)
+        venue.location.update(adr)
+        venue.update_slug(views.geo_name(venue.location, as_html=False))
+        db.session.commit()
 
 
 def do_reverse_geocode(lat, lng):
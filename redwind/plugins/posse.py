@@ -3,16 +3,17 @@ from flask import current_app
 from flask.ext.login import current_user, login_required
 from flask.ext.micropub import MicropubClient
 
-import mf2py
+import functools
 import mf2util
 import requests
 
 
-from redwind import hooks
+from redwind import pipeline
+# our own endpoint, not to be confused with the MicropubClient below
+from redwind import micropub as micropub_server
 from redwind import util
-from redwind.models import get_settings, Post, PosseTarget
+from redwind.models import get_settings, PosseTarget
 from redwind.extensions import db
-from redwind.tasks import get_queue, async_app_context
 
 
 posse = Blueprint('posse', __name__, url_prefix='/posse',)
@@ -22,7 +23,7 @@ micropub = MicropubClient(client_id='https://github.com/kylewm/redwind')
 def register(app):
     app.register_blueprint(posse)
     micropub.init_app(app)
-    hooks.register('post-saved', syndicate)
+    pipeline.register(plan_syndication)
 
 
 @posse.context_processor
@@ -50,6 +51,7 @@ def add():
 @posse.route('/callback')
 @micropub.authorized_handler
 def callback(info):
+    import mf2py
     if info.error:
         flash('Micropub failure: {}'.format(info.error))
     else:
@@ -67,6 +69,7 @@ def callback(info):
 
     current_user.posse_targets.append(target)
     db.session.commit()
+    micropub_server.invalidate_syndicate_to()
     return redirect(url_for('.edit', target_id=target.id))
 
 
@@ -89,6 +92,7 @@ def edit():
         setattr(target, prop, request.form.get(prop))
 
     db.session.commit()
+    micropub_server.invalidate_syndicate_to()
     return redirect(url_for('.edit', target_id=target_id))
 
 
@@ -99,75 +103,93 @@ def delete():
     target = PosseTarget.query.get(target_id)
     db.session.delete(target)
     db.session.commit()
+    micropub_server.invalidate_syndicate_to()
     return redirect(url_for('.index'))
 
 
-def syndicate(post, args):
+def plan_syndication(post, args):
     syndto = args.getlist('syndicate-to')
-    for target in PosseTarget.query.filter(PosseTarget.uid.in_(syndto)):
-        current_app.logger.debug('enqueuing task to posse to %s', target.uid)
-        get_queue().enqueue(do_syndicate, post.id, target.id,
-                            current_app.config['CONFIG_FILE'])
-
-
-def do_syndicate(post_id, target_id, app_config):
-    with async_app_context(app_config):
-        post = Post.query.get(post_id)
-        target = PosseTarget.query.get(target_id)
-
-        current_app.logger.debug(
-            'posseing %s to target %s', post.path, target.uid)
-
-        data = {'access_token': target.access_token}
-        files = None
-
-        if post.repost_of:
-            data['repost-of'] = post.repost_of[0]
-        if post.like_of:
-            data['like-of'] = post.like_of[0]
-        if post.in_reply_to:
-            data['in-reply-to'] = post.in_reply_to[0]
-
-        if post.post_type == 'review':
-            item = post.item or {}
-            data['item[name]'] = data['item'] = item.get('name')
-            data['item[author]'] = item.get('author')
-            data['rating'] = post.rating
-            data['description'] = data['description[markdown]'] = data['description[value]'] = post.content
-            data['description[html]'] = post.content_html
-        else:
-            data['name'] = post.title
-            data['content'] = data['content[markdown]'] = data['content[value]'] = post.content
-            data['content[html]'] = post.content_html
-
-        data['url'] = (post.shortlink if target.style == 'microblog'
-                       else post.permalink)
-
-        if post.post_type == 'photo' and post.attachments:
-            if len(post.attachments) == 1:
-                a = post.attachments[0]
-                files = {'photo': (a.filename, open(a.disk_path, 'rb'),
-                                   a.mimetype)}
-            else:
-                files = [('photo[]', (a.filename, open(a.disk_path, 'rb'),
-                                      a.mimetype)) for a in post.attachments]
-
-        data['location'] = post.get_location_as_geo_uri()
-        data['place-name'] = post.venue and post.venue.name
-
-        categories = [tag.name for tag in post.tags]
-        for person in post.people:
-            categories.append(person.url)
-            if person.social:
-                categories += person.social
-        data['category[]'] = categories
-
-        resp = requests.post(target.micropub_endpoint,
-                             data=util.trim_nulls(data), files=files)
-        resp.raise_for_status()
-        current_app.logger.debug(
-            'received response from posse endpoint: code=%d, headers=%s, body=%s',
-            resp.status_code, resp.headers, resp.text)
-
-        post.add_syndication_url(resp.headers['Location'])
-        db.session.commit()
+    if not syndto:
+        return []
+    return [pipeline.Stage(
+        'syndicate to {}'.format(target.name or target.uid),
+        functools.partial(
+            send_to_target, target.micropub_endpoint,
+            *build_request(post, target)),
+        save_syndication_url)
+        for target in PosseTarget.query.filter(PosseTarget.uid.in_(syndto))]
+
+
+def build_request(post, target):
+    """The micropub request to syndicate post to target, as the form
+    data and a list of photos to upload
+    """
+    current_app.logger.debug(
+        'posseing %s to target %s', post.path, target.uid)
+
+    data = {'access_token': target.access_token}
+    photos = []
+
+    if post.repost_of:
+        data['repost-of'] = post.repost_of[0]
+    if post.like_of:
+        data['like-of'] = post.like_of[0]
+    if post.in_reply_to:
+        data['in-reply-to'] = post.in_reply_to[0]
+
+    if post.post_type == 'review':
+        item = post.item or {}
+        data['item[name]'] = data['item'] = item.get('name')
+        data['item[author]'] = item.get('author')
+        data['rating'] = post.rating
+        data['description'] = data['description[markdown]'] = data['description[value]'] = post.content
+        data['description[html]'] = post.content_html
+    else:
+        data['name'] = post.title
+        data['content'] = data['content[markdown]'] = data['content[value]'] = post.content
+        data['content[html]'] = post.content_html
+
+    data['url'] = (post.shortlink if target.style == 'microblog'
+                   else post.permalink)
+
+    if post.post_type == 'photo':
+        photos = [(a.filename, a.disk_path, a.mimetype)
+                  for a in post.attachments]
+
+    data['location'] = post.get_location_as_geo_uri()
+    data['place-name'] = post.venue and post.venue.name
+
+    categories = [tag.name for tag in post.tags]
+    for person in post.people:
+        categories.append(person.url)
+        if person.social:
+            categories += person.social
+    data['category[]'] = categories
+
+    return data, photos
+
+
+def send_to_target(micropub_endpoint, data, photos):
+    """Send the micropub request and return the url of the syndicated
+    copy
+    """
+    files = None
+    if len(photos) == 1:
+        filename, disk_path, mimetype = photos[0]
+        files = {'photo': (filename, open(disk_path, 'rb'), mimetype)}
+    elif photos:
+        files = [('photo[]', (filename, open(disk_path, 'rb'), mimetype))
+                 for filename, disk_path, mimetype in photos]
+
+    resp = requests.post(micropub_endpoint,
+                         data=util.trim_nulls(data), files=files)
+    resp.raise_for_status()
+    current_app.logger.debug(
+        'received response from posse endpoint: code=%d, headers=%s, body=%s',
+        resp.status_code, resp.headers, resp.text)
+    return resp.headers['Location']
+
+
+def save_syndication_url(post, url):
+    post.add_syndication_url(url)
+    return url
@@ -1,21 +1,24 @@
-from flask import url_for, current_app, Config
-from redwind import hooks
-from redwind.tasks import get_queue
+from flask import url_for, current_app
+from redwind import pipeline
+import functools
 import requests
 
 
 def register(app):
     #app.register_blueprint(push)
-    hooks.register('post-saved', send_notifications)
+    pipeline.register(plan_notifications)
 
 
-def send_notifications(post, args):
+def plan_notifications(post, args):
     if not post.hidden and not post.draft and 'PUSH_HUB' in current_app.config:
         urls = [
             url_for('views.index', _external=True),
             url_for('views.index', feed='atom', _external=True),
         ]
-        get_queue().enqueue(publish, urls, current_app.config['PUSH_HUB'])
+        return [pipeline.Stage(
+            'PuSH', functools.partial(
+                publish, urls, current_app.config['PUSH_HUB']),
+            None)]
 
 
 def publish(urls, push_hub):
@@ -26,6 +29,10 @@ def publish(urls, push_hub):
         if response.status_code == 204:
             print('successfully sent PuSH notification.',
                   response, response.text)
+            return 'notified {}'.format(push_hub)
         else:
             print('unexpected response from PuSH hub',
                   response, response.text)
+            raise requests.HTTPError(
+                'unexpected response from PuSH hub: {}'.format(
+                    response.status_code), response=response)
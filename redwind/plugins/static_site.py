@@ -0,0 +1,176 @@
+"""Keep a static snapshot of the public pages under STATIC_SITE_PATH
+for nginx to serve to anonymous visitors.
+
+Pages are rendered by requesting them from the app as an anonymous
+user, so the snapshot matches what logged-out visitors would see, and
+written to <path>/index.html (or index.atom for ?feed=atom). Only the
+first page of each listing is stored; older pages, search and
+everything else fall through to the app.
+
+Once a saved post has been through the publish pipeline (so its
+syndication links and place name are in), and when a post is deleted
+or receives a mention, its permalink and the listings it appears on
+are re-rendered in a background job, as well as those it was on
+before an edit changed its path, type or tags.
+scripts/build_static_site.py rebuilds everything in parallel.
+"""
+from flask import current_app
+from redwind import hooks
+from redwind.models import Post, Tag, get_settings
+from redwind.views import POST_TYPES
+from werkzeug.datastructures import MultiDict
+import multiprocessing
+import os
+import tempfile
+import urllib.parse
+
+# the app each worker process renders with
+_worker_app = None
+
+
+def register(app):
+    if not app.config.get('STATIC_SITE_PATH'):
+        # don't queue a job on every save for nothing
+        return
+    # already in the publish job
+    hooks.register('post-published', on_post_changed)
+    hooks.register('post-deleted', on_post_changed, background=True)
+    hooks.register('mention-received', on_mention_received, background=True)
+
+
+def on_post_changed(post, args):
+    if post and current_app.config.get('STATIC_SITE_PATH'):
+        regenerate(post, previous_urls(args))
+
+
+def on_mention_received(post):
+    if post and current_app.config.get('STATIC_SITE_PATH'):
+        regenerate(post)
+
+
+def regenerate(post, previous=()):
+    urls = urls_for_post(post)
+    return render_pages(urls + [url for url in previous if url not in urls])
+
+
+def permalink_url(post):
+    return '/' + post.path
+
+
+def listing_urls(post):
+    """The first page of every listing post may appear on, their feeds,
+    and the tag cloud
+    """
+    return with_feeds(
+        ['/', '/everything/']
+        + ['/{}/'.format(plural) for post_type, plural, _ in POST_TYPES
+           if post_type == post.post_type]
+        + [tag_url(tag.name) for tag in post.tags]) + ['/tags/']
+
+
+def urls_for_post(post):
+    return [permalink_url(post)] + listing_urls(post)
+
+
+def previous_urls(args):
+    """The permalink and listings of the post before it was edited,
+    from the previous-* hook arguments
+    """
+    args = MultiDict(args)
+    urls = []
+    if args.get('previous-path'):
+        urls.append('/' + args['previous-path'])
+    return urls + with_feeds(
+        ['/{}/'.format(plural) for post_type, plural, _ in POST_TYPES
+         if post_type == args.get('previous-post-type')]
+        + [tag_url(name) for name in args.getlist('previous-tag')])
+
+
+def all_urls():
+    """Every page in a full snapshot"""
+    tags = Tag.query.with_entities(Tag.name).order_by(Tag.name)
+    paths = Post.query.with_entities(Post.path)\
+                      .filter_by(deleted=False, draft=False)\
+                      .order_by(Post.id)
+    return with_feeds(
+        ['/', '/everything/']
+        + ['/{}/'.format(plural) for _, plural, _ in POST_TYPES]
+        + [tag_url(name) for name, in tags]) + ['/tags/'] + [
+            '/' + path for path, in paths if path]
+
+
+def tag_url(name):
+    return '/tags/{}/'.format(urllib.parse.quote(name))
+
+
+def with_feeds(listings):
+    urls = []
+    for listing in listings:
+        urls += [listing, listing + '?feed=atom']
+    return urls
+
+
+def output_path(url):
+    """Where the snapshot of url is stored"""
+    path, _, query = url.partition('?')
+    filename = 'index.atom' if query == 'feed=atom' else 'index.html'
+    return os.path.join(current_app.config['STATIC_SITE_PATH'],
+                        urllib.parse.unquote(path).strip('/'), filename)
+
+
+def render_pages(urls):
+    """Render each url as an anonymous visitor would see it and store
+    it, or remove the stored copy if it is no longer a public page.
+
+    :return: the number of pages written
+    """
+    client = current_app.test_client()
+    base_url = get_settings().site_url
+    written = 0
+    for url in urls:
+        path, _, query = url.partition('?')
+        rv = client.get(path, query_string=query, base_url=base_url)
+        dest = output_path(url)
+        if rv.status_code == 200:
+            write_atomically(dest, rv.get_data())
+            written += 1
+        elif os.path.exists(dest):
+            # deleted, redirected or friends-only
+            os.remove(dest)
+    return written
+
+
+def write_atomically(dest, data):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(dest))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(temp, 0o644)
+    os.replace(temp, dest)
+
+
+def build_all(processes=None, chunk_size=50):
+    """Render every page, split across worker processes.
+
+    :return: the number of pages written
+    """
+    urls = all_urls()
+    chunks = [urls[ii:ii + chunk_size]
+              for ii in range(0, len(urls), chunk_size)]
+    if processes == 1:
+        return sum(render_pages(chunk) for chunk in chunks)
+
+    pool = multiprocessing.Pool(
+        processes, _init_worker, (current_app.config['CONFIG_FILE'],))
+    try:
+        return sum(pool.imap_unordered(render_pages, chunks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _init_worker(config_file):
+    global _worker_app
+    from redwind import create_app
+    _worker_app = create_app(config_file)
+    _worker_app.app_context().push()
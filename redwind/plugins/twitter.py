@@ -1,5 +1,4 @@
-from redwind import hooks, util
-from redwind.tasks import get_queue, async_app_context
+from redwind import hooks, pipeline, util
 from redwind.models import Post, Context, Setting, get_settings
 from redwind.extensions import db
 
@@ -8,8 +7,8 @@ from flask import request, redirect, url_for, make_response, render_template
 from flask import flash, abort, has_request_context, Blueprint, current_app
 from flask import jsonify
 
-import brevity
 import collections
+import functools
 import requests
 import re
 import json
@@ -17,8 +16,6 @@ import datetime
 
 from tempfile import mkstemp
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
-from requests_oauthlib import OAuth1Session, OAuth1
 
 twitter = Blueprint('twitter', __name__)
 
@@ -37,7 +34,7 @@ USERMENTION_RE = util.AT_USERNAME_RE
 def register(app):
     app.register_blueprint(twitter)
     hooks.register('create-context', create_context)
-    hooks.register('post-saved', send_to_twitter)
+    pipeline.register(plan_twitter)
 
 
 @twitter.context_processor
@@ -52,6 +49,7 @@ def inject_settings_variable():
 def authorize_twitter():
     """Get an access token from Twitter and redirect to the
        authentication page"""
+    from requests_oauthlib import OAuth1Session
     callback_url = url_for('.twitter_callback', _external=True)
     try:
         oauth = OAuth1Session(
@@ -70,6 +68,7 @@ def authorize_twitter():
 def twitter_callback():
     """Receive the request token from Twitter and convert it to an
        access token"""
+    from requests_oauthlib import OAuth1Session
     try:
         oauth = OAuth1Session(
             client_key=get_settings().twitter_api_key,
@@ -93,6 +92,7 @@ def twitter_callback():
 def collect_images(post):
     """collect the images (if any) that are in an <img> tag
     in the rendered post"""
+    from bs4 import BeautifulSoup
 
     if type(post) == Post and post.attachments:
         for photo in post.attachments:
@@ -114,54 +114,45 @@ def collect_images(post):
                         yield urljoin(get_settings().site_url, src)
 
 
-def send_to_twitter(post, args):
-    """Share a note to twitter without user-input. Makes a best-effort
-    attempt to guess the appropriate parameters and content
-    """
+def plan_twitter(post, args):
     if 'twitter' in args.getlist('syndicate-to'):
-        if not is_twitter_authorized():
-            return False, 'Current user is not authorized to tweets'
+        return [pipeline.Stage(
+            'twitter', functools.partial(send_to_twitter, post), None,
+            serial=True)]
 
-        try:
-            current_app.logger.debug('auto-posting to twitter %r', post.id)
-            get_queue().enqueue(
-                do_send_to_twitter, post.id, current_app.config['CONFIG_FILE'])
-            return True, 'Success'
 
-        except Exception as e:
-            current_app.logger.exception('auto-posting to twitter')
-            return (False, 'Exception while auto-posting to twitter: {}'
-                    .format(e))
+def send_to_twitter(post):
+    """Share a note to twitter without user-input. Makes a best-effort
+    attempt to guess the appropriate parameters and content
+    """
+    if not is_twitter_authorized():
+        raise RuntimeError('Current user is not authorized to tweet')
 
+    current_app.logger.debug('auto-posting to twitter for %s', post.id)
+    in_reply_to, repost_of, like_of = util.posse_post_discovery(
+        post, PERMALINK_RE)
 
-def do_send_to_twitter(post_id, app_config):
-    with async_app_context(app_config):
-        current_app.logger.debug('auto-posting to twitter for %s', post_id)
-        post = Post.load_by_id(post_id)
-
-        in_reply_to, repost_of, like_of = util.posse_post_discovery(
-            post, PERMALINK_RE)
-
-        # cowardly refuse to auto-POSSE a reply/repost/like when the
-        # target tweet is not found.
-        if post.in_reply_to and not in_reply_to:
-            current_app.logger.warn(
-                'could not find tweet to reply to for %s', post.in_reply_to)
-            return None
-        elif post.repost_of and not repost_of:
-            current_app.logger.warn(
-                'could not find tweet to repost for %s', post.repost_of)
-            preview, img_url = guess_raw_share_tweet_content(post)
-        elif post.like_of and not like_of:
-            current_app.logger.warn(
-                'could not find tweet to like for %s', post.like_of)
-            return None
-        else:
-            preview, img_url = guess_tweet_content(post, in_reply_to)
+    # cowardly refuse to auto-POSSE a reply/repost/like when the
+    # target tweet is not found.
+    if post.in_reply_to and not in_reply_to:
+        current_app.logger.warn(
+            'could not find tweet to reply to for %s', post.in_reply_to)
+        return 'could not find tweet to reply to'
+    elif post.repost_of and not repost_of:
+        current_app.logger.warn(
+            'could not find tweet to repost for %s', post.repost_of)
+        preview, img_url = guess_raw_share_tweet_content(post)
+    elif post.like_of and not like_of:
+        current_app.logger.warn(
+            'could not find tweet to like for %s', post.like_of)
+        return 'could not find tweet to like'
+    else:
+        preview, img_url = guess_tweet_content(post, in_reply_to)
 
-        response = do_tweet(post_id, preview, img_url, in_reply_to, repost_of,
-                            like_of)
-        return str(response)
+    twitter_url = handle_new_or_edit(
+        post, preview, img_url, in_reply_to, repost_of, like_of)
+    db.session.commit()
+    return twitter_url
 
 
 @twitter.route('/share_on_twitter', methods=['GET', 'POST'])
@@ -229,6 +220,7 @@ def format_markdown_as_tweet(data):
 
 
 def get_auth():
+    from requests_oauthlib import OAuth1
     return OAuth1(
         client_key=get_settings().twitter_api_key,
         client_secret=get_settings().twitter_api_secret,
@@ -383,6 +375,7 @@ def guess_tweet_content(post, in_reply_to):
     """Best guess effort to generate tweet content for a post; useful for
     auto-filling the share form.
     """
+    import brevity
     preview = ''
     if post.title:
         preview += post.title
@@ -448,6 +441,7 @@ def guess_tweet_content(post, in_reply_to):
 
 
 def guess_raw_share_tweet_content(post):
+    import brevity
     preview = ''
     if not post.repost_contexts:
         current_app.logger.debug(
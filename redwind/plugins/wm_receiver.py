@@ -1,22 +1,30 @@
-from bs4 import BeautifulSoup
 from flask import current_app
 from flask import request, make_response, render_template, url_for, Blueprint
 from redwind import hooks
+from redwind import metrics
 from redwind import util
 from redwind.extensions import db
 from redwind.models import Post, Mention, get_settings
 from redwind.tasks import get_queue, async_app_context
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
 import datetime
-import mf2py
+import hashlib
+import json
 import mf2util
 import re
 import requests
 import urllib.parse
-import urllib.request
 
 wm_receiver = Blueprint('wm_receiver', __name__)
 
+# job id of the queued, not yet started job for a (source, target) pair
+PENDING_KEY = 'redwind:webmention:pending:{}'
+# source ETag and response of the last job for a pair
+RECENT_KEY = 'redwind:webmention:recent:{}'
+PENDING_TTL = 24 * 60 * 60
+DEFAULT_COALESCE_WINDOW = 5 * 60
+
 
 class MentionResult:
     def __init__(self, mention, create):
@@ -25,12 +33,15 @@ class MentionResult:
 
 
 class ProcessResult:
-    def __init__(self, post=None, is_person_mention=False, error=None, delete=False):
+    def __init__(self, post=None, is_person_mention=False, error=None,
+                 delete=False, unchanged=False):
         self.post = post
         self.is_person_mention = is_person_mention
         self.error = error
         self.delete = delete
+        self.unchanged = unchanged
         self.mention_results = []
+        self.source_etag = None
 
     def add_mention(self, mention, create):
         self.mention_results.append(MentionResult(mention, create))
@@ -64,8 +75,16 @@ def receive_webmention():
     current_app.logger.debug(
         "Webmention from %s to %s received", source, target)
 
-    job = get_queue().enqueue(
-        do_process_webmention, source, target, callback, current_app.config['CONFIG_FILE'])
+    job = find_pending_job(source, target, callback)
+    if job:
+        current_app.logger.debug(
+            'Webmention from %s to %s is already queued as %s',
+            source, target, job.id)
+    else:
+        job = get_queue().enqueue(
+            do_process_webmention, source, target, callback,
+            current_app.config['CONFIG_FILE'])
+        remember_pending_job(source, target, job)
     status_url = url_for('.webmention_status', key=job.id, _external=True)
 
     return make_response(
@@ -97,58 +116,102 @@ def webmention_status(key):
         rv.get('response_code', 400))
 
 
-def do_process_webmention(source, target, callback, app_config):
-    def call_callback(result):
-        if callback:
-            requests.post(callback, data=result)
-    with async_app_context(app_config):
-        try:
-            result = interpret_mention(source, target)
+def pair_key(source, target):
+    return hashlib.sha1('{}\n{}'.format(source, target).encode()).hexdigest()
 
-            if result.error:
-                current_app.logger.warn(
-                    'Failed to process webmention: %s', result.error)
-                response = {
-                    'source': source,
-                    'target': target,
-                    'response_code': 400,
-                    'status': 'error',
-                    'reason': result.error
-                }
-                call_callback(response)
-                return response
 
-            if result.post and result.delete:
-                result.post.mentions = [m for m in result.post.mentions if
-                                        m.url != source]
-            elif result.post:
-                result.post.mentions.extend(result.mentions)
+def find_pending_job(source, target, callback):
+    """A queued job for the same source, target and callback that has
+    not started yet, and so will see the source as it is now
+    """
+    from redis.exceptions import RedisError
+    queue = get_queue()
+    try:
+        job_id = queue.connection.get(PENDING_KEY.format(
+            pair_key(source, target)))
+        job = job_id and queue.fetch_job(job_id.decode())
+    except RedisError as e:
+        current_app.logger.warn('could not look up pending webmention: %s', e)
+        return None
+    if job and job.is_queued and job.args[2] == callback:
+        return job
 
-            elif result.is_person_mention:
-                db.session.add_all(result.mentions)
 
-            db.session.commit()
-            current_app.logger.debug("saved mentions to %s", result.post.path if result.post else '/')
+def remember_pending_job(source, target, job):
+    from redis.exceptions import RedisError
+    try:
+        get_queue().connection.set(PENDING_KEY.format(
+            pair_key(source, target)), job.id, ex=PENDING_TTL)
+    except RedisError as e:
+        current_app.logger.warn('could not store pending webmention: %s', e)
 
-            hooks.fire('mention-received', post=result.post)
-            for mres in result.mention_results:
-                if mres.create:
-                    send_push_notification(result.post, result.is_person_mention,
-                                           mres.mention, app_config)
 
-            response = {
-                'source': source,
-                'target': target,
-                'response_code': 200,
-                'status': 'success',
-                'reason': 'Deleted' if result.delete
-                else 'Created' if any(mres.create for mres
-                                      in result.mention_results)
-                else 'Updated'
-            }
+def forget_pending_job(source, target):
+    from redis.exceptions import RedisError
+    try:
+        get_queue().connection.delete(PENDING_KEY.format(
+            pair_key(source, target)))
+    except RedisError as e:
+        current_app.logger.warn('could not clear pending webmention: %s', e)
+
+
+def load_recent_result(source, target):
+    """The source ETag and response of a job for this pair that finished
+    within WEBMENTION_COALESCE_WINDOW seconds, or None
+    """
+    from redis.exceptions import RedisError
+    try:
+        recent = get_queue().connection.get(
+            RECENT_KEY.format(pair_key(source, target)))
+    except RedisError as e:
+        current_app.logger.warn('could not load recent webmention: %s', e)
+        return None
+    return recent and json.loads(recent.decode())
+
+
+def store_recent_result(source, target, etag, response):
+    from redis.exceptions import RedisError
+    window = current_app.config.get('WEBMENTION_COALESCE_WINDOW',
+                                    DEFAULT_COALESCE_WINDOW)
+    if not etag or not window:
+        return
+    try:
+        get_queue().connection.set(
+            RECENT_KEY.format(pair_key(source, target)),
+            json.dumps({'etag': etag, 'response': response}), ex=window)
+    except RedisError as e:
+        current_app.logger.warn('could not store recent webmention: %s', e)
 
-            call_callback(response)
-            return response
+
+@metrics.timed_job
+def do_process_webmention(source, target, callback, app_config):
+    with async_app_context(app_config):
+        # this job is under way, so mentions received from now on
+        # need a job of their own
+        forget_pending_job(source, target)
+
+        recent = load_recent_result(source, target)
+        try:
+            result = interpret_mention(source, target,
+                                       etag=recent and recent['etag'])
+            if result.unchanged:
+                current_app.logger.debug(
+                    'Webmention source %s is unchanged since it was last '
+                    'processed', source)
+                response = recent['response'] if recent else {
+                    'source': source,
+                    'target': target,
+                    'response_code': 200,
+                    'status': 'success',
+                    'reason': 'Updated',
+                }
+            else:
+                response = save_mention_result(source, target, result,
+                                               app_config)
+                # saved, or an error the same source will give again;
+                # never a failure that might not happen next time
+                store_recent_result(source, target, result.source_etag,
+                                    response)
 
         except Exception as e:
             current_app.logger.exception(
@@ -160,8 +223,52 @@ def do_process_webmention(source, target, callback, app_config):
                 'status': 'error',
                 'reason': "exception while processing webmention {}".format(e)
             }
-            call_callback(response)
-            return response
+
+        if callback:
+            requests.post(callback, data=response)
+        return response
+
+
+def save_mention_result(source, target, result, app_config):
+    if result.error:
+        current_app.logger.warn(
+            'Failed to process webmention: %s', result.error)
+        return {
+            'source': source,
+            'target': target,
+            'response_code': 400,
+            'status': 'error',
+            'reason': result.error
+        }
+
+    if result.post and result.delete:
+        result.post.mentions = [m for m in result.post.mentions if
+                                m.url != source]
+    elif result.post:
+        result.post.mentions.extend(result.mentions)
+
+    elif result.is_person_mention:
+        db.session.add_all(result.mentions)
+
+    db.session.commit()
+    current_app.logger.debug("saved mentions to %s", result.post.path if result.post else '/')
+
+    hooks.fire('mention-received', post=result.post)
+    for mres in result.mention_results:
+        if mres.create:
+            send_push_notification(result.post, result.is_person_mention,
+                                   mres.mention, app_config)
+
+    return {
+        'source': source,
+        'target': target,
+        'response_code': 200,
+        'status': 'success',
+        'reason': 'Deleted' if result.delete
+        else 'Created' if any(mres.create for mres
+                              in result.mention_results)
+        else 'Updated'
+    }
 
 
 def send_push_notification(post, is_person_mention, mention, app_config):
@@ -185,7 +292,13 @@ def send_push_notification(post, is_person_mention, mention, app_config):
         })
 
 
-def interpret_mention(source, target):
+def interpret_mention(source, target, etag=None):
+    """Check that source links to target and parse the mentions in it.
+    The source is fetched with a conditional GET, using the validators
+    stored on an existing mention from it (or etag, from a recent job),
+    and the result is marked unchanged, without parsing the source, if
+    the server answers 304 or sends the same content as last time.
+    """
     current_app.logger.debug(
         'processing webmention from %s to %s', source, target)
     if target and target.strip('/') == get_settings().site_url.strip('/'):
@@ -214,7 +327,45 @@ def interpret_mention(source, target):
             error='{} and {} refer to the same post'.format(source, target))
 
     # confirm that source actually refers to the post
-    source_response = util.fetch_html(source)
+    existing = find_existing_mention(target_post, source)
+    headers = {}
+    if etag or (existing and existing.source_etag):
+        headers['If-None-Match'] = etag or existing.source_etag
+    if existing and existing.source_last_modified:
+        headers['If-Modified-Since'] = existing.source_last_modified
+    source_response = util.fetch_html(source, headers=headers)
+    if source_response.status_code == 304:
+        return ProcessResult(post=target_post, unchanged=True)
+
+    source_hash = source_response.status_code // 100 == 2 \
+        and hashlib.sha256(source_response.content or b'').hexdigest()
+    if existing and source_hash and existing.source_hash == source_hash:
+        return ProcessResult(post=target_post, unchanged=True)
+
+    result = interpret_source(source, target, source_response, target_post,
+                              target_urls, is_person_mention)
+    if source_hash:
+        # only a source we could read is worth remembering
+        result.source_etag = source_response.headers.get('ETag')
+    for mention in result.mentions:
+        if mention.url == source:
+            mention.source_etag = result.source_etag
+            mention.source_last_modified = source_response.headers.get(
+                'Last-Modified')
+            mention.source_hash = source_hash
+    return result
+
+
+def find_existing_mention(target_post, source):
+    """The mention saved from source last time, if any"""
+    if target_post:
+        return next((m for m in target_post.mentions if m.url == source),
+                    None)
+    return Mention.query.filter_by(url=source, person_mention=True).first()
+
+
+def interpret_source(source, target, source_response, target_post,
+                     target_urls, is_person_mention):
     current_app.logger.debug(
         'received response from source %s', source_response)
 
@@ -266,6 +417,7 @@ def interpret_mention(source, target):
 
 
 def find_http_equiv_status(source, source_response):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(source_response.text)
     meta = soup.find('meta', {
         'http-equiv': re.compile('status', re.IGNORECASE)})
@@ -280,6 +432,7 @@ def find_http_equiv_status(source, source_response):
 
 
 def find_link_to_target(source_url, source_response, target_urls):
+    from bs4 import BeautifulSoup
     if source_response.status_code // 2 != 100:
         current_app.logger.warn(
             "Received unexpected response from webmention source: %s",
@@ -296,79 +449,78 @@ def find_link_to_target(source_url, source_response, target_urls):
 
 
 def find_target_post(target_url):
+    """Find the post that target_url refers to by matching it against
+    our own url rules, without fetching it. Short links, historic paths
+    and Post.redirect are followed just as the views would redirect.
+    """
     current_app.logger.debug("looking for target post at %s", target_url)
-
-    # follow redirects if necessary
-    redirect_url = urllib.request.urlopen(target_url).geturl()
-    if redirect_url and redirect_url != target_url:
-        current_app.logger.debug("followed redirection to %s", redirect_url)
-        target_url = redirect_url
-
-    parsed_url = urllib.parse.urlparse(target_url)
-
-    if not parsed_url:
-        current_app.logger.warn(
-            "Could not parse target_url of received webmention: %s",
-            target_url)
+    seen = set()
+    while target_url not in seen:
+        seen.add(target_url)
+        post = resolve_post_url(target_url)
+        if not post:
+            current_app.logger.warn(
+                'Webmention could not find target for %s', target_url)
+            return None
+        if post.deleted:
+            current_app.logger.warn(
+                'Webmention target %s has been deleted', target_url)
+            return None
+        if not post.redirect:
+            return post
+        target_url = urllib.parse.urljoin(post.permalink, post.redirect)
+        current_app.logger.debug("followed redirection to %s", target_url)
+
+    current_app.logger.warn('Webmention target %s redirects in a loop',
+                            target_url)
+    return None
+
+
+def resolve_post_url(url):
+    """The post at url on this site, or None. Each url form maps to a
+    single indexed column lookup.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    # FIXME this is a less-than-perfect fix for hosting from a
+    # subdirectory. The url_map may have some clever work-around.
+    parsed_site_root = urllib.parse.urlparse(get_settings().site_url)
+    # either scheme, but only this site's host
+    if parsed_url.netloc.lower() != parsed_site_root.netloc.lower():
+        return None
+    site_prefix = parsed_site_root.path.rstrip('/')
+    if not parsed_url.path.startswith(site_prefix):
         return None
 
+    path = parsed_url.path[len(site_prefix):]
+    current_app.logger.debug('target path with no prefix %s', path)
+    urls = current_app.url_map.bind(get_settings().site_url)
     try:
-        # FIXME this is a less-than-perfect fix for hosting from a
-        # subdirectory. The url_map may have some clever work-around.
-        parsed_site_root = urllib.parse.urlparse(get_settings().site_url)
-        site_prefix = parsed_site_root.path
-        if site_prefix.endswith('/'):
-            site_prefix = site_prefix[:-1]
-        if not parsed_url.path.startswith(parsed_site_root.path):
-            raise NotFound
-
-        urls = current_app.url_map.bind(get_settings().site_url)
-        path = parsed_url.path[len(site_prefix):]
-        current_app.logger.debug('target path with no prefix %s', path)
-        endpoint, args = urls.match(path)
-        current_app.logger.debug(
-            'found match for target url %r: %r', endpoint, args)
-    except NotFound:
-        current_app.logger.warn(
-            'Webmention could not find target for %s', parsed_url.path)
+        try:
+            endpoint, args = urls.match(path)
+        except RequestRedirect as e:
+            # e.g. a missing trailing slash
+            endpoint, args = urls.match(urllib.parse.urlparse(e.new_url).path)
+    except HTTPException:
         return None
+    current_app.logger.debug(
+        'found match for target url %r: %r', endpoint, args)
 
-    post = None
     if endpoint == 'views.post_by_path':
-        year = args.get('year')
-        month = args.get('month')
-        slug = args.get('slug')
-        post = Post.load_by_path(
-            '{}/{:02d}/{}'.format(year, month, slug))
-
-    elif endpoint == 'views.post_by_date':
-        post_type = args.get('post_type')
-        year = args.get('year')
-        month = args.get('month')
-        day = args.get('day')
-        index = args.get('index')
-        post = Post.load_by_date(post_type, year, month, day, index)
-
-    elif endpoint == 'views.post_by_old_date':
-        post_type = args.get('post_type')
-        yymmdd = args.get('yymmdd')
-        year = int('20' + yymmdd[0:2])
-        month = int(yymmdd[2:4])
-        day = int(yymmdd[4:6])
-        post = Post.load_by_date(post_type, year, month, day, index)
-
-    elif endpoint == 'views.post_by_id':
-        dbid = args.get('dbid')
-        post = Post.load_by_id(dbid)
-
-    if not post:
-        current_app.logger.warn(
-            "Webmention target points to unknown post: {}".format(args)),
+        return Post.load_by_path('{}/{:02d}/{}'.format(
+            args['year'], args['month'], args['slug']))
+
+    if endpoint == 'views.post_by_date':
+        return Post.load_by_historic_path('{}/{}/{:02d}/{:02d}/{}'.format(
+            args['post_type'], args['year'], args['month'], args['day'],
+            args['index']))
 
-    return post
+    if endpoint == 'views.post_by_short_path':
+        return Post.load_by_short_path('{}/{}'.format(
+            args['tag'], args['tail']))
 
 
 def create_mentions(post, url, source_response, is_person_mention):
+    import mf2py
     # utility function for mf2util
     cached_mf2 = {}
 
@@ -441,6 +593,7 @@ def create_mentions(post, url, source_response, is_person_mention):
         mention.author_image = entry.get('author', {}).get('photo')
         mention.content = content
         mention.content_plain = content_plain
+        mention.update_display_html()
         mention.published = published
         mention.title = entry.get('name')
         mention.syndication = entry.get('syndication', [])
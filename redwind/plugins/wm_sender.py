@@ -1,8 +1,8 @@
 from redwind import hooks
+from redwind import pipeline
 from redwind.models import Post
 from redwind.extensions import db
-from redwind.tasks import get_queue, async_app_context
-from bs4 import BeautifulSoup
+import functools
 import re
 import requests
 import urllib
@@ -15,58 +15,39 @@ wm_sender = Blueprint('wm_sender', __name__)
 
 def register(app):
     app.register_blueprint(wm_sender)
-    hooks.register('post-saved', send_webmentions_on_save)
-    hooks.register('post-deleted', send_webmentions_on_delete)
-    hooks.register('mention-received', send_webmentions_on_comment)
+    pipeline.register(plan_webmentions)
+    hooks.register('post-deleted', send_webmentions_on_delete,
+                   background=True)
+    hooks.register('mention-received', send_webmentions_on_comment,
+                   background=True)
 
 
-def send_webmentions_on_save(post, args):
+def plan_webmentions(post, args):
     if args.get('action') in ('save_draft', 'publish_quietly'):
         current_app.logger.debug('skipping webmentions for {}'.format(post.id))
-        return
+        return []
+    target_urls = find_all_target_urls(post)
+    if target_urls:
+        return [pipeline.Stage(
+            'webmentions', functools.partial(send_mentions, post, target_urls),
+            save_sent_mentions)]
 
-    try:
-        current_app.logger.debug("queueing webmentions for {}".format(post.id))
-        get_queue().enqueue(do_send_webmentions, post.id, current_app.config['CONFIG_FILE'])
-        return True, 'Success'
 
-    except Exception as e:
-        current_app.logger.exception('sending webmentions')
-        return False, "Exception while sending webmention: {}"\
-            .format(e)
+def save_sent_mentions(post, results):
+    remember_sent_mentions(post, results)
+    return '{} of {} sent'.format(
+        len(post.sent_webmentions), len(results))
 
 
 def send_webmentions_on_delete(post, args):
-    try:
-        current_app.logger.debug("queueing deletion webmentions for %s", post.id)
-        get_queue().enqueue(do_send_webmentions, post.id, current_app.config['CONFIG_FILE'])
-        return True, 'Success'
-
-    except Exception as e:
-        current_app.logger.exception('sending deletion webmentions')
-        return False, "Exception while sending deletion webmention: {}"\
-            .format(e)
+    current_app.logger.debug("sending deletion webmentions for %s", post.id)
+    return handle_new_or_edit(post)
 
 
 def send_webmentions_on_comment(post):
-    try:
-        if post:
-            current_app.logger.debug("queueing webmentions for {}".format(post.id))
-            get_queue().enqueue(do_send_webmentions, post.id, current_app.config['CONFIG_FILE'])
-        return True, 'Success'
-
-    except Exception as e:
-        current_app.logger.exception('sending webmentions')
-        return False, "Exception while sending webmention: {}"\
-            .format(e)
-
-
-def do_send_webmentions(post_id, app_config):
-    with async_app_context(app_config):
-        current_app.logger.debug("sending mentions for {}".format(post_id))
-        post = Post.load_by_id(post_id)
-        if post:
-            return handle_new_or_edit(post)
+    if post:
+        current_app.logger.debug("sending webmentions for %s", post.id)
+        return handle_new_or_edit(post)
 
 
 @wm_sender.route('/send_webmentions', methods=['GET'])
@@ -84,6 +65,7 @@ def get_source_url(post):
 
 
 def get_target_urls(post):
+    from bs4 import BeautifulSoup
     target_urls = []
     # send mentions to 'in_reply_to' as well as all linked urls
     target_urls += post.in_reply_to
@@ -117,21 +99,28 @@ get_response.cached_responses = {}
 
 
 def handle_new_or_edit(post):
+    results = send_mentions(post, find_all_target_urls(post))
+    remember_sent_mentions(post, results)
+    db.session.commit()
+    return results
+
+
+def find_all_target_urls(post):
     target_urls = get_target_urls(post)
     # add any previously sent targets (maybe they have been removed)
     target_urls += [t for t in (post.sent_webmentions or []) if t not in target_urls]
+    return target_urls
+
 
+def send_mentions(post, target_urls):
     current_app.logger.debug(
         'Sending webmentions to these urls {}'.format(" ; ".join(target_urls)))
+    return [send_mention(post, target_url) for target_url in target_urls]
 
-    results = []
-    for target_url in target_urls:
-        results.append(send_mention(post, target_url))
 
+def remember_sent_mentions(post, results):
     # remember the successful mentions for next time
     post.sent_webmentions = [r['target'] for r in results if r['success']]
-    db.session.commit()
-    return results
 
 
 def send_mention(post, target_url):
@@ -208,6 +197,7 @@ def find_webmention_endpoint_in_http_links(links):
 
 
 def find_webmention_endpoint_in_html(body):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(body)
     link = soup.find(['a', 'link'], attrs={
         'href': True,
@@ -257,6 +247,7 @@ def supports_pingback(target_url):
 
 
 def find_pingback_endpoint(target_url):
+    from bs4 import BeautifulSoup
     response = get_response(target_url)
     endpoint = response.headers.get('x-pingback')
     if not endpoint:
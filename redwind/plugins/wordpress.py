@@ -1,6 +1,5 @@
-from redwind import hooks
-from redwind.tasks import get_queue, async_app_context
-from redwind.models import Post, Setting, get_settings
+from redwind import pipeline
+from redwind.models import Setting, get_settings
 from redwind.extensions import db
 
 from flask.ext.login import login_required
@@ -8,6 +7,7 @@ from flask import (
     request, redirect, url_for, Blueprint, current_app, make_response,
 )
 
+import functools
 import requests
 import urllib.request
 import urllib.parse
@@ -26,7 +26,7 @@ API_ME_URL = 'https://public-api.wordpress.com/rest/v1.1/me'
 
 def register(app):
     app.register_blueprint(wordpress)
-    hooks.register('post-saved', send_to_wordpress)
+    pipeline.register(plan_wordpress)
 
 
 @wordpress.route('/install_wordpress')
@@ -82,22 +82,21 @@ def authorize_wordpress():
         }))
 
 
-def send_to_wordpress(post, args):
+def plan_wordpress(post, args):
     if 'wordpress' in args.getlist('syndicate-to'):
-        get_queue().enqueue(do_send_to_wordpress, post.id, current_app.config['CONFIG_FILE'])
+        return [pipeline.Stage(
+            'wordpress', functools.partial(send_to_wordpress, post), None,
+            serial=True)]
 
 
-def do_send_to_wordpress(post_id, app_config):
-    with async_app_context(app_config):
-        post = Post.load_by_id(post_id)
-
-        if post.like_of:
-            for url in post.like_of:
-                try_post_like(url, post)
-
-        elif post.in_reply_to:
-            for url in post.in_reply_to:
-                try_post_reply(url, post)
+def send_to_wordpress(post):
+    if post.like_of:
+        wp_urls = [try_post_like(url, post) for url in post.like_of]
+    elif post.in_reply_to:
+        wp_urls = [try_post_reply(url, post) for url in post.in_reply_to]
+    else:
+        return 'nothing to share'
+    return ', '.join(url for url in wp_urls if url)
 
 
 def try_post_like(url, post):
@@ -0,0 +1,460 @@
+"""Creating and updating posts, shared by the editor (admin.save_post)
+and the micropub endpoint.
+"""
+from redwind import contexts
+from redwind import hooks
+from redwind import storage
+from redwind import util
+from redwind.extensions import db
+from redwind.models import Post, Attachment, Tag, Nick, Venue, get_settings
+from redwind.tasks import get_queue, async_app_context
+from flask import current_app
+from werkzeug import secure_filename
+from werkzeug.datastructures import MultiDict
+import datetime
+import hashlib
+import itertools
+import mf2util
+import mimetypes
+import os
+import urllib.parse
+
+
+class PostInput:
+    """The values submitted for a post, independent of whether they
+    arrived from the editor form, a micropub form or a micropub JSON
+    body.
+
+    Attributes left as None do not change an existing post. title,
+    content, hidden, friends_only, tags and people are always applied,
+    matching the editor, which always submits them.
+    """
+
+    def __init__(self, post_type=None, action=None, published=None,
+                 start=None, end=None, title='', content=None,
+                 hidden=False, friends_only=False, slug=None,
+                 venue_id=None, new_venue=None, latitude=None,
+                 longitude=None, location_name=None, in_reply_to=None,
+                 repost_of=None, like_of=None, bookmark_of=None,
+                 item=None, rating=None, syndication=None, audience=None,
+                 tags=None, people=None, files=None, photo_url=None,
+                 syndicate_to=None):
+        self.post_type = post_type
+        # one of publish, publish_quietly, publish+tweet, save_draft
+        self.action = action
+        # datetimes or strings that mf2util.parse_dt understands
+        self.published = published
+        self.start = start
+        self.end = end
+        self.title = title
+        self.content = content
+        self.hidden = hidden
+        self.friends_only = friends_only
+        self.slug = slug
+        self.venue_id = venue_id
+        # a dict with name, latitude and longitude
+        self.new_venue = new_venue
+        self.latitude = latitude
+        self.longitude = longitude
+        self.location_name = location_name
+        # lists of urls
+        self.in_reply_to = in_reply_to
+        self.repost_of = repost_of
+        self.like_of = like_of
+        self.bookmark_of = bookmark_of
+        # dict with name, author and photo
+        self.item = item
+        # an int, '' to clear it
+        self.rating = rating
+        self.syndication = syndication
+        self.audience = audience
+        self.tags = tags or []
+        self.people = people or []
+        # FileStorage objects or anything with filename, mimetype, stream
+        self.files = files or []
+        self.photo_url = photo_url
+        self.syndicate_to = syndicate_to or []
+
+    @classmethod
+    def from_form(cls, form, files):
+        """Read the fields submitted by the post editor"""
+        def opt_list(key):
+            value = form.get(key)
+            if value is not None:
+                return util.multiline_string_to_list(value)
+
+        new_venue = None
+        if (form.get('new_venue_name') and form.get('new_venue_latitude')
+                and form.get('new_venue_longitude')):
+            new_venue = {
+                'name': form.get('new_venue_name'),
+                'latitude': form.get('new_venue_latitude'),
+                'longitude': form.get('new_venue_longitude'),
+            }
+
+        item = None
+        if 'item-name' in form:
+            item = util.trim_nulls({
+                'name': form.get('item-name'),
+                'author': form.get('item-author'),
+                'photo': form.get('item-photo'),
+            })
+
+        return cls(
+            post_type=form.get('post_type'),
+            action=form.get('action'),
+            published=form.get('published'),
+            start=form.get('start'),
+            end=form.get('end'),
+            title=form.get('title', ''),
+            content=form.get('content'),
+            hidden=form.get('hidden', 'false') == 'true',
+            friends_only=form.get('friends_only', 'false') == 'true',
+            slug=form.get('slug'),
+            venue_id=form.get('venue'),
+            new_venue=new_venue,
+            latitude=form.get('latitude'),
+            longitude=form.get('longitude'),
+            location_name=form.get('location_name'),
+            in_reply_to=opt_list('in_reply_to'),
+            repost_of=opt_list('repost_of'),
+            like_of=opt_list('like_of'),
+            bookmark_of=opt_list('bookmark_of'),
+            item=item,
+            rating=form.get('rating'),
+            syndication=opt_list('syndication'),
+            audience=opt_list('audience'),
+            tags=form.getlist('tags'),
+            people=form.getlist('people'),
+            files=files.getlist('files') + files.getlist('photo'),
+            photo_url=form.get('photo'),
+            syndicate_to=form.getlist('syndicate-to'))
+
+    def hook_args(self):
+        """The arguments passed to post-saved hooks. Plugins expect
+        the editor's form field names.
+        """
+        args = MultiDict()
+        if self.action:
+            args['action'] = self.action
+        for target in self.syndicate_to:
+            args.add('syndicate-to', target)
+        return args
+
+
+class Resolver:
+    """Finds the tags, venues and contacts that posts refer to,
+    remembering each answer. A bulk import shares one Resolver across
+    all of its entries so each name is looked up (or created) once.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.venues = {}
+        self.venues_by_slug = {}
+        self.contacts = {}
+
+    def tag(self, name):
+        tag = self.tags.get(name)
+        if tag is None:
+            tag = self.tags[name] = (Tag.query.filter_by(name=name).first()
+                                     or Tag(name))
+        return tag
+
+    def venue(self, venue_id):
+        if venue_id not in self.venues:
+            self.venues[venue_id] = Venue.query.get(venue_id)
+        return self.venues[venue_id]
+
+    def venue_by_slug(self, slug):
+        if slug not in self.venues_by_slug:
+            self.venues_by_slug[slug] = Venue.query.filter_by(
+                slug=slug).first()
+        return self.venues_by_slug[slug]
+
+    def contact(self, nick):
+        if nick not in self.contacts:
+            found = Nick.query.filter_by(name=nick).first()
+            self.contacts[nick] = found and found.contact
+        return self.contacts[nick]
+
+
+def save_post(post, data):
+    """Apply data to post, render its html, store its attachments,
+    commit it and run the post-saved hooks.
+
+    :param post: a new or existing Post
+    :param data: a PostInput
+    :return: the saved post
+    """
+    was_draft = post.draft
+    hook_args = data.hook_args()
+    hook_args.update(previous_state(post))
+    apply_input(post, data, Resolver())
+
+    # fetch contexts before generating a slug
+    contexts.fetch_contexts(post)
+    update_paths(post, data, was_draft)
+
+    for infile in data.files:
+        if infile and infile.filename:
+            current_app.logger.debug('receiving uploaded file %s', infile)
+            attachment = create_attachment(
+                post, infile.filename, infile.mimetype)
+            storage.store_attachment(attachment, infile.stream)
+            post.attachments.append(attachment)
+
+    render_html(post)
+
+    if not post.id:
+        db.session.add(post)
+    db.session.commit()
+
+    current_app.logger.debug('saved post %d %s', post.id, post.permalink)
+
+    if data.photo_url:
+        # publish now and attach the photo once it has been fetched;
+        # post-saved hooks (syndication etc.) wait for the photo
+        current_app.logger.debug('queueing download of photo %s',
+                                 data.photo_url)
+        get_queue().enqueue(
+            do_fetch_photo, post.id, data.photo_url,
+            hook_args.to_dict(flat=False),
+            current_app.config['CONFIG_FILE'])
+    else:
+        hooks.fire('post-saved', post, hook_args)
+    return post
+
+
+def previous_state(post):
+    """Hook arguments describing an existing post before it is
+    edited, so plugins can update pages it is being moved off of
+    """
+    args = MultiDict()
+    if post.id:
+        args['previous-path'] = post.path
+        args['previous-post-type'] = post.post_type
+        for tag in post.tags:
+            args.add('previous-tag', tag.name)
+    return args
+
+
+def apply_input(post, data, resolver):
+    """Copy the fields of data onto post. Does not fetch contexts,
+    generate paths, render or commit.
+    """
+    was_draft = post.draft
+    if data.published:
+        post.published = parse_utc(data.published)
+
+    if data.post_type:
+        post.post_type = data.post_type
+
+    if data.start:
+        start = parse_dt(data.start)
+        if start:
+            post.start = start
+            post.start_utcoffset = start.utcoffset()
+
+    if data.end:
+        end = parse_dt(data.end)
+        if end:
+            post.end = end
+            post.end_utcoffset = end.utcoffset()
+
+    now = datetime.datetime.utcnow()
+    if not post.published or was_draft:
+        post.published = now
+    post.updated = now
+
+    post.title = data.title
+    post.content = data.content
+    post.draft = data.action == 'save_draft'
+    post.hidden = data.hidden
+    post.friends_only = data.friends_only
+
+    if data.new_venue:
+        venue = Venue()
+        venue.name = data.new_venue['name']
+        venue.location = {
+            'latitude': float(data.new_venue['latitude']),
+            'longitude': float(data.new_venue['longitude']),
+        }
+        venue.update_slug('{}-{}'.format(data.new_venue['latitude'],
+                                         data.new_venue['longitude']))
+        db.session.add(venue)
+        db.session.commit()
+        hooks.fire('venue-saved', venue, data.hook_args())
+        post.venue = venue
+
+    elif data.venue_id:
+        post.venue = resolver.venue(data.venue_id)
+
+    if data.latitude and data.longitude:
+        if post.location is None:
+            post.location = {}
+
+        post.location['latitude'] = float(data.latitude)
+        post.location['longitude'] = float(data.longitude)
+        if data.location_name is not None:
+            post.location['name'] = data.location_name
+    else:
+        post.location = None
+
+    for url_attr in ('in_reply_to', 'repost_of', 'like_of', 'bookmark_of'):
+        urls = getattr(data, url_attr)
+        if urls is not None:
+            setattr(post, url_attr, urls)
+
+    if data.item is not None:
+        post.item = data.item
+    if data.rating is not None:
+        post.rating = int(data.rating) if data.rating else None
+
+    if data.syndication is not None:
+        post.syndication = data.syndication
+
+    if data.audience is not None:
+        post.audience = data.audience
+
+    tags = list(data.tags)
+    if post.post_type != 'article' and post.content:
+        # parse out hashtags as tag links from note-like posts
+        tags += util.find_hashtags(post.content)
+    tags = list(filter(None, map(util.normalize_tag, tags)))
+    post.tags = [resolver.tag(tag) for tag in tags]
+
+    post.people = []
+    for person in data.people:
+        contact = resolver.contact(person)
+        if contact:
+            post.people.append(contact)
+
+
+def update_paths(post, data, was_draft):
+    if data.slug:
+        post.slug = util.slugify(data.slug)
+    elif not post.slug or was_draft:
+        post.slug = post.generate_slug()
+
+    generate_paths(post, was_draft)
+
+
+def render_html(post):
+    """Pre-render the post's html from its markdown content"""
+    html = util.markdown_filter(post.content, img_path=post.get_image_path())
+    html = util.autolink(html)
+    if post.post_type == 'article':
+        html = util.process_people_to_microcards(html)
+    else:
+        html = util.process_people_to_at_names(html)
+    post.content_html = html
+    post.update_display_html()
+
+
+def parse_dt(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return mf2util.parse_dt(value)
+
+
+def parse_utc(value):
+    dt = parse_dt(value)
+    if dt and dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def generate_paths(post, was_draft):
+    # events should use their start date for permalinks
+    path_date = post.start or post.published
+
+    if post.draft:
+        m = hashlib.md5()
+        m.update(bytes(path_date.isoformat() + '|' + post.slug,
+                       'utf-8'))
+        post.path = 'drafts/{}'.format(m.hexdigest())
+
+    elif not post.path or was_draft:
+        base_path = '{}/{:02d}/{}'.format(
+            path_date.year, path_date.month, post.slug)
+        # generate a unique path
+        unique_path = base_path
+        idx = 1
+        while Post.load_by_path(unique_path):
+            unique_path = '{}-{}'.format(base_path, idx)
+            idx += 1
+        post.path = unique_path
+
+    # generate short path
+    if not post.short_path:
+        short_base = '{}/{}'.format(
+            util.tag_for_post_type(post.post_type),
+            util.base60_encode(util.date_to_ordinal(path_date)))
+        short_paths = set(
+            row[0] for row in db.session.query(Post.short_path).filter(
+                Post.short_path.startswith(short_base)).all())
+        for idx in itertools.count(1):
+            post.short_path = short_base + util.base60_encode(idx)
+            if post.short_path not in short_paths:
+                break
+
+
+def do_fetch_photo(post_id, photo_url, hook_args, app_config):
+    with async_app_context(app_config):
+        post = Post.load_by_id(post_id)
+        if not post:
+            return
+        if fetch_photo(post, photo_url):
+            db.session.commit()
+
+        # hooks build absolute urls, so they need a request context
+        with current_app.test_request_context(
+                base_url=get_settings().site_url):
+            hooks.fire('post-saved', post, MultiDict(hook_args))
+
+
+def fetch_photo(post, photo_url):
+    """Download photo_url into storage and attach it to post, without
+    committing. Returns False, having logged why, if it could not be
+    fetched.
+    """
+    current_app.logger.debug('downloading photo from url %s', photo_url)
+    try:
+        storage_path, content_hash, mimetype = storage.store_url(
+            photo_url, storage.max_upload_size())
+    except Exception:
+        current_app.logger.exception(
+            'could not fetch photo %s for post %s', photo_url, post.id)
+        return False
+    filename = os.path.basename(urllib.parse.urlparse(photo_url).path)
+    attachment = create_attachment(post, filename, mimetype)
+    attachment.storage_path = storage_path
+    attachment.content_hash = content_hash
+    post.attachments.append(attachment)
+    return True
+
+
+def create_attachment(post, filename, mimetype=None, default_ext=None):
+    filename = secure_filename(filename)
+    basename, ext = os.path.splitext(filename)
+    if not mimetype:
+        mimetype, _ = mimetypes.guess_type(filename)
+
+    # special handling for ugly filenames from OwnYourGram
+    if basename.startswith('tmp_') and ext.lower() in ('.png', '.jpg'):
+        basename = 'photo'
+
+    idx = 0
+    while True:
+        if idx == 0:
+            filename = '{}{}'.format(basename, ext)
+        else:
+            filename = '{}-{}{}'.format(basename, idx, ext)
+        if filename not in [a.filename for a in post.attachments]:
+            break
+        idx += 1
+
+    # storage_path is filled in by storage.store_attachment
+    return Attachment(filename=filename,
+                      mimetype=mimetype)
@@ -0,0 +1,239 @@
+"""On-demand sampling profiler, for finding slow code on the live site.
+
+With PROFILER = True in the config, an admin can start profiling from
+/profiler: either the next N requests or a percentage of requests,
+optionally only those for one endpoint. While a chosen request runs, a
+background thread looks at its stack every few milliseconds, and the
+sampled stacks are added up in Redis, so every worker process shares
+one plan and one set of results. They are downloaded in the collapsed
+format that flamegraph.pl and speedscope read.
+
+When nothing is being profiled, each request costs one check of a
+locally cached copy of the plan, refreshed from Redis every
+PROFILER_POLL_INTERVAL seconds.
+"""
+from flask import Blueprint, Response, current_app, g, request
+from flask import flash, render_template, redirect, url_for
+import collections
+import flask.ext.login as flask_login
+import os
+import random
+import sys
+import threading
+import time
+
+profiler = Blueprint('profiler', __name__)
+
+PLAN_KEY = 'redwind:profiler:plan'
+REMAINING_KEY = 'redwind:profiler:remaining'
+STACKS_KEY = 'redwind:profiler:stacks'
+REQUESTS_KEY = 'redwind:profiler:requests'
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_POLL_INTERVAL = 2
+
+# this process's copy of the plan, and when it was read
+_plan = None
+_plan_read = None
+
+
+class Sampler:
+    """Samples the stacks of registered threads from a background
+    thread, which runs only while at least one thread is registered
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, thread_id):
+        counts = collections.Counter()
+        with self.lock:
+            self.active[thread_id] = counts
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return counts
+
+    def stop(self, thread_id):
+        with self.lock:
+            return self.active.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                for thread_id, counts in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame:
+                        counts[collapse(frame)] += 1
+
+
+_sampler = Sampler()
+
+
+def frame_name(code):
+    path = code.co_filename.split(os.sep)
+    return '{} ({}:{})'.format(code.co_name, '/'.join(path[-2:]),
+                               code.co_firstlineno)
+
+
+def collapse(frame):
+    """The stack ending at frame, outermost call first, separated by
+    semicolons
+    """
+    names = []
+    while frame:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def redis_connection():
+    from redwind.tasks import get_queue
+    return get_queue().connection
+
+
+def init_app(app):
+    if app.config.get('PROFILER'):
+        app.register_blueprint(profiler)
+        app.before_request(start_request)
+        app.teardown_request(finish_request)
+
+
+def current_plan():
+    """The active plan as a dict of endpoint, percent and requests, or
+    None. Read from Redis at most once per poll interval.
+    """
+    global _plan, _plan_read
+    from redis.exceptions import RedisError
+    now = time.monotonic()
+    interval = current_app.config.get('PROFILER_POLL_INTERVAL',
+                                      DEFAULT_POLL_INTERVAL)
+    if _plan_read is not None and now - _plan_read < interval:
+        return _plan
+    _plan_read = now
+    try:
+        plan = redis_connection().hgetall(PLAN_KEY)
+    except RedisError as e:
+        current_app.logger.warn('could not load the profiler plan: %s', e)
+        plan = None
+    _plan = plan and {k.decode(): v.decode() for k, v in plan.items()}
+    return _plan
+
+
+def should_profile(plan, endpoint):
+    if plan.get('endpoint') and plan['endpoint'] != endpoint:
+        return False
+    if plan.get('percent'):
+        return random.random() * 100 < float(plan['percent'])
+    if plan.get('requests'):
+        if redis_connection().decr(REMAINING_KEY) >= 0:
+            return True
+        # used up; let the other workers know at their next poll
+        stop()
+    return False
+
+
+def start_request():
+    plan = current_plan()
+    if plan and should_profile(plan, request.endpoint):
+        g.profiler_counts = _sampler.start(threading.get_ident())
+
+
+def finish_request(exc=None):
+    from redis.exceptions import RedisError
+    if getattr(g, 'profiler_counts', None) is None:
+        return
+    counts = _sampler.stop(threading.get_ident())
+    g.profiler_counts = None
+    # one root frame per endpoint, so each can be viewed separately
+    root = request.endpoint or 'none'
+    pipe = redis_connection().pipeline()
+    for stack, count in counts.items():
+        pipe.hincrby(STACKS_KEY, root + ';' + stack, count)
+    pipe.incr(REQUESTS_KEY)
+    try:
+        pipe.execute()
+    except RedisError as e:
+        current_app.logger.warn('could not store profile samples: %s', e)
+
+
+def start(requests=None, percent=None, endpoint=None):
+    """Profile the next `requests` requests, or `percent` percent of
+    requests, for endpoint or for all endpoints
+    """
+    global _plan_read
+    pipe = redis_connection().pipeline()
+    pipe.delete(PLAN_KEY, REMAINING_KEY)
+    pipe.hmset(PLAN_KEY, {
+        'endpoint': endpoint or '',
+        'percent': percent or '',
+        'requests': requests or '',
+    })
+    if requests:
+        pipe.set(REMAINING_KEY, requests)
+    pipe.execute()
+    _plan_read = None
+
+
+def stop():
+    global _plan_read
+    redis_connection().delete(PLAN_KEY, REMAINING_KEY)
+    _plan_read = None
+
+
+def clear():
+    redis_connection().delete(STACKS_KEY, REQUESTS_KEY)
+
+
+def collapsed_stacks():
+    """Sampled stacks and their counts, one per line"""
+    stacks = redis_connection().hgetall(STACKS_KEY)
+    return ''.join('{} {}\n'.format(stack.decode(), int(count))
+                   for stack, count in sorted(stacks.items()))
+
+
+@profiler.route('/profiler', methods=['GET', 'POST'])
+@flask_login.login_required
+def profiler_page():
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'start':
+            requests = request.form.get('requests', type=int)
+            percent = request.form.get('percent', type=float)
+            if (requests and requests > 0) or (percent and 0 < percent <= 100):
+                start(requests=requests, percent=percent,
+                      endpoint=request.form.get('endpoint'))
+            else:
+                flash('Enter a number of requests, or a percentage between '
+                      '0 and 100, to profile')
+        elif action == 'stop':
+            stop()
+        elif action == 'clear':
+            clear()
+        return redirect(url_for('.profiler_page'))
+
+    conn = redis_connection()
+    plan = conn.hgetall(PLAN_KEY)
+    return render_template(
+        'admin/profiler.jinja2',
+        plan=plan and {k.decode(): v.decode() for k, v in plan.items()},
+        remaining=max(0, int(conn.get(REMAINING_KEY) or 0)),
+        profiled=int(conn.get(REQUESTS_KEY) or 0),
+        stacks=conn.hlen(STACKS_KEY),
+        endpoints=sorted(set(rule.endpoint for rule
+                             in current_app.url_map.iter_rules())))
+
+
+@profiler.route('/profiler/stacks')
+@flask_login.login_required
+def download_stacks():
+    return Response(collapsed_stacks(), mimetype='text/plain', headers={
+        'Content-Disposition': 'attachment; filename=redwind-profile.txt',
+    })
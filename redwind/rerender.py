@@ -0,0 +1,120 @@
+"""Re-render every post's content_html (and content_display) through the
+same pipeline save_post uses, e.g. after changing markdown extensions,
+contacts and nicks, or the site url.
+
+Posts are read a chunk at a time, only the columns rendering needs,
+and rendered by a pool of worker processes, each with its own app.
+Only rows whose output changed are written back.
+"""
+from redwind import create_app
+from redwind import posts
+from redwind.extensions import db
+from redwind.models import Post, get_settings
+from flask import current_app
+import collections
+import multiprocessing
+import sqlalchemy
+import time
+
+CHUNK_SIZE = 200
+
+# the app each worker process renders with
+_worker_app = None
+
+
+def rerender_all(processes=None, chunk_size=CHUNK_SIZE, report=None):
+    """Re-render all posts.
+
+    :param processes: the number of worker processes; defaults to the
+      number of CPUs. With 1, posts are rendered in this process.
+    :param report: called with a stats dict after each chunk is written
+    :return: the final stats dict
+    """
+    processes = processes or multiprocessing.cpu_count()
+    stats = {'rendered': 0, 'changed': 0, 'elapsed': 0.0, 'per_second': 0.0}
+    start = time.perf_counter()
+
+    def write(changes, count):
+        if changes:
+            table = Post.__table__
+            db.session.execute(
+                table.update()
+                .where(table.c.id == sqlalchemy.bindparam('post_id'))
+                .values(content_html=sqlalchemy.bindparam('html'),
+                        content_display=sqlalchemy.bindparam('display')),
+                changes)
+            db.session.commit()
+        stats['rendered'] += count
+        stats['changed'] += len(changes)
+        stats['elapsed'] = time.perf_counter() - start
+        stats['per_second'] = stats['rendered'] / stats['elapsed']
+        if report:
+            report(dict(stats))
+
+    if processes == 1:
+        for rows in iter_chunks(chunk_size):
+            write(render_rows(rows), len(rows))
+        return stats
+
+    pool = multiprocessing.Pool(
+        processes, _init_worker, (current_app.config['CONFIG_FILE'],))
+    try:
+        # keep a few chunks in flight, rather than reading every post
+        # into memory to queue them up
+        pending = collections.deque()
+        for rows in iter_chunks(chunk_size):
+            pending.append((pool.apply_async(render_rows, (rows,)),
+                            len(rows)))
+            if len(pending) >= 2 * processes:
+                result, count = pending.popleft()
+                write(result.get(), count)
+        while pending:
+            result, count = pending.popleft()
+            write(result.get(), count)
+    finally:
+        pool.close()
+        pool.join()
+    return stats
+
+
+def iter_chunks(chunk_size):
+    """Yield lists of (id, post_type, path, content, content_html,
+    content_display) tuples in id order.
+    """
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Post.id, Post.post_type, Post.path, Post.content,
+            Post.content_html, Post.content_display
+        ).filter(Post.id > last_id).order_by(Post.id).limit(chunk_size).all()
+        if not rows:
+            break
+        yield [tuple(row) for row in rows]
+        last_id = rows[-1][0]
+
+
+def render_rows(rows):
+    """Render each row and return the changed ones, as dicts of
+    post_id, html and display.
+    """
+    changes = []
+    for post_id, post_type, path, content, old_html, old_display in rows:
+        # a throwaway Post, never added to the session
+        post = Post(post_type)
+        post.path = path
+        post.content = content
+        posts.render_html(post)
+        if (post.content_html, post.content_display) != (old_html,
+                                                         old_display):
+            changes.append({'post_id': post_id, 'html': post.content_html,
+                            'display': post.content_display})
+    return changes
+
+
+def _init_worker(config_file):
+    global _worker_app
+    _worker_app = create_app(config_file)
+    _worker_app.app_context().push()
+    # people processing builds urls with url_for
+    _worker_app.test_request_context(
+        base_url=get_settings().site_url).push()
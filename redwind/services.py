@@ -3,10 +3,8 @@ from . import util
 from .models import Venue
 from .views import geo_name
 
-from bs4 import BeautifulSoup
 from flask import request, jsonify, redirect, url_for, Blueprint, current_app, render_template
 import datetime
-import mf2py
 import mf2util
 import requests
 import sys
@@ -18,6 +16,7 @@ USER_AGENT = 'Red Wind (https://github.com/kylewm/redwind)'
 
 @services.route('/services/fetch_profile')
 def fetch_profile():
+    import mf2py
     url = request.args.get('url')
     if not url:
         return """
@@ -113,6 +112,7 @@ def youtube_shortener(video, slug):
 
 @services.route('/services/youtube/')
 def create_youtube_link():
+    from bs4 import BeautifulSoup
     url = request.args.get('url')
     if url:
         m = util.YOUTUBE_RE.match(url)
@@ -0,0 +1,139 @@
+"""Count the SQL queries each request issues.
+
+With SQL_STATS enabled, every response gets X-Query-Count and
+X-Query-Time headers and a log line, and statements that run several
+times in one request (usually a lazy load inside a template loop) are
+logged as likely N+1 queries. Statements are grouped by fingerprint:
+the SQL with whitespace and IN lists collapsed, so the same query with
+different parameters counts as a repeat.
+
+count_queries() records the queries issued inside a with block, with
+or without a request, e.g. to hold a view to a query budget in tests.
+"""
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import collections
+import contextlib
+import re
+import time
+
+# report statements repeated at least this many times in one request
+DEFAULT_REPEATED_THRESHOLD = 5
+
+# recorders active outside of requests, see count_queries
+_recorders = []
+_installed = False
+
+IN_LIST_RE = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+'
+                        r'\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    return IN_LIST_RE.sub('(?)', WHITESPACE_RE.sub(' ', statement).strip())
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = collections.Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[fingerprint(statement)] += 1
+
+    def repeated(self, threshold=2):
+        """Statements run at least threshold times, most frequent first,
+        as (fingerprint, count) pairs
+        """
+        return [(stmt, count) for stmt, count in self.statements.most_common()
+                if count >= threshold]
+
+    def report(self):
+        lines = ['{} queries in {:.1f}ms'.format(
+            self.count, 1000 * self.duration)]
+        lines += ['{:5d} x {}'.format(count, stmt)
+                  for stmt, count in self.statements.most_common()]
+        return '\n'.join(lines)
+
+
+def init_app(app):
+    if app.config.get('SQL_STATS'):
+        install()
+        app.before_request(start_request)
+        app.after_request(finish_request)
+
+
+def install():
+    """Listen to queries on every engine. Safe to call more than once."""
+    global _installed
+    if not _installed:
+        event.listen(Engine, 'before_cursor_execute', before_execute)
+        event.listen(Engine, 'after_cursor_execute', after_execute)
+        _installed = True
+
+
+def before_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    conn.info.setdefault('sqlstats_started', []).append(time.perf_counter())
+
+
+def after_execute(conn, cursor, statement, parameters, context,
+                  executemany):
+    started = conn.info.get('sqlstats_started')
+    if not started:
+        return
+    duration = time.perf_counter() - started.pop()
+    stats = has_app_context() and getattr(g, 'sql_stats', None)
+    if stats:
+        stats.record(statement, duration)
+    for recorder in _recorders:
+        recorder.record(statement, duration)
+
+
+def start_request():
+    g.sql_stats = QueryStats()
+
+
+def finish_request(response):
+    stats = getattr(g, 'sql_stats', None)
+    if not stats:
+        return response
+    g.sql_stats = None
+
+    response.headers['X-Query-Count'] = str(stats.count)
+    response.headers['X-Query-Time'] = '{:.1f}ms'.format(
+        1000 * stats.duration)
+    current_app.logger.info(
+        '%s %s: %d queries in %.1fms', request.method, request.path,
+        stats.count, 1000 * stats.duration)
+
+    repeated = stats.repeated(current_app.config.get(
+        'SQL_STATS_REPEATED_THRESHOLD', DEFAULT_REPEATED_THRESHOLD))
+    if repeated:
+        current_app.logger.warn(
+            '%s %s: repeated queries, possible N+1:\n%s',
+            request.method, request.path,
+            '\n'.join('{:5d} x {}'.format(count, stmt)
+                      for stmt, count in repeated))
+    return response
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Record the queries run inside the with block.
+
+        with count_queries() as stats:
+            client.get('/')
+        assert stats.count <= 10, stats.report()
+    """
+    install()
+    stats = QueryStats()
+    _recorders.append(stats)
+    try:
+        yield stats
+    finally:
+        _recorders.remove(stats)
@@ -0,0 +1,202 @@
+"""Content-addressed storage for attachments.
+
+Files live under UPLOAD_PATH at blobs/<first two hex digits>/<sha256>,
+so the same photo uploaded twice is only stored once. Attachment rows
+point at their blob through storage_path; collect_garbage deletes
+blobs that no attachment refers to any more.
+"""
+from redwind import util
+from redwind.extensions import db
+from redwind.models import Attachment
+from flask import current_app, Request
+from werkzeug.exceptions import RequestEntityTooLarge
+import hashlib
+import os
+import requests
+import tempfile
+import time
+
+BLOB_DIR = 'blobs'
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
+
+def blob_path(content_hash):
+    """The storage path (relative to UPLOAD_PATH) for a hash"""
+    return '/'.join((BLOB_DIR, content_hash[:2], content_hash))
+
+
+def is_blob_path(storage_path):
+    return storage_path.startswith(BLOB_DIR + '/')
+
+
+def max_upload_size():
+    return current_app.config.get('MAX_UPLOAD_SIZE', DEFAULT_MAX_UPLOAD_SIZE)
+
+
+class UploadFile:
+    """A temporary file under UPLOAD_PATH that hashes its contents as
+    they are written, so a finished upload can be moved into blob
+    storage without being read or copied again. Raises
+    RequestEntityTooLarge once more than max_size bytes are written.
+    """
+    def __init__(self, max_size=None):
+        temp_dir = os.path.join(current_app.config['UPLOAD_PATH'], 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=temp_dir)
+        self.file = os.fdopen(fd, 'wb+')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.max_size = max_size
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            # werkzeug abandons the stream without closing it
+            self.close()
+            raise RequestEntityTooLarge()
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.file, attr)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def move_into_place(self):
+        self.file.close()
+        return move_into_place(self.name, self.sha256.hexdigest())
+
+    def close(self):
+        self.file.close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+class UploadRequest(Request):
+    """Request class that has werkzeug write file uploads straight into
+    an UploadFile instead of a spooled temporary file.
+    """
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if 'UPLOAD_PATH' not in current_app.config:
+            return super()._get_file_stream(
+                total_content_length, content_type, filename,
+                content_length)
+        return UploadFile(max_upload_size())
+
+
+def store_chunks(chunks, max_size=None):
+    """Write an iterable of byte strings to storage, hashing as we go,
+    and move the result into place under its hash.
+
+    :return: a tuple of (storage path, sha256 hex digest)
+    """
+    upload = UploadFile(max_size)
+    try:
+        for chunk in chunks:
+            upload.write(chunk)
+        return upload.move_into_place()
+    finally:
+        upload.close()
+
+
+def store_stream(stream, max_size=None):
+    """Read stream in chunks and store it. If the stream is an upload
+    that was already written to disk, it is moved instead of copied.
+
+    :return: a tuple of (storage path, sha256 hex digest)
+    """
+    if isinstance(stream, UploadFile):
+        return stream.move_into_place()
+    return store_chunks(iter(lambda: stream.read(CHUNK_SIZE), b''),
+                        max_size)
+
+
+def store_url(url, max_size=None):
+    """Download url straight into storage.
+
+    :return: a tuple of (storage path, sha256 hex digest, mimetype)
+    """
+    response = requests.get(url, stream=True, timeout=30, headers={
+        'User-Agent': util.USER_AGENT,
+    })
+    response.raise_for_status()
+    length = response.headers.get('content-length')
+    if max_size and length and length.isdigit() and int(length) > max_size:
+        raise RequestEntityTooLarge()
+    mimetype = response.headers.get('content-type', '').split(';')[0].strip()
+    storage_path, content_hash = store_chunks(
+        response.iter_content(CHUNK_SIZE), max_size)
+    return storage_path, content_hash, mimetype
+
+
+def move_into_place(path, content_hash):
+    """Move the file at path to the blob for content_hash, or discard it
+    if we already have that blob.
+
+    :return: a tuple of (storage path, sha256 hex digest)
+    """
+    storage_path = blob_path(content_hash)
+    dest = os.path.join(current_app.config['UPLOAD_PATH'], storage_path)
+    if os.path.exists(dest):
+        current_app.logger.debug('already have blob %s', content_hash)
+        os.remove(path)
+        # keep collect_garbage from racing the new reference
+        os.utime(dest)
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+    return storage_path, content_hash
+
+
+def store_attachment(attachment, stream):
+    """Store the contents of stream and point attachment at them"""
+    attachment.storage_path, attachment.content_hash = store_stream(
+        stream, max_upload_size())
+    return attachment
+
+
+def refcount(storage_path):
+    return Attachment.query.filter_by(storage_path=storage_path).count()
+
+
+def delete_attachment(attachment):
+    delete_attachments([attachment])
+
+
+def delete_attachments(attachments):
+    """Delete attachments and commit. Their blobs stay on disk until
+    collect_garbage finds nothing refers to them; deleting them here
+    could race an upload of the same content that is about to commit
+    a new reference.
+    """
+    for attachment in attachments:
+        db.session.delete(attachment)
+    db.session.commit()
+
+
+def collect_garbage(min_age=60 * 60, dry_run=False):
+    """Delete every blob that no attachment refers to. Blobs younger
+    than min_age seconds are skipped, since they may belong to an
+    upload that has not been committed yet. With dry_run, nothing is
+    deleted.
+
+    :return: the list of deleted storage paths
+    """
+    root = current_app.config['UPLOAD_PATH']
+    cutoff = time.time() - min_age
+    referenced = set(
+        row[0] for row in db.session.query(Attachment.storage_path))
+    deleted = []
+    for dirpath, _, filenames in os.walk(os.path.join(root, BLOB_DIR)):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            storage_path = os.path.relpath(path, root).replace(os.sep, '/')
+            if (storage_path not in referenced
+                    and os.path.getmtime(path) < cutoff):
+                if not dry_run:
+                    os.remove(path)
+                deleted.append(storage_path)
+    return deleted
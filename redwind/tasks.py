@@ -1,6 +1,4 @@
 from contextlib import contextmanager
-from redis import StrictRedis
-import rq
 
 
 _queue = None
@@ -18,6 +16,8 @@ def create_queue():
     directly, it is a convenient place to mock for tests that don't
     care about the queue.
     """
+    from redis import StrictRedis
+    import rq
     redis = StrictRedis()
     return rq.Queue('redwind:low', connection=redis)
 
@@ -1,18 +1,14 @@
 from flask import url_for, current_app
-from markdown import markdown
 from requests.exceptions import HTTPError, SSLError
 from smartypants import smartyPants
-import bleach
-import brevity
-import bs4
 import jwt
-import mf2py
 
 from datetime import date
 import cgi
 import collections
 import datetime
 import functools
+import hashlib
 import os
 import os.path
 import random
@@ -23,10 +19,11 @@ import unicodedata
 import urllib
 
 
-bleach.ALLOWED_TAGS += ['img', 'p', 'br', 'marquee', 'blink']
-bleach.ALLOWED_ATTRIBUTES.update({
+# allowed in foreign html, on top of bleach's defaults
+EXTRA_ALLOWED_TAGS = ['img', 'p', 'br', 'marquee', 'blink']
+EXTRA_ALLOWED_ATTRIBUTES = {
     'img': ['src', 'alt', 'title']
-})
+}
 
 
 TWITTER_PROFILE_RE = re.compile(r'https?://(?:www\.)?twitter\.com/(\w+)')
@@ -115,9 +112,13 @@ def download_resource(url, path):
     if not os.path.exists(os.path.dirname(path)):
         os.makedirs(os.path.dirname(path))
 
-    with open(path, 'wb') as f:
-        for chunk in response.iter_content(512):
+    # write to a temporary file so a partial download is never
+    # mistaken for a complete one
+    temp_path = path + '.part'
+    with open(temp_path, 'wb') as f:
+        for chunk in response.iter_content(4096):
             f.write(chunk)
+    os.replace(temp_path, path)
 
 
 def urls_match(url1, url2):
@@ -167,6 +168,8 @@ def process_text(fn, doc, blacklist=BLACKLIST_TAGS):
 
 
 def autolink(text):
+    import brevity
+
     def link_hashtag(m):
         return '<a href="/tags/{}">{}</a>'.format(
             m.group(1).lower(), m.group())
@@ -332,6 +335,7 @@ def multiline_string_to_list(s):
 
 
 def markdown_filter(data, img_path=None):
+    from markdown import markdown
     if data is None:
         return ''
 
@@ -363,6 +367,7 @@ def convert_legacy_people_to_at_names(data):
 
 
 def format_as_text(html, link_fn=None):
+    import bs4
     if html is None:
         return ''
 
@@ -394,6 +399,103 @@ def format_as_text(html, link_fn=None):
     return result
 
 
+IMAGE_TAG_RE = re.compile(r'<img([^>]*) src="(https?://[^">]+)"')
+
+INSTAGRAM_PREVIEW_RE = re.compile(r'https?://instagram\.com/p/[\w\-]+/?')
+VIMEO_PREVIEW_RE = re.compile(r'https?://vimeo\.com/(\d+)/?')
+YOUTUBE_PREVIEW_RE = re.compile(
+    r'https?://(?:(?:www\.)youtube\.com/watch\?v=|youtu\.be/)([\w\-]+)')
+IMAGE_PREVIEW_RE = re.compile(r'https?://[^\s">]*\.(?:gif|png|jpg)')
+
+# post types that get an inline preview of a trailing media link
+PREVIEW_POST_TYPES = ('note', 'reply', 'photo')
+
+
+def proxy_all(html, side=None):
+    """Rewrite the src of every remote <img> to go through the image
+    proxy.
+    """
+    # most bodies have no images at all; skip the regex entirely
+    if not html or '<img' not in html:
+        return html
+
+    from . import imageproxy
+    from .models import get_settings
+    site_url = get_settings().site_url
+
+    def repl(m):
+        url = m.group(2)
+        # don't proxy images that come from this site
+        if url.startswith(site_url):
+            return m.group(0)
+        url = url.replace('&amp;', '&')
+        return '<img{} src="{}"'.format(
+            m.group(1), imageproxy.imageproxy_filter(url, side))
+    return IMAGE_TAG_RE.sub(repl, html)
+
+
+def add_preview(content):
+    """If a post ends with the URL of a known media source (youtube,
+    instagram, etc.), add the content inline.
+    """
+    if not content or any('<' + tag in content for tag in (
+            'img', 'iframe', 'embed', 'audio', 'video')):
+        # don't add  a preview to a post that already has one
+        return content
+
+    m = INSTAGRAM_PREVIEW_RE.search(content)
+    if m:
+        ig_url = m.group(0)
+        media_url = urllib.parse.urljoin(ig_url, 'media/?size=l')
+        return '{}<a href="{}"><img src="{}" /></a>'.format(
+            content, ig_url, media_url)
+
+    m = VIMEO_PREVIEW_RE.search(content)
+    if m:
+        vimeo_id = m.group(1)
+        return (
+            '{}<iframe src="//player.vimeo.com/video/{}" width="560" '
+            'height="315" frameborder="0" webkitallowfullscreen '
+            'mozallowfullscreen allowfullscreen></iframe>'
+        ).format(content, vimeo_id)
+
+    m = YOUTUBE_PREVIEW_RE.search(content)
+    if m:
+        youtube_id = m.group(1)
+        return (
+            '{}<iframe width="560" height="315" '
+            'src="https://www.youtube.com/embed/{}" frameborder="0" '
+            'allowfullscreen></iframe>'
+        ).format(content, youtube_id)
+
+    m = IMAGE_PREVIEW_RE.search(content)
+    if m:
+        return '{}<img src="{}"/>'.format(content, m.group(0))
+
+    return content
+
+
+def render_display_html(html, preview=False):
+    """Apply the transformations that used to run on every page view
+    (proxied image URLs and, optionally, media previews) so the result
+    can be stored alongside the source html.
+    """
+    html = proxy_all(html)
+    if preview:
+        html = add_preview(html)
+    return html
+
+
+def hash_file(path):
+    """Return the hex SHA-256 digest of a file's contents
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def is_cached_current(original, cached):
     """Compare a file and the processed, cached version to see if the cached
     version is up to date.
@@ -415,17 +517,20 @@ def prettify_url(url):
     return path.rstrip('/')
 
 
-def fetch_html(url):
+def fetch_html(url, headers=None):
     """Utility to fetch HTML from an external site. If the Content-Type
     header does not explicitly list a charset, Requests will assume a
     bad one, so we have to use 'get_encodings_from_content` to find
     the meta charset or other indications in the actual response body.
 
+    headers are sent along with our User-Agent, e.g. If-None-Match to
+    make a conditional request; a 304 response is not logged as a
+    failure.
+
     Return a requests.Response
     """
-    response = requests.get(url, timeout=30, headers={
-        'User-Agent': USER_AGENT,
-    })
+    response = requests.get(url, timeout=30, headers=dict(
+        headers or {}, **{'User-Agent': USER_AGENT}))
     if response.status_code // 2 == 100:
         # requests ignores <meta charset> when a Content-Type header
         # is provided, even if the header does not define a charset
@@ -434,15 +539,19 @@ def fetch_html(url):
                 response.text)
             if encodings:
                 response.encoding = encodings[0]
-    else:
+    elif response.status_code != 304:
         current_app.logger.warn('failed to fetch url %s. got response %s.',
                                 url, response)
     return response
 
 
 def clean_foreign_html(html):
+    import bleach
     html = re.sub('<script.*?</script>', '', html, flags=re.DOTALL)
-    return bleach.clean(html, strip=True)
+    attributes = dict(bleach.ALLOWED_ATTRIBUTES, **EXTRA_ALLOWED_ATTRIBUTES)
+    return bleach.clean(
+        html, tags=list(bleach.ALLOWED_TAGS) + EXTRA_ALLOWED_TAGS,
+        attributes=attributes, strip=True)
 
 
 def jwt_encode(obj):
@@ -463,6 +572,8 @@ def posse_post_discovery(post, regex):
     Return:
       a tuple of the first match for (in-reply-to, repost-of, like-of)
     """
+    import mf2py
+
     def find_syndicated(original):
         if regex.match(original):
             return original
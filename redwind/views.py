@@ -1,8 +1,10 @@
 from flask import Blueprint
-from flask import make_response, Markup, send_from_directory, current_app
+from flask import make_response, Markup, current_app
 from flask import request, redirect, url_for, render_template, g, abort
 from werkzeug.http import generate_etag
+from redwind import delivery
 from redwind import imageproxy
+from redwind import metrics
 from redwind import util
 from redwind.extensions import db
 from redwind.models import Post, Tag, get_settings
@@ -11,7 +13,6 @@ import flask.ext.login as flask_login
 import json
 import os
 import pytz
-import re
 import sqlalchemy
 import sqlalchemy.orm
 import sqlalchemy.sql
@@ -161,8 +162,7 @@ def render_posts(title, posts, older, events=None, template='posts.jinja2'):
     last_modified = max((p.updated for p in posts if p.updated), default=None)
     if last_modified:
         # rv.headers['Last-Modified'] = http_date(last_modified)
-        rv.headers['Etag'] = generate_etag(rv.get_data())
-        rv.make_conditional(request)
+        add_etag(rv)
     return rv
 
 
@@ -174,11 +174,16 @@ def render_posts_atom(title, feed_id, posts):
     last_modified = max((p.updated for p in posts if p.updated), default=None)
     if last_modified:
         # rv.headers['Last-Modified'] = http_date(last_modified)
-        rv.headers['Etag'] = generate_etag(rv.get_data())
-        rv.make_conditional(request)
+        add_etag(rv)
     return rv
 
 
+@metrics.timed('redwind_etag_seconds')
+def add_etag(rv):
+    rv.headers['Etag'] = generate_etag(rv.get_data())
+    rv.make_conditional(request)
+
+
 @views.route('/')
 @views.route('/before-<before_ts>/')
 def index(before_ts=None):
@@ -339,21 +344,11 @@ def render_attachment(post, filename):
                                 attachment.disk_path)
         abort(404)
 
-    if current_app.debug:
-        _, ext = os.path.splitext(attachment.disk_path)
-        return send_from_directory(
-            os.path.dirname(attachment.disk_path),
-            os.path.basename(attachment.disk_path),
-            mimetype=attachment.mimetype)
-
-    resp = make_response('')
-    # nginx is configured to serve internal resources directly
-    resp.headers['X-Accel-Redirect'] = os.path.join(
-        '/internal_data', attachment.storage_path)
-    resp.headers['Content-Type'] = attachment.mimetype
-    del resp.headers['Content-Length']
-    current_app.logger.debug('response with X-Accel-Redirect %s', resp.headers)
-    return resp
+    return delivery.send_file(
+        attachment.disk_path, attachment.mimetype,
+        # nginx is configured to serve internal resources directly
+        internal_url=os.path.join('/internal_data', attachment.storage_path),
+        etag=attachment.content_hash, private=post.friends_only)
 
 
 @views.route('/' + POST_TYPE_RULE + '/' + DATE_RULE, defaults={'slug': None})
@@ -404,8 +399,7 @@ def render_post(post):
                         title=post.title_or_fallback))
     if post.updated:
         # rv.headers['Last-Modified'] = http_date(post.updated)
-        rv.headers['Etag'] = generate_etag(rv.get_data())
-        rv.make_conditional(request)
+        add_etag(rv)
     return rv
 
 
@@ -638,66 +632,11 @@ def syndication_text(url):
     return domain_from_url(url)
 
 
-IMAGE_TAG_RE = re.compile(r'<img([^>]*) src="(https?://[^">]+)"')
-
-
 @views.app_template_filter('proxy_all')
 def proxy_all_filter(html, side=None):
-    def repl(m):
-        url = m.group(2)
-        # don't proxy images that come from this site
-        if url.startswith(get_settings().site_url):
-            return m.group(0)
-        url = url.replace('&amp;', '&')
-        return '<img{} src="{}"'.format(
-            m.group(1), imageproxy.imageproxy_filter(url, side))
-    return IMAGE_TAG_RE.sub(repl, html) if html else html
+    return util.proxy_all(html, side)
 
 
 @views.app_template_filter()
 def add_preview(content):
-    """If a post ends with the URL of a known media source (youtube,
-    instagram, etc.), add the content inline.
-    """
-    if any('<' + tag in content for tag in (
-            'img', 'iframe', 'embed', 'audio', 'video')):
-        # don't add  a preview to a post that already has one
-        return content
-
-    instagram_regex = 'https?://instagram\.com/p/[\w\-]+/?'
-    vimeo_regex = 'https?://vimeo\.com/(\d+)/?'
-    youtube_regex = \
-        'https?://(?:(?:www\.)youtube\.com/watch\?v=|youtu\.be/)([\w\-]+)'
-    img_regex = 'https?://[^\s">]*\.(?:gif|png|jpg)'
-
-    m = re.search(instagram_regex, content)
-    if m:
-        ig_url = m.group(0)
-        media_url = urllib.parse.urljoin(ig_url, 'media/?size=l')
-        return '{}<a href="{}"><img src="{}" /></a>'.format(
-            content, ig_url, media_url)
-
-    m = re.search(vimeo_regex, content)
-    if m:
-        # vimeo_url = m.group(0)
-        vimeo_id = m.group(1)
-        return (
-            '{}<iframe src="//player.vimeo.com/video/{}" width="560" '
-            'height="315" frameborder="0" webkitallowfullscreen '
-            'mozallowfullscreen allowfullscreen></iframe>'
-        ).format(content, vimeo_id)
-
-    m = re.search(youtube_regex, content)
-    if m:
-        youtube_id = m.group(1)
-        return (
-            '{}<iframe width="560" height="315" '
-            'src="https://www.youtube.com/embed/{}" frameborder="0" '
-            'allowfullscreen></iframe>'
-        ).format(content, youtube_id)
-
-    m = re.search(img_regex, content)
-    if m:
-        return '{}<img src="{}"/>'.format(content, m.group(0))
-
-    return content
+    return util.add_preview(content)
@@ -0,0 +1,28 @@
+"""Render every public page into STATIC_SITE_PATH.
+
+    python scripts/build_static_site.py --processes 4
+"""
+from redwind import create_app
+from redwind.plugins import static_site
+import argparse
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('--config', default='../redwind.cfg')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        start = time.perf_counter()
+        written = static_site.build_all(args.processes)
+        elapsed = time.perf_counter() - start
+    print('wrote {} pages in {:.1f}s ({:.0f} pages/s)'.format(
+        written, elapsed, written / elapsed))
+
+
+if __name__ == '__main__':
+    main()
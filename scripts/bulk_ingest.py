@@ -0,0 +1,39 @@
+"""Create posts from a file of micropub JSON entries, one per line.
+Contexts, html and (with --hooks) post-saved hooks are handled by the
+queue worker, so keep one running.
+
+    python scripts/bulk_ingest.py tweets.ndjson --batch-size 500
+    zcat archive.ndjson.gz | python scripts/bulk_ingest.py -
+"""
+from redwind import create_app
+from redwind import ingest
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file', help="NDJSON file, or '-' for stdin")
+    parser.add_argument('--batch-size', type=int,
+                        default=ingest.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--hooks', action='store_true',
+                        help='run post-saved hooks (syndication, '
+                        'webmentions) for the new posts')
+    parser.add_argument('--config', default='../redwind.cfg')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    infile = (sys.stdin if args.file == '-'
+              else open(args.file, encoding='utf-8'))
+    with app.app_context(), infile:
+        for progress in ingest.ingest_lines(infile, args.batch_size,
+                                            args.hooks):
+            for error in progress['errors']:
+                print('line {line}: {error}'.format(**error),
+                      file=sys.stderr)
+            print('{lines} lines, {created} created, {skipped} skipped'
+                  .format(**progress), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
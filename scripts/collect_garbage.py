@@ -0,0 +1,32 @@
+"""Delete stored attachment files that no attachment refers to.
+
+    python scripts/collect_garbage.py
+    python scripts/collect_garbage.py --min-age 0 --dry-run
+"""
+from redwind import create_app
+from redwind import storage
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-age', type=int, default=60 * 60,
+                        help='skip files younger than this many seconds, '
+                        'which may belong to an upload in progress '
+                        '(default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the files that would be deleted')
+    parser.add_argument('--config', default='../redwind.cfg')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        deleted = storage.collect_garbage(args.min_age, args.dry_run)
+    for storage_path in deleted:
+        print(storage_path)
+    print('{} {} unreferenced files'.format(
+        'found' if args.dry_run else 'deleted', len(deleted)))
+
+
+if __name__ == '__main__':
+    main()
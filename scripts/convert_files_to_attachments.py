@@ -1,6 +1,7 @@
 from redwind import create_app
 from redwind import util
 from redwind import admin
+from redwind import storage
 from redwind.models import Post, Attachment
 from redwind.extensions import db
 import os
@@ -38,10 +39,7 @@ def convert_file_to_attachment(post, filename):
 
 with app.app_context():
     for post in Post.query.all():
-        for a in post.attachments:
-            if os.path.exists(a.disk_path):
-                os.remove(a.disk_path)
-            db.session.delete(a)
+        storage.delete_attachments(list(post.attachments))
 
         if not post.photos:
             # check for files
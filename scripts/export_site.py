@@ -0,0 +1,32 @@
+"""Write a backup of the site to a file, a batch of posts at a time.
+
+    python scripts/export_site.py backup.ndjson
+    python scripts/export_site.py --format json - > backup.json
+    python scripts/export_site.py --since 2015-06-01T00:00:00 recent.ndjson
+"""
+from redwind import create_app
+from redwind import exporter
+from redwind import posts
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file', help="output file, or '-' for stdout")
+    parser.add_argument('--format', choices=('ndjson', 'json'),
+                        default='ndjson')
+    parser.add_argument('--since', type=posts.parse_utc,
+                        help='only posts updated since this ISO 8601 time')
+    parser.add_argument('--config', default='../redwind.cfg')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    outfile = (sys.stdout if args.file == '-'
+               else open(args.file, 'w', encoding='utf-8'))
+    with app.app_context(), outfile:
+        exporter.export_to_file(outfile, args.format, args.since)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Import a backup written by scripts/export_site.py (or /export),
+committing a batch at a time.
+
+    python scripts/import_site.py backup.ndjson --checkpoint import.ckpt
+    python scripts/import_site.py --format json backup.json
+
+If the import is interrupted, run the same command again: with
+--checkpoint it skips straight to the first uncommitted record, and
+posts that already exist are never imported twice.
+"""
+from redwind import create_app
+from redwind import importer
+from redwind.extensions import db
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=('ndjson', 'json'),
+                        default='ndjson')
+    parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE)
+    parser.add_argument('--checkpoint',
+                        help='file to record progress in, for resuming')
+    parser.add_argument('--create-tables', action='store_true')
+    parser.add_argument('--config', default='../redwind.cfg')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context(), open(args.file, encoding='utf-8') as f:
+        if args.create_tables:
+            db.create_all()
+        stats = importer.import_file(f, args.format, args.batch_size,
+                                     args.checkpoint)
+    for key, count in sorted(stats.items()):
+        print('{}: {}'.format(key, count))
+
+
+if __name__ == '__main__':
+    main()
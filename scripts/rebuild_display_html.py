@@ -0,0 +1,37 @@
+"""Regenerate the stored display html (proxied image urls, media
+previews) for every post, context and mention. Run this after
+changing PILBOX_URL, PILBOX_KEY or the site url.
+"""
+from redwind import create_app
+from redwind.models import Post, Context, Mention
+from redwind.extensions import db
+
+BATCH_SIZE = 500
+
+app = create_app()
+
+
+def rebuild(model):
+    count = changed = 0
+    last_id = 0
+    while True:
+        batch = model.query.filter(model.id > last_id)\
+                           .order_by(model.id)\
+                           .limit(BATCH_SIZE).all()
+        if not batch:
+            break
+        for obj in batch:
+            html = obj.render_display_html()
+            if html != obj.content_display:
+                obj.content_display = html
+                changed += 1
+        count += len(batch)
+        last_id = batch[-1].id
+        db.session.commit()
+        db.session.expunge_all()
+    print('{}: rebuilt {} of {}'.format(model.__name__, changed, count))
+
+
+with app.app_context():
+    for model in (Post, Context, Mention):
+        rebuild(model)
@@ -0,0 +1,35 @@
+"""Re-render the stored html of every post, e.g. after changing
+markdown extensions, contacts and nicks, or the site url.
+
+    python scripts/rerender_posts.py --processes 4 --chunk-size 200
+"""
+from redwind import create_app
+from redwind import rerender
+from redwind.models import get_settings
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('--chunk-size', type=int, default=rerender.CHUNK_SIZE)
+    parser.add_argument('--config', default='../redwind.cfg')
+    args = parser.parse_args()
+
+    def report(stats):
+        print('{rendered} rendered, {changed} changed, '
+              '{per_second:.0f} posts/s'.format(**stats), file=sys.stderr)
+
+    app = create_app(args.config)
+    with app.app_context():
+        with app.test_request_context(base_url=get_settings().site_url):
+            stats = rerender.rerender_all(args.processes, args.chunk_size,
+                                          report)
+    print('rendered {rendered} posts in {elapsed:.1f}s '
+          '({per_second:.0f} posts/s); {changed} changed'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -58,7 +58,7 @@ def app(request):
     temp_upload_path = tempfile.mkdtemp()
     temp_imageproxy_path = tempfile.mkdtemp()
     rw_app.config['UPLOAD_PATH'] = temp_upload_path
-    #rw_app.config['IMAGEPROXY_PATH'] = temp_imageproxy_path
+    rw_app.config['IMAGEPROXY_PATH'] = temp_imageproxy_path
 
     set_setting('posts_per_page', '15')
     set_setting('author_domain', 'example.com')
@@ -96,3 +96,25 @@ def auth(request, app, client):
     client.get('/bypass_login')
     yield
     client.get('/logout')
+
+
+@pytest.fixture
+def token(app, db):
+    """An access token for an admin user, accepted by the micropub
+    endpoint.
+    """
+    from redwind import util
+    from redwind.models import User, Credential
+    user = User()
+    user.name = 'example.com'
+    user.admin = True
+    cred = Credential()
+    cred.type = 'indieauth'
+    cred.value = 'http://example.com/'
+    cred.user = user
+    db.session.add_all([user, cred])
+    db.session.commit()
+    token = util.jwt_encode({'me': 'http://example.com/',
+                             'client_id': 'https://quill.p3k.io/',
+                             'scope': ['post']})
+    return token.decode() if isinstance(token, bytes) else token
@@ -0,0 +1,72 @@
+import hashlib
+import pytest
+
+
+@pytest.fixture
+def attachment_url(client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    rv = client.post('/save_new', data={
+        'photo': (open('tests/image.jpg', 'rb'), 'image.jpg', 'image/jpeg'),
+        'post_type': 'photo',
+        'content': 'Delivered photo',
+        'action': 'publish_quietly',
+    })
+    assert rv.status_code == 302
+    return rv.location + '/files/image.jpg'
+
+
+@pytest.fixture
+def image_data():
+    with open('tests/image.jpg', 'rb') as f:
+        return f.read()
+
+
+def test_direct_etag(app, client, attachment_url, image_data):
+    app.config['FILE_DELIVERY'] = 'direct'
+    rv = client.get(attachment_url)
+    assert rv.status_code == 200
+    assert rv.data == image_data
+    assert rv.headers['ETag'] == '"{}"'.format(
+        hashlib.sha256(image_data).hexdigest())
+    assert 'max-age=' in rv.headers['Cache-Control']
+
+    rv = client.get(attachment_url, headers={
+        'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+    assert not rv.data
+
+
+def test_direct_range(app, client, attachment_url, image_data):
+    app.config['FILE_DELIVERY'] = 'direct'
+    rv = client.get(attachment_url, headers={'Range': 'bytes=10-19'})
+    assert rv.status_code == 206
+    assert rv.data == image_data[10:20]
+    assert rv.headers['Content-Range'] == 'bytes 10-19/{}'.format(
+        len(image_data))
+
+    rv = client.get(attachment_url, headers={'Range': 'bytes=-5'})
+    assert rv.status_code == 206
+    assert rv.data == image_data[-5:]
+
+    rv = client.get(attachment_url, headers={
+        'Range': 'bytes={}-'.format(len(image_data) + 10)})
+    assert rv.status_code == 416
+
+    # a stale If-Range gets the whole file
+    rv = client.get(attachment_url, headers={
+        'Range': 'bytes=10-19', 'If-Range': '"stale"'})
+    assert rv.status_code == 200
+    assert rv.data == image_data
+
+
+def test_offload_backends(app, client, attachment_url):
+    app.config['FILE_DELIVERY'] = 'x-accel-redirect'
+    rv = client.get(attachment_url)
+    assert rv.headers['X-Accel-Redirect'].startswith('/internal_data/')
+    assert not rv.data
+
+    app.config['FILE_DELIVERY'] = 'x-sendfile'
+    rv = client.get(attachment_url)
+    assert rv.headers['X-Sendfile'].startswith(app.config['UPLOAD_PATH'])
+    assert not rv.data
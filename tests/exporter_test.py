@@ -0,0 +1,82 @@
+import datetime
+import json
+import pytest
+from redwind import exporter
+from redwind.models import Post, Tag, Context, Mention, Venue
+
+
+@pytest.fixture
+def site(db):
+    venue = Venue()
+    venue.name = 'Cafe'
+    venue.slug = 'cafe'
+    db.session.add(venue)
+    for ii in range(5):
+        post = Post('reply')
+        post.path = '2015/06/post-{}'.format(ii)
+        post.content = 'Post {}'.format(ii)
+        post.published = datetime.datetime(2015, 6, 1 + ii)
+        post.updated = post.published
+        post.venue = venue
+        post.tags = [Tag('tag-{}'.format(ii % 2))]
+        post.in_reply_to = ['http://example.org/{}'.format(ii)]
+        context = Context()
+        context.url = post.in_reply_to[0]
+        post.reply_contexts = [context]
+        mention = Mention()
+        mention.url = 'http://example.org/reply-{}'.format(ii)
+        mention.reftype = 'reply'
+        post.mentions = [mention]
+        db.session.add(post)
+    db.session.commit()
+
+
+def test_ndjson(app, site):
+    records = [json.loads(line) for line in exporter.iter_ndjson()]
+    types = [r['type'] for r in records]
+    assert types == ['setting'] * 4 + ['venue'] + ['post'] * 5
+    post = records[-1]['data']
+    assert post['path'] == '2015/06/post-4'
+    assert post['venue'] == 'cafe'
+    assert post['reply_contexts'][0]['url'] == 'http://example.org/4'
+    assert post['mentions'][0]['url'] == 'http://example.org/reply-4'
+
+
+def test_json_matches_export_all(app, site):
+    streamed = json.loads(''.join(exporter.iter_json()))
+    assert streamed == json.loads(json.dumps(exporter.export_all()))
+    assert len(streamed['posts']) == 5
+    assert streamed['contacts'] == []
+
+
+def test_batches_and_since(app, site):
+    since = datetime.datetime(2015, 6, 3)
+    batched = list(exporter.iter_posts(since=since, batch_size=2))
+    assert [p.path for p in batched] == [
+        '2015/06/post-2', '2015/06/post-3', '2015/06/post-4']
+
+
+def test_queries_per_batch(app, db, site):
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+
+    db.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        records = list(exporter.iter_records())
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+    assert len(records) == 10
+    # one query per relationship per batch, not per post
+    assert len(statements) < 15
+
+
+def test_export_route(client, auth, site):
+    rv = client.get('/export?since=2015-06-05T00:00:00')
+    assert rv.status_code == 200
+    assert 'attachment' in rv.headers['Content-Disposition']
+    lines = rv.get_data(as_text=True).splitlines()
+    assert [json.loads(l)['data'].get('path') for l in lines][-1] == \
+        '2015/06/post-4'
+    assert sum(1 for l in lines if '"type": "post"' in l) == 1
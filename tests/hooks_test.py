@@ -0,0 +1,71 @@
+import pytest
+import time
+from redwind import hooks
+from redwind.models import Post
+
+
+@pytest.fixture
+def clean_hooks(monkeypatch):
+    monkeypatch.setattr(hooks, 'actions', {})
+
+
+def fail(post):
+    raise ValueError('broken plugin')
+
+
+def slow(post):
+    time.sleep(5)
+
+
+def succeed(post):
+    return 'ok'
+
+
+def test_exceptions_are_isolated(app, clean_hooks):
+    hooks.register('test-hook', fail)
+    hooks.register('test-hook', succeed)
+    with app.test_request_context():
+        assert hooks.fire('test-hook', None) == [None, 'ok']
+
+
+def test_timeout(app, clean_hooks):
+    hooks.register('test-hook', slow, timeout=0.1)
+    hooks.register('test-hook', succeed)
+    start = time.monotonic()
+    with app.test_request_context():
+        assert hooks.fire('test-hook', None) == [None, 'ok']
+    assert time.monotonic() - start < 1
+
+
+def test_register_replaces(clean_hooks):
+    hooks.register('test-hook', succeed)
+    hooks.register('test-hook', succeed, background=True)
+    assert hooks.actions['test-hook'] == [
+        hooks.Action(succeed, True, None)]
+
+
+def test_background_actions_queued_once(app, db, clean_hooks, mocker):
+    get_queue = mocker.patch('redwind.hooks.get_queue')
+    background = mocker.Mock(__module__='plugin', __name__='background')
+    also_background = mocker.Mock(__module__='plugin', __name__='also')
+    hooks.register('test-hook', background, background=True)
+    hooks.register('test-hook', also_background, background=True)
+    hooks.register('test-hook', succeed)
+
+    post = Post('note')
+    db.session.add(post)
+    db.session.commit()
+    with app.test_request_context():
+        assert hooks.fire('test-hook', post) == ['ok']
+
+    background.assert_not_called()
+    get_queue().enqueue.assert_called_once_with(
+        hooks.do_fire, 'test-hook', ['plugin.background', 'plugin.also'],
+        [hooks.ModelRef('Post', post.id)], {}, app.config['CONFIG_FILE'])
+
+    # run the job in this process
+    mocker.patch('redwind.hooks.async_app_context')
+    job, *job_args = get_queue().enqueue.call_args[0]
+    job(*job_args)
+    background.assert_called_once_with(post)
+    also_background.assert_called_once_with(post)
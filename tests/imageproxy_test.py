@@ -0,0 +1,116 @@
+import os
+import pytest
+from redwind import imageproxy
+from redwind import pipeline
+
+
+@pytest.fixture
+def photo_url(client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    rv = client.post('/save_new', data={
+        'photo': (open('tests/image.jpg', 'rb'), 'image.jpg', 'image/jpeg'),
+        'post_type': 'photo',
+        'content': 'Proxied photo',
+        'action': 'publish_quietly',
+    })
+    assert rv.status_code == 302
+    return rv.location + '/files/image.jpg'
+
+
+def test_resize_attachment(app, client, photo_url):
+    with app.test_request_context():
+        proxy_url = imageproxy.construct_url(photo_url, 100)
+    rv = client.get(proxy_url)
+    assert rv.status_code == 200
+    assert rv.data
+
+    derivatives = [
+        f for _, _, files in os.walk(app.config['IMAGEPROXY_PATH'])
+        for f in files]
+    assert derivatives == [
+        imageproxy.source_key(photo_url) + '-100x100.jpg']
+
+
+def test_bad_signature(app, client, photo_url):
+    app.config['PILBOX_KEY'] = 'abracadabra'
+    with app.test_request_context():
+        proxy_url = imageproxy.construct_url(photo_url, 100)
+    assert client.get(proxy_url).status_code == 200
+    assert client.get(proxy_url[:-1] + 'x').status_code == 400
+    assert client.get(proxy_url.replace('w=100', 'w=200')).status_code == 400
+
+
+def test_pregenerate_on_save(app, client, auth, mocker):
+    get_queue = mocker.patch('redwind.pipeline.get_queue')
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    client.post('/save_new', data={
+        'photo': (open('tests/image.jpg', 'rb'), 'image.jpg', 'image/jpeg'),
+        'post_type': 'photo',
+        'action': 'publish_quietly',
+    })
+    get_queue().enqueue.assert_called_once_with(
+        pipeline.do_publish, mocker.ANY, mocker.ANY, app.config['CONFIG_FILE'])
+
+
+def test_pregenerate_derivatives(app, photo_url):
+    from redwind.models import Post
+    post = Post.query.first()
+    with app.test_request_context():
+        stage, = imageproxy.plan_derivatives(post, {})
+        stage.run()
+    derivatives = [
+        f for _, _, files in os.walk(app.config['IMAGEPROXY_PATH'])
+        for f in files]
+    assert derivatives == [
+        imageproxy.source_key(photo_url) + '-600x600.jpg']
+
+
+def test_construct_url_memoized(app, mocker):
+    hmac_new = mocker.spy(imageproxy.hmac, 'new')
+    app.config['PILBOX_KEY'] = 'memoize-me'
+    with app.test_request_context():
+        url1 = imageproxy.construct_url('http://example.com/a.jpg', 64)
+        url2 = imageproxy.construct_url('http://example.com/a.jpg', '64')
+        assert url1 == url2
+        assert hmac_new.call_count == 1
+
+        # a new key must not return the old signature
+        app.config['PILBOX_KEY'] = 'something-else'
+        assert imageproxy.construct_url(
+            'http://example.com/a.jpg', 64) != url1
+
+
+def test_proxy_all_fast_path(app, mocker):
+    from redwind import models, util
+    get_settings = mocker.spy(models, 'get_settings')
+    with app.test_request_context():
+        assert util.proxy_all('<p>no images</p>') == '<p>no images</p>'
+        assert get_settings.call_count == 0
+        html = util.proxy_all('<img src="http://example.org/a.jpg">')
+        assert '/imageproxy?' in html
+
+
+def test_unsigned_remote_rejected(app, client, photo_url):
+    with app.test_request_context():
+        local_url = imageproxy.construct_url(photo_url, 100)
+        remote_url = imageproxy.construct_url('http://example.com/a.jpg', 100)
+    assert client.get(local_url).status_code == 200
+    assert client.get(remote_url).status_code == 400
+
+
+def test_remote_without_extension(app, client, mocker):
+    import shutil
+
+    def download(url, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile('tests/image.jpg', path)
+
+    mocker.patch('redwind.util.download_resource', side_effect=download)
+    app.config['PILBOX_KEY'] = 'abracadabra'
+    with app.test_request_context():
+        proxy_url = imageproxy.construct_url('http://example.com/avatar')
+    rv = client.get(proxy_url)
+    assert rv.status_code == 200
+    assert rv.mimetype == 'image/jpeg'
@@ -0,0 +1,117 @@
+import io
+import json
+import pytest
+from redwind import exporter
+from redwind import importer
+from redwind.models import Post, Context, Tag, Venue
+
+
+def post(ii, url, tags=('indieweb',), mentions=0):
+    return {
+        'path': '2015/06/post-{}'.format(ii), 'historic_path': None,
+        'post_type': 'reply', 'draft': False, 'deleted': False,
+        'hidden': False, 'redirect': None, 'tags': list(tags),
+        'in_reply_to': [url], 'repost_of': [], 'like_of': [],
+        'bookmark_of': [], 'like_contexts': [], 'repost_contexts': [],
+        'bookmark_contexts': [],
+        'reply_contexts': [{
+            'url': url, 'permalink': url, 'author_name': 'Someone',
+            'author_url': None, 'author_image': None, 'content': 'Hi',
+            'content_plain': 'Hi', 'published': None, 'title': None,
+            'syndication': [],
+        }],
+        'title': None, 'published': '2015-06-01T00:00:00',
+        'slug': 'post-{}'.format(ii), 'syndication': [], 'location': None,
+        'venue': 'cafe' if ii % 2 else None,
+        'mentions': [{
+            'url': 'http://example.org/m/{}/{}'.format(ii, jj),
+            'permalink': None, 'author_name': None, 'author_url': None,
+            'author_image': None, 'content': None, 'content_plain': None,
+            'published': None, 'title': None, 'syndication': [],
+            'reftype': 'reply',
+        } for jj in range(mentions)],
+        'content': 'Reply {}'.format(ii),
+        'content_html': '<p>Reply {}</p>'.format(ii),
+    }
+
+
+def ndjson(records):
+    return io.StringIO(''.join(
+        json.dumps({'type': rectype, 'data': data}) + '\n'
+        for rectype, data in records))
+
+
+@pytest.fixture
+def records():
+    return [('venue', {'name': 'Cafe', 'location': None, 'slug': 'cafe'})] + [
+        ('post', post(ii, 'http://example.org/{}'.format(ii % 3),
+                      mentions=ii % 2))
+        for ii in range(7)]
+
+
+def test_import_ndjson(app, records):
+    stats = importer.import_file(ndjson(records), batch_size=3)
+    assert stats['post'] == 7
+    assert stats['context'] == 3
+
+    posts = Post.query.order_by(Post.id).all()
+    assert [p.path for p in posts] == [
+        '2015/06/post-{}'.format(ii) for ii in range(7)]
+    # contexts are shared between posts replying to the same url
+    assert Context.query.count() == 3
+    assert posts[0].reply_contexts == posts[3].reply_contexts
+    assert Tag.query.count() == 1
+    assert all(p.tags[0].name == 'indieweb' for p in posts)
+    assert len(posts[1].mentions) == 1
+    assert posts[1].venue == Venue.query.one()
+    assert posts[0].content_display == '<p>Reply 0</p>'
+
+
+def test_import_duplicates(app):
+    stats = importer.import_file(ndjson([
+        ('post', post(0, 'http://example.org/0', tags=('a', 'b', 'a'))),
+        ('post', post(0, 'http://example.org/copy')),
+    ]), batch_size=10)
+    assert stats['post'] == 1
+    assert stats['post skipped'] == 1
+    assert [t.name for t in Post.query.one().tags] == ['a', 'b']
+
+
+def test_resume_from_checkpoint(app, records, tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint'))
+
+    def interrupted():
+        for ii, record in enumerate(records):
+            if ii == 5:
+                raise KeyboardInterrupt
+            yield record
+
+    with pytest.raises(KeyboardInterrupt):
+        importer.Importer(batch_size=2, checkpoint=checkpoint).run(
+            interrupted())
+    assert json.load(open(checkpoint)) == {'position': 4}
+    assert Post.query.count() == 3
+
+    stats = importer.import_file(ndjson(records), batch_size=2,
+                                 checkpoint=checkpoint)
+    assert stats['post'] == 4
+    assert stats['post skipped'] == 0
+    assert Post.query.count() == 7
+    assert Venue.query.count() == 1
+
+    # without a checkpoint, existing posts are skipped
+    stats = importer.import_file(ndjson(records))
+    assert stats['post skipped'] == 7
+    assert Post.query.count() == 7
+
+
+def test_round_trip_json(app, records):
+    importer.import_file(ndjson(records))
+    exported = ''.join(exporter.iter_json())
+    for model in (Post, Context, Venue):
+        model.query.delete()
+
+    stats = importer.import_file(io.StringIO(exported), fmt='json')
+    assert stats['post'] == 7
+    assert stats['setting'] == 4
+    assert Context.query.count() == 3
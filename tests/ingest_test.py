@@ -0,0 +1,87 @@
+import json
+import pytest
+from redwind import ingest
+from redwind.models import Post, Tag
+
+
+def entry(content, **props):
+    props['content'] = [content]
+    return json.dumps({'type': ['h-entry'], 'properties': props})
+
+
+@pytest.fixture
+def queue(mocker):
+    mocker.patch('redwind.tasks.create_queue')
+    return mocker.patch('redwind.ingest.get_queue')()
+
+
+def test_bulk_endpoint(client, token, queue):
+    body = '\n'.join([
+        entry('first #archive', published=['2010-01-02T03:04:05Z'],
+              syndication=['https://twitter.com/kylewm/status/1']),
+        entry('second', category=['archive', 'silo']),
+        '{not json',
+        '',
+        entry('dupe', syndication=['https://twitter.com/kylewm/status/1']),
+        entry('third', **{'mp-slug': ['a-slug']}),
+    ])
+    rv = client.post('/micropub/bulk?batch_size=2', data=body,
+                     content_type='application/x-ndjson',
+                     headers={'Authorization': 'Bearer ' + token})
+    assert rv.status_code == 200
+    reports = [json.loads(line) for line
+               in rv.get_data(as_text=True).splitlines()]
+    assert [r['created'] for r in reports] == [2, 3]
+    assert reports[-1]['skipped'] == 2
+    assert reports[-1]['lines'] == 6
+    assert [e['line'] for e in reports[1]['errors']] == [3]
+
+    posts = Post.query.order_by(Post.id).all()
+    assert [p.content for p in posts] == ['first #archive', 'second', 'third']
+    assert posts[0].published.isoformat() == '2010-01-02T03:04:05'
+    assert posts[2].slug == 'a-slug'
+    # one tag row despite being used by two posts in the same batch
+    assert Tag.query.filter_by(name='archive').count() == 1
+    assert not any(p.content_html for p in posts)
+
+    assert queue.enqueue.call_count == 2
+    batches = [c[0][1] for c in queue.enqueue.call_args_list]
+    assert [[post_id for post_id, _, _ in b] for b in batches] == [
+        [posts[0].id, posts[1].id], [posts[2].id]]
+
+
+def test_bulk_endpoint_requires_token(client, token):
+    rv = client.post('/micropub/bulk', data=entry('nope'),
+                     content_type='application/x-ndjson')
+    assert rv.status_code == 401
+    assert not Post.query.count()
+
+
+def test_process_batch(app, queue, mocker):
+    fire = mocker.patch('redwind.hooks.fire')
+    mocker.patch('redwind.ingest.async_app_context')
+    list(ingest.ingest_lines([entry('a *markdown* note')], fire_hooks=True))
+    args = queue.enqueue.call_args[0]
+    assert args[0] == ingest.do_process_batch
+
+    ingest.do_process_batch(*args[1:])
+    post = Post.query.one()
+    assert '<em>markdown</em>' in post.content_html
+    assert post.content_display == post.content_html
+    assert fire.call_args[0][:2] == ('post-saved', post)
+
+
+def test_process_batch_fetches_photo(app, queue, mocker):
+    mocker.patch('redwind.ingest.async_app_context')
+    store_url = mocker.patch('redwind.storage.store_url')
+    store_url.return_value = ('blobs/ab/abc', 'abc', 'image/jpeg')
+    list(ingest.ingest_lines([entry(
+        'a photo', photo=['https://example.com/photos/sunset.jpg'])]))
+    args = queue.enqueue.call_args[0]
+    assert args[1][0][2] == 'https://example.com/photos/sunset.jpg'
+
+    ingest.do_process_batch(*args[1:])
+    attachment, = Post.query.one().attachments
+    assert attachment.filename == 'sunset.jpg'
+    assert attachment.storage_path == 'blobs/ab/abc'
+    assert store_url.call_args[0][0] == 'https://example.com/photos/sunset.jpg'
@@ -0,0 +1,67 @@
+import os
+import pytest
+from redwind import maps
+
+
+def test_map_url_memoized(app, mocker):
+    maps.build_map_url.cache_clear()
+    markers = [maps.Marker(37.8, -122.3), maps.Marker(37.9, -122.2)]
+    url1 = maps.get_map_image(600, 400, 13, markers)
+    url2 = maps.get_map_image(600, 400, 13, list(markers))
+    assert url1 == url2
+    assert url1.startswith('/imageproxy?')
+    assert maps.build_map_url.cache_info().misses == 1
+
+
+def test_map_image_local_cache(app, client, mocker):
+    get_queue = mocker.patch('redwind.tasks.get_queue')
+    app.config['MAP_IMAGE_CACHE'] = True
+    markers = [maps.Marker(40.1, -88.2)]
+
+    with app.test_request_context():
+        # no local copy yet, fall back to the proxied remote image
+        url = maps.get_map_image(600, 400, 13, markers)
+        assert url.startswith('/imageproxy?')
+        get_queue().enqueue.assert_called_once_with(
+            maps.fetch_map_image, mocker.ANY, mocker.ANY,
+            app.config['CONFIG_FILE'])
+
+        # already pending in another process
+        get_queue().connection.set.return_value = None
+        maps.get_map_image(600, 400, 13, markers)
+        assert get_queue().enqueue.call_count == 1
+
+        map_url = maps.build_map_url(600, 400, 13, tuple(markers))
+        path = maps.map_image_path(maps.map_image_key(map_url))
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'not really a png')
+
+        url = maps.get_map_image(600, 400, 13, markers)
+        assert url.startswith('/imageproxy/maps/')
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.data == b'not really a png'
+
+
+def test_failed_map_fetch_clears_pending(app, mocker):
+    get_queue = mocker.patch('redwind.tasks.get_queue')
+    mocker.patch('redwind.tasks.async_app_context')
+    mocker.patch('requests.get').side_effect = ValueError('no network')
+    with app.app_context():
+        path = maps.map_image_path('abc123')
+        with pytest.raises(ValueError):
+            maps.fetch_map_image('http://example.com/map.png', path,
+                                 app.config['CONFIG_FILE'])
+    get_queue().connection.delete.assert_called_once_with(
+        'redwind:maps:pending:abc123')
+    assert not os.path.exists(path)
+
+
+def test_fetched_maps_bounded(monkeypatch):
+    monkeypatch.setattr(maps, 'FETCHED_MAPS_SIZE', 2)
+    monkeypatch.setattr(maps, '_fetched_maps', maps.collections.OrderedDict())
+    for key in ['a', 'b', 'a', 'c']:
+        maps.remember_fetched_map(key)
+    assert list(maps._fetched_maps) == ['a', 'c']
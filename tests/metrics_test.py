@@ -0,0 +1,81 @@
+import pytest
+from redwind import metrics
+from redwind import hooks
+
+
+@pytest.fixture
+def enabled(app, monkeypatch):
+    """Turn metrics on for this app only"""
+    monkeypatch.setattr(metrics, 'enabled', False)
+    monkeypatch.setattr(metrics, '_histograms', {})
+    app.config['METRICS'] = True
+    metrics.init_app(app)
+
+
+def test_render():
+    hist = metrics.Histogram()
+    for value in (0.001, 0.02, 0.02, 30):
+        hist.observe(value)
+    text = metrics.render({('redwind_hook_seconds',
+                            (('hook', 'post-saved'),)): hist})
+    lines = text.splitlines()
+    assert lines[0] == '# HELP redwind_hook_seconds ' \
+        'Time taken by each hook action'
+    assert lines[1] == '# TYPE redwind_hook_seconds histogram'
+    assert 'redwind_hook_seconds_bucket{hook="post-saved",le="0.005"} 1' \
+        in lines
+    assert 'redwind_hook_seconds_bucket{hook="post-saved",le="0.025"} 3' \
+        in lines
+    assert 'redwind_hook_seconds_bucket{hook="post-saved",le="10.0"} 3' \
+        in lines
+    assert 'redwind_hook_seconds_bucket{hook="post-saved",le="+Inf"} 4' \
+        in lines
+    assert 'redwind_hook_seconds_count{hook="post-saved"} 4' in lines
+
+
+def test_disabled_by_default(app, monkeypatch):
+    monkeypatch.setattr(metrics, 'enabled', False)
+    monkeypatch.setattr(metrics, '_histograms', {})
+    metrics.observe('redwind_etag_seconds', 0.1)
+    assert metrics._histograms == {}
+
+
+def test_request_phases(enabled, client, auth, mocker):
+    mocker.patch('redwind.tasks.get_queue').return_value\
+        .connection.hgetall.return_value = {}
+    hooks.register('test-hook', lambda: None)
+    hooks.fire('test-hook')
+
+    client.get('/')
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    text = rv.get_data(as_text=True)
+    assert 'redwind_request_seconds_count{endpoint="views.index"} 1' in text
+    assert 'redwind_request_db_seconds_count{endpoint="views.index"} 1' \
+        in text
+    assert 'redwind_template_render_seconds_count{template="home.jinja2"}' \
+        in text
+    assert 'redwind_hook_seconds_count{action="metrics_test.<lambda>",' \
+        'hook="test-hook"} 1' in text
+
+
+def test_jobs_recorded_in_redis(app, enabled, mocker):
+    queue = mocker.patch('redwind.tasks.get_queue').return_value
+
+    @metrics.timed_job
+    def do_something(arg):
+        return arg
+
+    assert do_something(42) == 42
+    pipe = queue.connection.pipeline.return_value
+    pipe.hincrby.assert_any_call(metrics.JOBS_KEY, 'do_something|0', 1)
+    pipe.hincrby.assert_any_call(metrics.JOBS_KEY, 'do_something|count', 1)
+    pipe.execute.assert_called_once_with()
+
+    queue.connection.hgetall.return_value = {
+        b'do_something|0': b'1', b'do_something|sum': b'0.001',
+        b'do_something|count': b'1'}
+    text = metrics.render(metrics.load_job_histograms())
+    assert 'redwind_job_seconds_bucket{job="do_something",le="0.005"} 1' \
+        in text
+    assert 'redwind_job_seconds_sum{job="do_something"} 0.001' in text
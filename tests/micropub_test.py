@@ -0,0 +1,106 @@
+import json
+import pytest
+from redwind import util
+from redwind.models import Post, User, Credential, PosseTarget
+
+
+@pytest.fixture
+def quiet(mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    return mocker.patch('redwind.hooks.fire')
+
+
+def test_create_from_form(client, token, quiet):
+    rv = client.post('/micropub', data={
+        'h': 'entry',
+        'content': 'Posted from a micropub client',
+        'syndicate-to[]': ['twitter', 'facebook'],
+    }, headers={'Authorization': 'Bearer ' + token})
+    assert rv.status_code == 201
+    post = Post.query.one()
+    assert rv.headers['Location'] == post.permalink
+    assert post.post_type == 'note'
+    assert post.content == 'Posted from a micropub client'
+
+    hook, saved, args = quiet.call_args[0]
+    assert (hook, saved) == ('post-saved', post)
+    assert args.getlist('syndicate-to') == ['twitter', 'facebook']
+
+
+def test_create_from_json(client, token, quiet):
+    rv = client.post('/micropub', content_type='application/json', data='''{
+        "type": ["h-entry"],
+        "properties": {
+            "name": ["A JSON article"],
+            "content": [{"html": "<p>Hello <b>world</b></p>"}],
+            "published": ["2015-12-01T10:00:00-08:00"],
+            "mp-syndicate-to": ["twitter"]
+        }
+    }''', headers={'Authorization': 'Bearer ' + token})
+    assert rv.status_code == 201
+    post = Post.query.one()
+    assert post.post_type == 'article'
+    assert post.title == 'A JSON article'
+    assert '<b>world</b>' in post.content_html
+    assert post.published.isoformat() == '2015-12-01T18:00:00'
+    assert quiet.call_args[0][2].getlist('syndicate-to') == ['twitter']
+
+
+def test_existing_syndication(client, token, quiet):
+    data = {
+        'h': 'entry',
+        'content': 'Backfed from twitter',
+        'syndication': 'https://twitter.com/kylewm/status/1234',
+    }
+    headers = {'Authorization': 'Bearer ' + token}
+    rv = client.post('/micropub', data=data, headers=headers)
+    assert rv.status_code == 201
+    rv = client.post('/micropub', data=data, headers=headers)
+    assert rv.status_code == 302
+    assert rv.location == Post.query.one().permalink
+
+
+def test_bad_token(client, token):
+    rv = client.post('/micropub', data={'content': 'nope'},
+                     headers={'Authorization': 'Bearer ' + token + 'x'})
+    assert rv.status_code == 401
+
+
+def test_token_cached(client, token, mocker):
+    decode = mocker.spy(util, 'jwt_decode')
+    headers = {'Authorization': 'Bearer ' + token,
+               'Accept': 'application/json'}
+    assert client.get('/micropub?q=actions', headers=headers).status_code == 200
+    assert client.get('/micropub?q=actions', headers=headers).status_code == 200
+    assert decode.call_count == 1
+
+
+def test_token_revoked(client, token, db):
+    headers = {'Authorization': 'Bearer ' + token}
+    assert client.get('/micropub?q=actions', headers=headers).status_code == 200
+    db.session.delete(Credential.query.one())
+    db.session.commit()
+    assert client.get('/micropub?q=actions', headers=headers).status_code == 401
+
+
+def test_syndicate_to_invalidated(client, token, db, auth):
+    user = User.query.one()
+    user.posse_targets.append(PosseTarget(uid='https://twitter.com/kylewm',
+                                          name='Twitter'))
+    db.session.commit()
+    headers = {'Authorization': 'Bearer ' + token,
+               'Accept': 'application/json'}
+
+    def syndicate_to():
+        rv = client.get('/micropub?q=syndicate-to', headers=headers)
+        return [t['name'] for t in json.loads(rv.get_data(as_text=True))
+                ['syndicate-to']]
+
+    assert syndicate_to() == ['Twitter']
+    target = PosseTarget.query.one()
+    client.post('/posse/edit', data={'target_id': target.id,
+                                     'name': '@kylewm'})
+    assert syndicate_to() == ['@kylewm']
+    client.post('/posse/delete', data={'target_id': target.id})
+    assert syndicate_to() == []
@@ -0,0 +1,32 @@
+from redwind.models import Post, PostSyndication
+
+
+def test_syndication_table_in_sync(client, db, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    client.post('/save_new', data={
+        'post_type': 'note',
+        'content': 'Syndicated note',
+        'syndication': 'https://twitter.com/kylewm/status/1234\n'
+                       'https://www.facebook.com/kyle/posts/5678',
+        'action': 'publish_quietly',
+    })
+    post = Post.query.first()
+    assert post.tweet_id == '1234'
+    assert Post.load_by_syndication_url(
+        'https://www.facebook.com/kyle/posts/5678') == post
+
+    post.add_syndication_url('https://instagram.com/p/abc/')
+    db.session.commit()
+    assert Post.load_by_syndication_url('https://instagram.com/p/abc/') == post
+
+    client.post('/save_edit', data={
+        'post_id': post.id,
+        'post_type': 'note',
+        'content': 'Syndicated note',
+        'syndication': 'https://twitter.com/kylewm/status/1234',
+        'action': 'publish_quietly',
+    })
+    assert [s.url for s in PostSyndication.query.all()] == [
+        'https://twitter.com/kylewm/status/1234']
+    assert not Post.load_by_syndication_url('https://instagram.com/p/abc/')
@@ -0,0 +1,131 @@
+import pytest
+import time
+from redwind import pipeline
+from redwind.models import Post, PosseTarget
+from werkzeug.datastructures import MultiDict
+
+
+@pytest.fixture
+def clean_planners(monkeypatch):
+    monkeypatch.setattr(pipeline, 'planners', [])
+
+
+@pytest.fixture
+def post(app, db):
+    post = Post('note')
+    post.path = '2015/06/pipeline'
+    post.content = post.content_html = 'Hello'
+    post.location = {'latitude': 45.5, 'longitude': -122.6}
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return 'slept'
+
+
+def fail():
+    raise ValueError('unreachable')
+
+
+def save_title(post, title):
+    post.title = title
+    return 'renamed'
+
+
+def test_stages_run_concurrently(app, db, post, clean_planners):
+    pipeline.register(lambda post, args: [
+        pipeline.Stage('first', lambda: sleep(0.3), None),
+        pipeline.Stage('second', lambda: sleep(0.3), None),
+        pipeline.Stage('broken', fail, None),
+        pipeline.Stage('title', lambda: 'New title', save_title),
+    ])
+    start = time.monotonic()
+    with app.test_request_context():
+        pipeline.publish(post, MultiDict())
+    assert time.monotonic() - start < 0.55
+
+    post_id = post.id
+    db.session.remove()
+    post = Post.query.get(post_id)
+    assert post.title == 'New title'
+    assert [(stage['name'], stage['status'], stage['message'])
+            for stage in post.publish_status['stages']] == [
+        ('first', 'ok', 'slept'),
+        ('second', 'ok', 'slept'),
+        ('broken', 'failed', 'unreachable'),
+        ('title', 'ok', 'renamed'),
+    ]
+
+
+def test_do_publish(app, db, post, mocker):
+    mocker.patch('redwind.pipeline.async_app_context')
+    geocode = mocker.patch('redwind.plugins.locations.do_reverse_geocode')
+    geocode.return_value = {'locality': 'Portland', 'region': 'Oregon'}
+    poster = mocker.patch('requests.post')
+    poster.return_value.headers = {'Location': 'https://example.org/1'}
+
+    target = PosseTarget()
+    target.uid = 'https://example.org/'
+    target.name = 'Example'
+    target.micropub_endpoint = 'https://example.org/micropub'
+    db.session.add(target)
+    db.session.commit()
+
+    post_id = post.id
+    pipeline.do_publish(post_id, MultiDict({
+        'action': 'publish_quietly',
+        'syndicate-to': 'https://example.org/',
+    }), app.config['CONFIG_FILE'])
+
+    db.session.remove()
+    post = Post.query.get(post_id)
+    assert post.location['locality'] == 'Portland'
+    assert post.syndication == ['https://example.org/1']
+    assert [(stage['name'], stage['status'])
+            for stage in post.publish_status['stages']] == [
+        ('reverse geocode', 'ok'),
+        ('syndicate to Example', 'ok'),
+    ]
+    assert poster.call_args[0][0] == 'https://example.org/micropub'
+
+
+def test_status_on_edit_page(app, client, auth, post, db):
+    post.publish_status = {'finished': '2015-06-01T00:00:00', 'stages': [
+        {'name': 'webmentions', 'status': 'failed',
+         'message': 'connection refused', 'seconds': 1.5},
+    ]}
+    db.session.commit()
+    text = client.get('/edit?id={}'.format(post.id)).get_data(as_text=True)
+    assert 'connection refused' in text
+
+
+def test_serial_stages_run_in_job_thread(app, db, post, clean_planners):
+    import threading
+    pipeline.register(lambda post, args: [
+        pipeline.Stage('pooled', threading.current_thread, None),
+        pipeline.Stage('serial', lambda: Post.query.count(), None,
+                       serial=True),
+    ])
+    with app.test_request_context():
+        pipeline.publish(post, MultiDict())
+    assert [(stage['name'], stage['message'])
+            for stage in post.publish_status['stages']][1] == ('serial', '1')
+
+
+def test_twitter_stage(app, db, post, clean_planners, mocker):
+    from redwind.plugins import twitter
+    mocker.patch('redwind.plugins.twitter.is_twitter_authorized')
+    tweet = mocker.patch('redwind.plugins.twitter.handle_new_or_edit')
+    tweet.return_value = 'https://twitter.com/kylewm/status/1'
+    pipeline.register(twitter.plan_twitter)
+    with app.test_request_context():
+        pipeline.publish(post, MultiDict({'syndicate-to': 'twitter'}))
+    assert post.publish_status['stages'] == [{
+        'name': 'twitter', 'status': 'ok',
+        'message': 'https://twitter.com/kylewm/status/1',
+        'seconds': mocker.ANY,
+    }]
+    assert tweet.call_args[0][0] is post
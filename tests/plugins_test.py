@@ -0,0 +1,25 @@
+from redwind import create_app
+from redwind.extensions import db
+
+
+def test_only_enabled_plugins_loaded(app, tmpdir):
+    cfg = tmpdir.join('redwind.cfg')
+    cfg.write("SECRET_KEY = 'lmnop8765309'\n"
+              "SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'\n"
+              "PLUGINS = ['wm_receiver']\n".format(tmpdir.join('db')))
+    other = create_app(str(cfg))
+    assert 'wm_receiver' in other.blueprints
+    assert 'twitter' not in other.blueprints
+    assert 'posse' not in other.blueprints
+
+    with other.app_context():
+        db.create_all()
+        rv = other.test_client().get('/')
+        db.session.remove()
+    assert rv.status_code == 200
+    assert 'rel="webmention"' in rv.get_data(as_text=True)
+
+
+def test_default_plugins(app):
+    assert 'twitter' in app.blueprints
+    assert 'static_site' in app.config['PLUGINS']
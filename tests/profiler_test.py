@@ -0,0 +1,104 @@
+import threading
+import time
+import pytest
+from redwind import profiler
+
+
+@pytest.fixture
+def redis(app, mocker, monkeypatch):
+    """Turn the profiler on, with a mock Redis connection"""
+    monkeypatch.setattr(profiler, '_plan_read', None)
+    monkeypatch.setattr(profiler._sampler, 'interval', 0.0005)
+    app.config['PROFILER'] = True
+    profiler.init_app(app)
+    conn = mocker.patch('redwind.profiler.redis_connection').return_value
+    conn.hgetall.return_value = {}
+    return conn
+
+
+def busy_work(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler():
+    sampler = profiler.Sampler(interval=0.001)
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_work, args=(stop,))
+    thread.start()
+    counts = sampler.start(thread.ident)
+    time.sleep(0.05)
+    assert sampler.stop(thread.ident) is counts
+    stop.set()
+    thread.join()
+
+    assert counts
+    stack = counts.most_common(1)[0][0]
+    assert stack.rpartition(';')[2].startswith(
+        'busy_work (tests/profiler_test.py:')
+    assert stack.split(';')[0].startswith('_bootstrap ')
+
+
+def test_should_profile(app, redis):
+    plan = {'endpoint': 'views.index', 'percent': '100', 'requests': ''}
+    assert profiler.should_profile(plan, 'views.index')
+    assert not profiler.should_profile(plan, 'views.post_by_path')
+    assert not profiler.should_profile(dict(plan, percent='0'),
+                                       'views.index')
+
+    plan = {'endpoint': '', 'percent': '', 'requests': '2'}
+    redis.decr.return_value = 0
+    assert profiler.should_profile(plan, 'views.index')
+    redis.decr.return_value = -1
+    assert not profiler.should_profile(plan, 'views.index')
+    redis.delete.assert_called_once_with(
+        profiler.PLAN_KEY, profiler.REMAINING_KEY)
+
+
+def test_disabled(redis, client):
+    client.get('/')
+    redis.pipeline.assert_not_called()
+
+
+def test_profile_request(app, redis, client):
+    app.add_url_rule('/slow', 'slow', lambda: time.sleep(0.05) or 'done')
+    redis.hgetall.return_value = {
+        b'endpoint': b'slow', b'percent': b'100', b'requests': b''}
+    client.get('/')
+    client.get('/slow')
+    pipe = redis.pipeline.return_value
+    pipe.incr.assert_called_once_with(profiler.REQUESTS_KEY)
+    stacks = [args[1] for args, _ in pipe.hincrby.call_args_list]
+    assert stacks
+    assert all(stack.startswith('slow;') for stack in stacks)
+    assert any('<lambda> (tests/profiler_test.py:' in stack
+               for stack in stacks)
+
+
+def test_start(redis, client, auth):
+    rv = client.post('/profiler', data={
+        'action': 'start', 'requests': '10', 'endpoint': 'views.index'})
+    assert rv.status_code == 302
+    pipe = redis.pipeline.return_value
+    pipe.hmset.assert_called_once_with(profiler.PLAN_KEY, {
+        'endpoint': 'views.index', 'percent': '', 'requests': 10})
+    pipe.set.assert_called_once_with(profiler.REMAINING_KEY, 10)
+
+
+def test_start_needs_requests_or_percent(redis, client, auth):
+    rv = client.post('/profiler', data={
+        'action': 'start', 'requests': '', 'percent': '',
+        'endpoint': 'views.index'})
+    assert rv.status_code == 302
+    with client.session_transaction() as session:
+        (category, message), = session['_flashes']
+    assert message.startswith('Enter a number of requests')
+    assert not redis.pipeline.return_value.hmset.called
+
+
+def test_download(redis, client, auth):
+    redis.hgetall.return_value = {b'views.index;a;b': b'3',
+                                  b'views.index;a': b'1'}
+    rv = client.get('/profiler/stacks')
+    assert rv.get_data(as_text=True) == \
+        'views.index;a 1\nviews.index;a;b 3\n'
@@ -0,0 +1,39 @@
+import pytest
+from redwind import rerender
+from redwind.models import Post
+
+
+@pytest.fixture
+def stale(db):
+    for ii in range(5):
+        post = Post('note')
+        post.path = '2015/06/post-{}'.format(ii)
+        post.content = 'Some *emphasis* in post {}'.format(ii)
+        post.content_html = post.content_display = (
+            '<p>Some <em>emphasis</em> in post {}</p>'.format(ii))
+        db.session.add(post)
+    # rendered before #hashtags were linked
+    post.content += ' #indieweb'
+    db.session.commit()
+    return post
+
+
+def test_rerender_only_writes_changes(app, stale, mocker):
+    report = mocker.Mock()
+    stats = rerender.rerender_all(processes=1, chunk_size=2, report=report)
+    assert stats['rendered'] == 5
+    assert stats['changed'] == 1
+    assert report.call_count == 3
+    assert [c[0][0]['rendered'] for c in report.call_args_list] == [2, 4, 5]
+
+    post = Post.query.get(stale.id)
+    assert '<a href="/tags/indieweb">#indieweb</a>' in post.content_html
+    assert post.content_display == post.content_html
+
+
+def test_render_rows(app):
+    rows = [(1, 'note', '2015/06/a', 'hello', '<p>hello</p>',
+             '<p>hello</p>'),
+            (2, 'note', '2015/06/b', 'hello', '<p>old</p>', '<p>old</p>')]
+    assert rerender.render_rows(rows) == [
+        {'post_id': 2, 'html': '<p>hello</p>', 'display': '<p>hello</p>'}]
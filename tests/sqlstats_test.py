@@ -0,0 +1,96 @@
+import datetime
+import pytest
+from redwind import sqlstats
+from redwind.models import Post, Tag, Mention, Context, Contact, Nick
+from testutil import assert_max_queries
+
+
+@pytest.fixture
+def busy_posts(app, db):
+    """Posts with tags, people, reply contexts and mentions, enough to
+    show up any per-post lazy loads on a page
+    """
+    tags = [Tag('tag{}'.format(ii)) for ii in range(3)]
+    contacts = []
+    for ii in range(3):
+        contact = Contact(name='Person {}'.format(ii),
+                          url='http://person{}.example.org/'.format(ii))
+        contact.social = []
+        contact.nicks = [Nick('person{}'.format(ii))]
+        contacts.append(contact)
+    now = datetime.datetime(2015, 6, 1)
+    posts = []
+    for ii in range(12):
+        post = Post('reply')
+        post.path = '2015/06/post-{}'.format(ii)
+        post.published = now - datetime.timedelta(hours=ii)
+        post.content = post.content_html = 'Reply {}'.format(ii)
+        post.update_display_html()
+        post.tags = tags
+        post.people = contacts
+        context = Context()
+        context.url = context.permalink = 'http://example.org/{}'.format(ii)
+        context.content = 'Hello'
+        context.update_display_html()
+        post.in_reply_to = [context.url]
+        post.reply_contexts = [context]
+        for jj in range(3):
+            mention = Mention()
+            mention.url = mention.permalink = \
+                'http://example.org/m/{}/{}'.format(ii, jj)
+            mention.reftype = 'reply'
+            mention.content = 'Nice'
+            mention.update_display_html()
+            post.mentions.append(mention)
+        posts.append(post)
+    db.session.add_all(posts)
+    db.session.commit()
+    return posts
+
+
+def test_fingerprint():
+    assert sqlstats.fingerprint(
+        'SELECT *\n  FROM post WHERE id IN (?, ?, ?)') == \
+        'SELECT * FROM post WHERE id IN (?)'
+    assert sqlstats.fingerprint(
+        'SELECT * FROM post WHERE id IN (%(id_1)s, %(id_2)s)') == \
+        'SELECT * FROM post WHERE id IN (?)'
+
+
+def test_count_queries(app, busy_posts):
+    with sqlstats.count_queries() as stats:
+        for post in busy_posts:
+            Post.load_by_id(post.id)
+    assert stats.count == len(busy_posts)
+    assert len(stats.repeated()) == 1
+
+
+def test_response_headers(app, client, busy_posts):
+    app.config['SQL_STATS'] = True
+    sqlstats.init_app(app)
+    rv = client.get('/')
+    assert int(rv.headers['X-Query-Count']) > 0
+    assert rv.headers['X-Query-Time'].endswith('ms')
+
+
+def test_index_query_budget(client, db, busy_posts):
+    client.get('/')
+    # start from an empty session, as each request does
+    db.session.remove()
+    with assert_max_queries(4):
+        assert client.get('/').status_code == 200
+
+
+def test_render_post_query_budget(client, db, busy_posts):
+    path = '/' + busy_posts[0].path
+    client.get(path)
+    db.session.remove()
+    with assert_max_queries(10):
+        assert client.get(path).status_code == 200
+
+
+def test_edit_query_budget(client, db, auth, busy_posts):
+    url = '/edit?id={}'.format(busy_posts[0].id)
+    db.session.remove()
+    with assert_max_queries(12):
+        assert client.get(url).status_code == 200
@@ -0,0 +1,107 @@
+import datetime
+import os
+import pytest
+from redwind import hooks
+from redwind import pipeline
+from redwind.models import Post, Tag
+from redwind.plugins import static_site
+
+
+@pytest.fixture
+def static_dir(app, tmpdir, monkeypatch):
+    monkeypatch.setattr(hooks, 'actions', {
+        hook: list(actions) for hook, actions in hooks.actions.items()})
+    app.config['STATIC_SITE_PATH'] = str(tmpdir)
+    static_site.register(app)
+    yield tmpdir
+    del app.config['STATIC_SITE_PATH']
+
+
+@pytest.fixture
+def post(db):
+    post = Post('note')
+    post.path = '2015/06/hello'
+    post.slug = 'hello'
+    post.content = post.content_html = 'Hello static world'
+    post.published = post.updated = datetime.datetime(2015, 6, 1)
+    post.friends_only = False
+    post.tags = [Tag('static')]
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+def test_render_post_pages(app, static_dir, post):
+    written = static_site.render_pages(static_site.urls_for_post(post))
+    assert written == len(static_site.urls_for_post(post))
+    for path in ('2015/06/hello/index.html', 'index.html', 'index.atom',
+                 'notes/index.html', 'tags/static/index.atom',
+                 'tags/index.html'):
+        assert static_dir.join(path).check(), path
+    assert 'Hello static world' in \
+        static_dir.join('2015/06/hello/index.html').read()
+
+
+def test_remove_deleted(app, db, static_dir, post):
+    static_site.render_pages(['/2015/06/hello'])
+    permalink = static_dir.join('2015/06/hello/index.html')
+    assert permalink.check()
+
+    post.deleted = True
+    db.session.commit()
+    static_site.render_pages(['/2015/06/hello'])
+    assert not permalink.check()
+
+
+def test_hooks_queue_regeneration(app, static_dir, post, mocker):
+    get_queue = mocker.patch('redwind.hooks.get_queue')
+    with app.test_request_context():
+        hooks.fire('post-deleted', post, {})
+    job, hook, names, args, kwargs, _ = get_queue().enqueue.call_args[0]
+    assert (job, hook) == (hooks.do_fire, 'post-deleted')
+    assert 'redwind.plugins.static_site.on_post_changed' in names
+    assert args == [hooks.ModelRef('Post', post.id), {}]
+    assert static_site.on_mention_received(None) is None
+
+
+def test_regenerated_after_publish(app, client, auth, static_dir, post,
+                                   mocker, monkeypatch):
+    get_queue = mocker.patch('redwind.pipeline.get_queue')
+    mocker.patch('redwind.pipeline.async_app_context')
+    mocker.patch('redwind.hooks.get_queue')
+    # the snapshot must include what the publish stages add
+    monkeypatch.setattr(pipeline, 'planners', [lambda post, args: [
+        pipeline.Stage('syndicate', lambda: 'https://example.org/copy',
+                       lambda post, url: post.add_syndication_url(url))]])
+    post_id = post.id
+    static_site.render_pages(static_site.urls_for_post(post))
+    tag_page = static_dir.join('tags/static/index.html')
+    assert 'Hello static world' in tag_page.read()
+
+    client.post('/save_edit', data={
+        'post_id': post_id,
+        'post_type': 'article',
+        'title': 'Hello',
+        'content': 'Hello static world',
+        'action': 'publish_quietly',
+    })
+    job, *args = get_queue().enqueue.call_args[0]
+    assert job == pipeline.do_publish
+    assert args[1].getlist('previous-tag') == ['static']
+    assert args[1]['previous-post-type'] == 'note'
+
+    job(*args)
+    assert 'Hello static world' not in tag_page.read()
+    assert 'Hello static world' not in \
+        static_dir.join('notes/index.html').read()
+    assert 'Hello static world' in \
+        static_dir.join('articles/index.html').read()
+    assert 'https://example.org/copy' in \
+        static_dir.join('2015/06/hello/index.html').read()
+
+
+def test_build_all(app, static_dir, post):
+    written = static_site.build_all(processes=1)
+    assert written == len(static_site.all_urls())
+    assert static_dir.join('2015/06/hello/index.html').check()
+    assert static_dir.join('tags/static/index.html').check()
@@ -0,0 +1,118 @@
+import io
+import os
+from redwind import storage
+from redwind.models import Post
+
+
+def save_photo(client, content):
+    return client.post('/save_new', data={
+        'photo': (open('tests/image.jpg', 'rb'), 'image.jpg', 'image/jpeg'),
+        'post_type': 'photo',
+        'content': content,
+        'action': 'publish_quietly',
+    })
+
+
+def test_duplicate_uploads_share_a_blob(app, client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    save_photo(client, 'First copy')
+    save_photo(client, 'Second copy')
+
+    first, second = [p.attachments[0] for p in Post.query.all()]
+    assert first.storage_path == second.storage_path
+    assert storage.is_blob_path(first.storage_path)
+    assert first.storage_path.endswith(first.content_hash)
+    assert storage.refcount(first.storage_path) == 2
+
+    blobs = [f for _, _, files in os.walk(app.config['UPLOAD_PATH'])
+             for f in files]
+    assert blobs == [first.content_hash]
+
+    # the blob is collected once its last reference is gone
+    path = first.disk_path
+    storage.delete_attachment(first)
+    assert storage.collect_garbage(min_age=-1) == []
+    storage.delete_attachment(second)
+    assert os.path.exists(path)
+    assert storage.collect_garbage(min_age=-1) == [second.storage_path]
+    assert not os.path.exists(path)
+
+
+def test_collect_garbage(app):
+    storage_path, _ = storage.store_stream(io.BytesIO(b'orphaned'))
+    assert storage.collect_garbage() == []
+    assert storage.collect_garbage(min_age=-1, dry_run=True) == [storage_path]
+    assert storage.collect_garbage(min_age=-1) == [storage_path]
+    assert storage.collect_garbage(min_age=-1) == []
+
+
+def test_deleting_post_keeps_files(app, client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    save_photo(client, 'Deleted, for now')
+    post = Post.query.first()
+    path = post.attachments[0].disk_path
+
+    rv = client.get('/delete?id={}'.format(post.id))
+    assert rv.status_code == 302
+    assert Post.query.first().deleted
+    assert Post.query.first().attachments
+    assert storage.collect_garbage(min_age=-1) == []
+    assert os.path.exists(path)
+
+
+def test_upload_size_limit(app, client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    app.config['MAX_UPLOAD_SIZE'] = 1024
+    rv = save_photo(client, 'Too big')
+    assert rv.status_code == 413
+    assert not Post.query.all()
+    assert not os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'tmp'))
+
+
+def test_upload_moved_not_copied(app, client, auth, mocker):
+    mocker.patch('requests.get')
+    mocker.patch('redwind.tasks.create_queue')
+    save_photo(client, 'Streamed')
+    assert not os.listdir(os.path.join(app.config['UPLOAD_PATH'], 'tmp'))
+    with open('tests/image.jpg', 'rb') as f:
+        assert f.read() == open(
+            Post.query.first().attachments[0].disk_path, 'rb').read()
+
+
+def test_remote_photo_fetched_later(app, client, auth, mocker):
+    from redwind import posts
+    get_queue = mocker.patch('redwind.posts.get_queue')
+    mocker.patch('redwind.tasks.create_queue')
+    fire = mocker.patch('redwind.hooks.fire')
+    with open('tests/image.jpg', 'rb') as f:
+        image_data = f.read()
+
+    rv = client.post('/save_new', data={
+        'photo': 'http://example.org/photos/kitten.jpg',
+        'post_type': 'photo',
+        'content': 'Remote photo',
+        'action': 'publish_quietly',
+    })
+    assert rv.status_code == 302
+    post = Post.query.first()
+    assert not post.attachments
+    assert not fire.called
+    args = get_queue().enqueue.call_args[0]
+    assert args[:3] == (posts.do_fetch_photo, post.id,
+                        'http://example.org/photos/kitten.jpg')
+
+    response = mocker.patch('requests.get').return_value
+    response.headers = {'content-type': 'image/jpeg'}
+    response.iter_content.return_value = [image_data[:100], image_data[100:]]
+    mocker.patch('redwind.posts.async_app_context')
+    posts.do_fetch_photo(*args[1:])
+
+    attachment = post.attachments[0]
+    assert attachment.filename == 'kitten.jpg'
+    assert attachment.mimetype == 'image/jpeg'
+    assert open(attachment.disk_path, 'rb').read() == image_data
+    fire.assert_called_once_with('post-saved', post, mocker.ANY)
+    assert fire.call_args[0][2].get('action') == 'publish_quietly'
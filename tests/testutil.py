@@ -1,3 +1,5 @@
+from redwind import sqlstats
+import contextlib
 import urllib
 
 
@@ -55,3 +57,11 @@ class FakeUrlMetadata:
 
     def get_content_maintype(self):
         return self.content_type.split('/')[0]
+
+
+@contextlib.contextmanager
+def assert_max_queries(budget):
+    """Fail if the with block issues more than budget SQL queries"""
+    with sqlstats.count_queries() as stats:
+        yield stats
+    assert stats.count <= budget, stats.report()
@@ -30,6 +30,28 @@ def test_create_post(client, auth, mocker):
     assert 'This is a test note' in rv.get_data(as_text=True)
 
 
+def test_display_html_stored(client, db, auth, mocker):
+    """Proxied images and previews are rendered once, at save time"""
+    from redwind.models import Post
+    mocker.patch('requests.get').return_value = FakeResponse()
+    mocker.patch('redwind.tasks.create_queue')
+    client.post('/save_new', data={
+        'post_type': 'note',
+        'content': '![cat](http://example.org/cat.jpg) '
+                   'https://www.youtube.com/watch?v=abcdef',
+        'action': 'publish_quietly',
+    })
+    post = Post.query.first()
+    assert '/imageproxy?url=http' in post.content_display
+    # images already present, so no preview is added
+    assert 'youtube.com/embed' not in post.content_display
+
+    post.content_display = 'stored display html'
+    db.session.commit()
+    rv = client.get(post.permalink)
+    assert 'stored display html' in rv.get_data(as_text=True)
+
+
 @pytest.fixture
 def silly_posts(client, auth, mocker):
     mocker.patch('requests.get').return_value = FakeResponse()
@@ -1,8 +1,12 @@
 from redwind.plugins import wm_receiver
 from redwind import util
+from redwind.models import Mention, Post
 
+import http.server
+import json
 import pytest
-from testutil import FakeResponse, FakeUrlOpen
+import threading
+from testutil import FakeResponse
 from flask.ext.login import current_user
 from flask import current_app
 
@@ -25,6 +29,7 @@ def target_url(client, auth, mocker):
 
 def test_wm_receipt(client, target_url, mocker):
     get_queue = mocker.patch('redwind.plugins.wm_receiver.get_queue')
+    get_queue().connection.get.return_value = None
     source_url = 'http://foreign/permalink/url'
 
     assert not current_user
@@ -36,13 +41,88 @@ def test_wm_receipt(client, target_url, mocker):
         mocker.ANY)
 
 
+def test_wm_receipt_coalesced(client, target_url, mocker):
+    get_queue = mocker.patch('redwind.plugins.wm_receiver.get_queue')
+    source_url = 'http://foreign/permalink/url'
+    pending = get_queue().fetch_job.return_value
+    pending.id = 'pending-job'
+    pending.is_queued = True
+    pending.args = (source_url, target_url, None, 'redwind.cfg')
+    get_queue().connection.get.return_value = b'pending-job'
+
+    rv = client.post('/webmention', data={'source': source_url,
+                                          'target': target_url})
+    assert 202 == rv.status_code
+    assert '/webmention/status/pending-job' in rv.get_data(as_text=True)
+    get_queue().fetch_job.assert_called_once_with('pending-job')
+    assert not get_queue().enqueue.called
+
+    # once the job has started, a new mention needs a new job
+    pending.is_queued = False
+    client.post('/webmention', data={'source': source_url,
+                                     'target': target_url})
+    assert get_queue().enqueue.called
+
+
+def test_process_wm_unchanged_source(app, target_url, mocker):
+    get_queue = mocker.patch('redwind.plugins.wm_receiver.get_queue')
+    mocker.patch('redwind.plugins.wm_receiver.async_app_context')
+    save = mocker.patch('redwind.plugins.wm_receiver.save_mention_result')
+    getter = mocker.patch('requests.get')
+    getter.return_value = FakeResponse(status_code=304)
+    source_url = 'http://foreign/permalink/url'
+    previous = {'source': source_url, 'target': target_url,
+                'response_code': 200, 'status': 'success',
+                'reason': 'Created'}
+    get_queue().connection.get.return_value = json.dumps(
+        {'etag': '"v1"', 'response': previous}).encode()
+
+    response = wm_receiver.do_process_webmention(
+        source_url, target_url, None, app.config['CONFIG_FILE'])
+
+    assert response == previous
+    assert not save.called
+    getter.assert_called_once_with(
+        source_url, timeout=TIMEOUT,
+        headers=dict(HEADERS, **{'If-None-Match': '"v1"'}))
+
+
+def test_process_wm_failures_not_remembered(app, target_url, mocker):
+    get_queue = mocker.patch('redwind.plugins.wm_receiver.get_queue')
+    get_queue().connection.get.return_value = None
+    mocker.patch('redwind.plugins.wm_receiver.async_app_context')
+    save = mocker.patch('redwind.plugins.wm_receiver.save_mention_result')
+    getter = mocker.patch('requests.get')
+    source_url = 'http://foreign/permalink/url'
+
+    def process():
+        return wm_receiver.do_process_webmention(
+            source_url, target_url, None, app.config['CONFIG_FILE'])
+
+    # the source could not be read this time
+    getter.return_value = FakeResponse(status_code=503)
+    getter.return_value.headers['ETag'] = '"v1"'
+    process()
+    # it could, but saving the mention failed
+    getter.return_value = FakeResponse('<a href="{}">hi</a>'.format(
+        target_url))
+    getter.return_value.headers['ETag'] = '"v2"'
+    save.side_effect = ValueError('database is locked')
+    assert process()['status'] == 'error'
+    assert not get_queue().connection.set.called
+
+    save.side_effect = None
+    save.return_value = {'status': 'success'}
+    process()
+    assert get_queue().connection.set.call_args[0][1] == json.dumps(
+        {'etag': '"v2"', 'response': {'status': 'success'}})
+
+
 def test_process_wm(db, client, target_url, mocker):
     source_url = 'http://foreign/permalink/url'
 
-    urlopen = mocker.patch('urllib.request.urlopen')
     getter = mocker.patch('requests.get')
 
-    urlopen.return_value = FakeUrlOpen(target_url)  # follows redirects
     getter.return_value = FakeResponse("""
 
     <!DOCTYPE html>
@@ -74,8 +154,6 @@ def test_process_wm_no_target_post(client, mocker):
     source_url = 'http://foreign/permalink/url'
     target_url = 'http://example.com/buy/cialis'  # possible spam
 
-    urlopen = mocker.patch('urllib.request.urlopen')
-    urlopen.return_value = FakeUrlOpen(target_url)  # follows redirects
 
     assert not current_user
     result = wm_receiver.interpret_mention(source_url, target_url)
@@ -89,10 +167,8 @@ def test_process_wm_no_target_post(client, mocker):
 def test_process_wm_deleted(client, target_url, mocker):
     source_url = 'http://foreign/permalink/url'
 
-    urlopen = mocker.patch('urllib.request.urlopen')
     getter = mocker.patch('requests.get')
 
-    urlopen.return_value = FakeUrlOpen(target_url)  # follows redirects
     getter.return_value = FakeResponse(status_code=410)
 
     assert not current_user
@@ -104,3 +180,121 @@ def test_process_wm_deleted(client, target_url, mocker):
     assert result.error is None
     getter.assert_called_once_with('http://foreign/permalink/url',
                                    timeout=TIMEOUT, headers=HEADERS)
+
+
+def test_find_target_post_url_forms(app, db, target_url, mocker):
+    urlopen = mocker.patch('urllib.request.urlopen')
+    post = Post.query.first()
+    post.short_path = 'n/4Ab1'
+    post.historic_path = 'note/2014/11/23/1'
+    moved = Post('note')
+    moved.path = '2014/11/moved'
+    moved.redirect = target_url
+    db.session.add(moved)
+    db.session.commit()
+
+    with app.test_request_context():
+        for url in (target_url,
+                    'http://example.com/n/4Ab1',
+                    'http://example.com/note/2014/11/23/1',
+                    'http://example.com/note/2014/11/23/1/some-slug',
+                    'http://example.com/2014/11/moved',
+                    'https://example.com/n/4Ab1'):
+            assert wm_receiver.find_target_post(url) == post, url
+
+        assert wm_receiver.find_target_post(
+            'http://example.com/2014/11/no-such-post') is None
+        assert wm_receiver.find_target_post(
+            'http://example.com/tags/indieweb/') is None
+        assert wm_receiver.find_target_post(
+            'http://other.example/n/4Ab1') is None
+
+        post.redirect = 'http://example.com/2014/11/moved'
+        assert wm_receiver.find_target_post(target_url) is None
+    assert not urlopen.called
+
+
+class StubSource(http.server.BaseHTTPRequestHandler):
+    """Serves one page, with an ETag and Last-Modified, answering
+    conditional requests with 304 Not Modified when validators is set
+    """
+    page = ''
+    validators = True
+    requests = []
+
+    def do_GET(self):
+        etag = '"{}"'.format(hash(self.page))
+        StubSource.requests.append(dict(self.headers))
+        if self.validators and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.page.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if self.validators:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Mon, 01 Jun 2015 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.yield_fixture
+def stub_source():
+    server = http.server.HTTPServer(('127.0.0.1', 0), StubSource)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    StubSource.requests = []
+    StubSource.validators = True
+    yield 'http://127.0.0.1:{}/reply'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def reply_page(source_url, target_url, content):
+    return """<!DOCTYPE html>
+    <html><body class="h-entry">
+      <a href="{}" class="u-in-reply-to">In Reply To</a>
+      <div class="e-content">{}</div>
+      <a href="{}" class="u-url">Permalink</a>
+    </body></html>""".format(target_url, content, source_url)
+
+
+def test_conditional_source_fetch(app, db, target_url, stub_source, mocker):
+    mocker.patch('redwind.plugins.wm_receiver.get_queue')\
+        .return_value.connection.get.return_value = None
+    mocker.patch('redwind.plugins.wm_receiver.async_app_context')
+    mocker.patch('redwind.hooks.get_queue')
+    parse = mocker.spy(wm_receiver, 'interpret_source')
+
+    def process():
+        return wm_receiver.do_process_webmention(
+            stub_source, target_url, None, app.config['CONFIG_FILE'])
+
+    StubSource.page = reply_page(stub_source, target_url, 'First')
+    assert process()['reason'] == 'Created'
+    mention = Mention.query.filter_by(url=stub_source).one()
+    assert mention.source_etag and mention.source_hash
+    assert mention.source_last_modified == 'Mon, 01 Jun 2015 00:00:00 GMT'
+
+    # the server answers 304 Not Modified
+    assert process()['reason'] == 'Updated'
+    assert StubSource.requests[-1]['If-None-Match'] == mention.source_etag
+    assert StubSource.requests[-1]['If-Modified-Since'] == \
+        mention.source_last_modified
+    assert parse.call_count == 1
+
+    # no validators from the server, but the same content
+    StubSource.validators = False
+    assert process()['reason'] == 'Updated'
+    assert parse.call_count == 1
+
+    # the reply was edited
+    StubSource.page = reply_page(stub_source, target_url, 'Edited')
+    assert process()['reason'] == 'Updated'
+    assert parse.call_count == 2
+    assert Mention.query.filter_by(url=stub_source).one().content == 'Edited'
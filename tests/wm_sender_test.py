@@ -1,4 +1,5 @@
 import pytest
+from redwind import pipeline
 from redwind.models import Post
 from redwind.plugins import wm_sender
 from testutil import FakeResponse, FakeUrlOpen, FakeUrlMetadata
@@ -16,14 +17,24 @@ def source_post(app, db):
 
 
 def test_queue_wm_sender(app, auth, client, mocker):
-    get_queue = mocker.patch('redwind.plugins.wm_sender.get_queue')
+    get_queue = mocker.patch('redwind.pipeline.get_queue')
     client.post('/save_new', data={
         'post_type': 'note',
         'content': 'Some content',
     })
     post = Post.query.first()
     get_queue().enqueue.assert_called_with(
-        wm_sender.do_send_webmentions, post.id, mocker.ANY)
+        pipeline.do_publish, post.id, mocker.ANY, mocker.ANY)
+
+
+def test_plan_webmentions(app, source_post):
+    with app.test_request_context():
+        stage, = wm_sender.plan_webmentions(source_post, {})
+        assert stage.name == 'webmentions'
+        assert stage.run.args == (
+            source_post, ['https://en.wikipedia.org/wiki/Webmention'])
+        assert wm_sender.plan_webmentions(
+            source_post, {'action': 'publish_quietly'}) == []
 
 
 def test_send_wms(mocker, source_post):